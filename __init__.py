@@ -1,21 +1,168 @@
 import os
-import json
+import re
 import time
+import heapq
+import asyncio
+import collections
+import operator
 import logging
 import threading
+import concurrent.futures
 import ctpwrapper as CTP
 import ctpwrapper.ApiStructure as CTPStruct
 
 MAX_TIMEOUT = 10
+MAX_BACKOFF = 60
+SUBSCRIBE_BATCH = 500
 DATA_DIR = ".ctp_client_data/"
 
 FILTER = lambda x: None if x > 1.797e+308 else x
 
+TICK_FIELDS = ("code", "price", "open", "close", "highest", "lowest", "upper_limit",
+        "lower_limit", "settlement", "volume", "turnover", "open_interest", "pre_close",
+        "pre_settlement", "pre_open_interest") +                                        \
+        sum((("ask_price%d" % i, "ask_volume%d" % i, "bid_price%d" % i, "bid_volume%d" % i)
+                for i in range(1, 6)), ()) +                                           \
+        ("trading_day", "action_day", "update_time", "update_millisec")
+TICK_INT_FIELDS = frozenset(["volume", "open_interest", "pre_open_interest",
+        "update_millisec"] +
+        ["%s_volume%d" % (side, i) for side in ("ask", "bid") for i in range(1, 6)])
+TICK_STR_FIELDS = frozenset(["code", "trading_day", "action_day", "update_time"])
+
+class Tick(tuple):
+
+    __slots__ = ()
+
+    def __repr__(self):
+        return "Tick(%s)" % ", ".join("%s=%r" % item for item in zip(TICK_FIELDS, self))
+
+for (i, name) in enumerate(TICK_FIELDS):
+    setattr(Tick, name, property(operator.itemgetter(i)))
+for i in range(1, 6):
+    setattr(Tick, "ask%d" % i, property(operator.itemgetter(11 + 4 * i, 12 + 4 * i)))
+    setattr(Tick, "bid%d" % i, property(operator.itemgetter(13 + 4 * i, 14 + 4 * i)))
+
+def decodeTick(field, M = 1.797e+308):
+    f = field
+    return (f.InstrumentID,
+            None if f.LastPrice > M else f.LastPrice,
+            None if f.OpenPrice > M else f.OpenPrice,
+            None if f.ClosePrice > M else f.ClosePrice,
+            None if f.HighestPrice > M else f.HighestPrice,
+            None if f.LowestPrice > M else f.LowestPrice,
+            None if f.UpperLimitPrice > M else f.UpperLimitPrice,
+            None if f.LowerLimitPrice > M else f.LowerLimitPrice,
+            None if f.SettlementPrice > M else f.SettlementPrice,
+            f.Volume, f.Turnover, int(f.OpenInterest),
+            None if f.PreClosePrice > M else f.PreClosePrice,
+            None if f.PreSettlementPrice > M else f.PreSettlementPrice,
+            int(f.PreOpenInterest),
+            None if f.AskPrice1 > M else f.AskPrice1, f.AskVolume1,
+            None if f.BidPrice1 > M else f.BidPrice1, f.BidVolume1,
+            None if f.AskPrice2 > M else f.AskPrice2, f.AskVolume2,
+            None if f.BidPrice2 > M else f.BidPrice2, f.BidVolume2,
+            None if f.AskPrice3 > M else f.AskPrice3, f.AskVolume3,
+            None if f.BidPrice3 > M else f.BidPrice3, f.BidVolume3,
+            None if f.AskPrice4 > M else f.AskPrice4, f.AskVolume4,
+            None if f.BidPrice4 > M else f.BidPrice4, f.BidVolume4,
+            None if f.AskPrice5 > M else f.AskPrice5, f.AskVolume5,
+            None if f.BidPrice5 > M else f.BidPrice5, f.BidVolume5,
+            f.TradingDay, f.ActionDay, f.UpdateTime, f.UpdateMillisec)
+
+def tickToDict(t):
+    return {"code": t[0], "price": t[1], "open": t[2], "close": t[3], "highest": t[4],
+            "lowest": t[5], "upper_limit": t[6], "lower_limit": t[7], "settlement": t[8],
+            "volume": t[9], "turnover": t[10], "open_interest": t[11], "pre_close": t[12],
+            "pre_settlement": t[13], "pre_open_interest": t[14],
+            "ask1": (t[15], t[16]), "bid1": (t[17], t[18]),
+            "ask2": (t[19], t[20]), "bid2": (t[21], t[22]),
+            "ask3": (t[23], t[24]), "bid3": (t[25], t[26]),
+            "ask4": (t[27], t[28]), "bid4": (t[29], t[30]),
+            "ask5": (t[31], t[32]), "bid5": (t[33], t[34]),
+            "trading_day": t[35], "action_day": t[36], "update_time": t[37],
+            "update_millisec": t[38]}
+
+def decodeTickDict(field, M = 1.797e+308):
+    f = field
+    return {"code": f.InstrumentID,
+            "price": None if f.LastPrice > M else f.LastPrice,
+            "open": None if f.OpenPrice > M else f.OpenPrice,
+            "close": None if f.ClosePrice > M else f.ClosePrice,
+            "highest": None if f.HighestPrice > M else f.HighestPrice,
+            "lowest": None if f.LowestPrice > M else f.LowestPrice,
+            "upper_limit": None if f.UpperLimitPrice > M else f.UpperLimitPrice,
+            "lower_limit": None if f.LowerLimitPrice > M else f.LowerLimitPrice,
+            "settlement": None if f.SettlementPrice > M else f.SettlementPrice,
+            "volume": f.Volume, "turnover": f.Turnover, "open_interest": int(f.OpenInterest),
+            "pre_close": None if f.PreClosePrice > M else f.PreClosePrice,
+            "pre_settlement": None if f.PreSettlementPrice > M else f.PreSettlementPrice,
+            "pre_open_interest": int(f.PreOpenInterest),
+            "ask1": (None if f.AskPrice1 > M else f.AskPrice1, f.AskVolume1),
+            "bid1": (None if f.BidPrice1 > M else f.BidPrice1, f.BidVolume1),
+            "ask2": (None if f.AskPrice2 > M else f.AskPrice2, f.AskVolume2),
+            "bid2": (None if f.BidPrice2 > M else f.BidPrice2, f.BidVolume2),
+            "ask3": (None if f.AskPrice3 > M else f.AskPrice3, f.AskVolume3),
+            "bid3": (None if f.BidPrice3 > M else f.BidPrice3, f.BidVolume3),
+            "ask4": (None if f.AskPrice4 > M else f.AskPrice4, f.AskVolume4),
+            "bid4": (None if f.BidPrice4 > M else f.BidPrice4, f.BidVolume4),
+            "ask5": (None if f.AskPrice5 > M else f.AskPrice5, f.AskVolume5),
+            "bid5": (None if f.BidPrice5 > M else f.BidPrice5, f.BidVolume5),
+            "trading_day": f.TradingDay, "action_day": f.ActionDay,
+            "update_time": f.UpdateTime, "update_millisec": f.UpdateMillisec}
+
+def decodeTickObject(field):
+    return Tick(decodeTick(field))
+
+TICK_TYPES = {"dict": decodeTickDict, "tick": decodeTickObject, "tuple": decodeTick}
+TICK_CONVERTERS = {"dict": tickToDict, "tick": Tick, "tuple": None}
+
 class SpiHelper:
 
     def __init__(self):
         self._event = threading.Event()
         self._error = None
+        self._ready = False
+        self._reconnecting = False
+        self._backoff = 1
+        self._status_handler = None
+
+    def isReady(self):
+        return self._ready
+
+    def _create(self, name, front):
+        #the flow files of each front in their own directory, so the sessions of a pool
+        #do not share, and overwrite, each other's resume positions
+        flow_dir = DATA_DIR + name + "/" + re.sub(r"\W+", "_", front).strip("_") + "/"
+        os.makedirs(flow_dir, exist_ok = True)
+        self.Create(flow_dir)
+
+    def setStatusHandler(self, func):
+        self._status_handler = func
+
+    def _setReady(self, ready):
+        self._ready = ready
+        if ready:
+            (self._reconnecting, self._backoff) = (False, 1)
+        if self._status_handler:
+            self._status_handler(self, ready)
+
+    def _onDisconnected(self, error):
+        if self._ready:
+            self._reconnecting = True
+            #fail the request being waited for instead of letting it time out
+            self.notifyCompletion(error)
+        self._setReady(False)
+
+    def _retryLogin(self):
+        #the API reconnects by itself, but a failed login after that has to be retried here
+        if not self._reconnecting:
+            return
+        delay = self._backoff
+        self._backoff = min(self._backoff * 2, MAX_BACKOFF)
+        logging.warning("%d秒后重新登录..." % delay)
+        timer = threading.Timer(delay, self.OnFrontConnected)
+        timer.daemon = True
+        timer.start()
 
     def resetCompletion(self):
         self._event.clear()
@@ -42,6 +189,7 @@ class SpiHelper:
     def checkApiReturnInCallback(self, ret):
         if ret != 0:
             self.notifyCompletion(self._cvtApiRetToError(ret))
+        return ret == 0
 
     def checkRspInfoInCallback(self, info):
         if not info or info.ErrorID == 0:
@@ -50,15 +198,395 @@ class SpiHelper:
         return False
 
 
+class RequestFuture:
+
+    def __init__(self, operation_name = ""):
+        self._operation_name = operation_name
+        self._lock = threading.Lock()
+        #held until the future completes, a Lock costs far less to create than an Event and
+        #a future is created for every order
+        self._waiter = threading.Lock()
+        self._waiter.acquire()
+        self._done = False
+        self._result = None
+        self._error = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done
+
+    def wait(self, timeout = MAX_TIMEOUT):
+        if not self._done:
+            if not self._waiter.acquire(True, -1 if timeout is None else timeout):
+                raise TimeoutError("%s超时" % self._operation_name)
+            #pass it on to the other waiters
+            self._waiter.release()
+        if isinstance(self._error, Exception):
+            raise self._error
+        if self._error:
+            raise RuntimeError(self._error)
+        return self._result
+
+    def addCallback(self, func):
+        with self._lock:
+            if not self._done:
+                self._callbacks.append(func)
+                return
+        func(self)
+
+    def setResult(self, result = None):
+        return self._complete(result, None)
+
+    def setError(self, error):
+        return self._complete(None, error)
+
+    def _complete(self, result, error):
+        with self._lock:
+            if self._done:
+                return False
+            (self._result, self._error) = (result, error)
+            self._done = True
+            (callbacks, self._callbacks) = (self._callbacks, [])
+        self._waiter.release()
+        for func in callbacks:
+            func(self)
+        return True
+
+
+class TickDispatcher:
+
+    def __init__(self, receiver, workers = 1, queue_size = 10000, conflate = False):
+        assert(workers > 0 and queue_size > 0)
+        self._receiver = receiver
+        self._queue_size = queue_size
+        self._conflate = conflate
+        self._running = True
+        self._shards = []
+        for i in range(workers):
+            shard = {"cond": threading.Condition(), "queue": collections.deque(),
+                    "latest": {}, "max_depth": 0, "delivered": 0, "dropped": 0,
+                    "conflated": 0}
+            shard["thread"] = threading.Thread(target = self._work, args = (shard,),
+                    name = "ctp_dispatch_%d" % i, daemon = True)
+            self._shards.append(shard)
+        for shard in self._shards:
+            shard["thread"].start()
+
+    def __call__(self, tick):
+        code = tick["code"] if isinstance(tick, dict) else tick[0]
+        shard = self._shards[hash(code) % len(self._shards)]
+        with shard["cond"]:
+            queue = shard["queue"]
+            if self._conflate:
+                latest = shard["latest"]
+                if code in latest:
+                    shard["conflated"] += 1
+                else:
+                    queue.append(code)
+                latest[code] = tick
+            else:
+                if len(queue) >= self._queue_size:
+                    queue.popleft()
+                    shard["dropped"] += 1
+                queue.append(tick)
+            if len(queue) > shard["max_depth"]:
+                shard["max_depth"] = len(queue)
+            shard["cond"].notify()
+
+    def _work(self, shard):
+        (cond, queue, latest) = (shard["cond"], shard["queue"], shard["latest"])
+        while True:
+            with cond:
+                while self._running and not queue:
+                    cond.wait()
+                if not self._running:
+                    return
+                tick = latest.pop(queue.popleft()) if self._conflate else queue.popleft()
+                shard["delivered"] += 1
+            try:
+                self._receiver(tick)
+            except Exception:
+                logging.exception("行情接收器出错")
+
+    def getStats(self):
+        stats = {"queue_depth": 0, "max_queue_depth": 0, "delivered": 0, "dropped": 0,
+                "conflated": 0}
+        for shard in self._shards:
+            with shard["cond"]:
+                stats["queue_depth"] += len(shard["queue"])
+                stats["max_queue_depth"] = max(stats["max_queue_depth"], shard["max_depth"])
+                for key in ("delivered", "dropped", "conflated"):
+                    stats[key] += shard[key]
+        return stats
+
+    def close(self):
+        self._running = False
+        for shard in self._shards:
+            with shard["cond"]:
+                shard["cond"].notify()
+        for shard in self._shards:
+            shard["thread"].join()
+
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+class TokenBucket:
+
+    def __init__(self, rate, burst = 1):
+        assert(rate > 0 and burst >= 1)
+        self._rate = rate
+        self._burst = burst
+        self._tokens = burst
+        self._last_time = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self._burst,
+                        self._tokens + (now - self._last_time) * self._rate)
+                self._last_time = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                time.sleep((1 - self._tokens) / self._rate)
+
+
+class QueryScheduler:
+
+    def __init__(self, rate = 1, burst = 1):
+        self._bucket = TokenBucket(rate, burst)
+        self._cond = threading.Condition()
+        self._queue = []
+        self._seq = 0
+        #key -> [future, func, priority in the queue or None once running]
+        self._futures = {}
+        self._thread = threading.Thread(target = self._work, name = "ctp_query",
+                daemon = True)
+        self._thread.start()
+
+    def submit(self, key, func, priority = PRIORITY_NORMAL, operation_name = ""):
+        with self._cond:
+            item = None if key is None else self._futures.get(key)
+            if item:
+                if item[2] is not None and priority < item[2]:
+                    #still queued, a more urgent caller moves it up and the old place is
+                    #skipped
+                    item[2] = priority
+                    self._seq += 1
+                    heapq.heappush(self._queue, (priority, self._seq, key, item[1], item[0]))
+                    self._cond.notify()
+                return item[0]
+            future = RequestFuture(operation_name)
+            if key is not None:
+                self._futures[key] = [future, func, priority]
+            self._seq += 1
+            heapq.heappush(self._queue, (priority, self._seq, key, func, future))
+            self._cond.notify()
+        return future
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                (priority, _, key, func, future) = heapq.heappop(self._queue)
+                if key is not None:
+                    item = self._futures.get(key)
+                    if not item or item[0] is not future or item[2] != priority:
+                        continue
+                    item[2] = None
+            self._bucket.acquire()
+            try:
+                (result, error) = (func(), None)
+            except Exception as e:
+                (result, error) = (None, e)
+            with self._cond:
+                if key is not None:
+                    del self._futures[key]
+            if error:
+                future.setError(error)
+            else:
+                future.setResult(result)
+
+
+class TradingBook:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._orders = {}
+        self._codes = {}
+        self._positions = {}
+        #(code, direction) -> volume still to be closed by active orders
+        self._closing = {}
+        self._trade_ids = set()
+        #version counts every change, positions_version only those of the positions
+        self.version = 0
+        self.positions_version = 0
+
+    @staticmethod
+    def _closingVolume(order):
+        if order and order["is_active"] and order["volume"] < 0:
+            return -order["volume"] - order["volume_traded"]
+        return 0
+
+    @staticmethod
+    def _progress(order):
+        #an order only ever trades more and then ends
+        return (order["volume_traded"], not order["is_active"])
+
+    def _mergeOrders(self, orders, recent):
+        #orders returned since they were queried may be further along than the query, or
+        #missing from it
+        merged = {oid: order.copy() for (oid, order) in orders.items()}
+        for oid in recent:
+            (mine, theirs) = (self._orders.get(oid), merged.get(oid))
+            if mine and (not theirs or self._progress(mine) > self._progress(theirs)):
+                merged[oid] = mine.copy()
+        return merged
+
+    @classmethod
+    def _expectPositions(cls, positions, trades):
+        #the queried positions plus the trades returned after they were answered
+        merged = cls.mergePositions(positions)
+        seen = set()
+        for (trade_id, *trade) in trades:
+            if trade_id not in seen:
+                seen.add(trade_id)
+                cls._addTrade(merged, *trade)
+        return merged
+
+    def reset(self, orders, positions, trades = (), recent = ()):
+        with self._lock:
+            self._orders = self._mergeOrders(orders, recent)
+            self._codes = {}
+            self._closing = {}
+            for (oid, order) in self._orders.items():
+                self._codes.setdefault(order["code"], set()).add(oid)
+                key = (order["code"], order["direction"])
+                self._closing[key] = self._closing.get(key, 0) + self._closingVolume(order)
+            self._positions = self._expectPositions(positions, trades)
+            self._trade_ids.update(trade[0] for trade in trades)
+            self.version += 1
+            self.positions_version += 1
+
+    @staticmethod
+    def mergePositions(positions):
+        merged = {}
+        for position in positions:
+            key = (position["code"], position["direction"])
+            if key in merged:
+                for field in ("volume", "margin", "cost"):
+                    merged[key][field] += position[field]
+            else:
+                merged[key] = position.copy()
+        return merged
+
+    def updateOrder(self, oid, order):
+        with self._lock:
+            old = self._orders.get(oid)
+            key = (order["code"], order["direction"])
+            self._closing[key] = self._closing.get(key, 0) - self._closingVolume(old) +     \
+                    self._closingVolume(order)
+            self._orders[oid] = order
+            self._codes.setdefault(order["code"], set()).add(oid)
+            self.version += 1
+
+    def applyTrade(self, trade_id, code, direction, volume, price, multiple, margin_ratio):
+        with self._lock:
+            if trade_id in self._trade_ids:
+                return
+            self._trade_ids.add(trade_id)
+            self.version += 1
+            self.positions_version += 1
+            self._addTrade(self._positions, code, direction, volume, price, multiple,
+                    margin_ratio)
+
+    @staticmethod
+    def _addTrade(positions, code, direction, volume, price, multiple, margin_ratio):
+        key = (code, direction)
+        position = positions.get(key)
+        if volume > 0:
+            if not position:
+                position = {"code": code, "direction": direction, "volume": 0,
+                        "margin": 0.0, "cost": 0.0}
+                positions[key] = position
+            position["volume"] += volume
+            position["cost"] += price * volume * multiple
+            position["margin"] += price * volume * multiple * (margin_ratio or 0)
+        elif position:
+            ratio = min(-volume / position["volume"], 1)
+            position["volume"] += volume
+            position["cost"] -= position["cost"] * ratio
+            position["margin"] -= position["margin"] * ratio
+            if position["volume"] <= 0:
+                del positions[key]
+
+    def getOrder(self, oid):
+        with self._lock:
+            order = self._orders.get(oid)
+            return order and order.copy()
+
+    def getOrders(self, code = None, direction = None):
+        with self._lock:
+            oids = self._orders if code is None else self._codes.get(code, ())
+            return {oid: self._orders[oid].copy() for oid in oids
+                    if direction is None or self._orders[oid]["direction"] == direction}
+
+    def getClosable(self, code, direction):
+        #the position less the volume active orders are already closing
+        with self._lock:
+            position = self._positions.get((code, direction))
+            held = position["volume"] if position else 0
+            return held - self._closing.get((code, direction), 0)
+
+    def getPositions(self, code = None, direction = None):
+        with self._lock:
+            if code is not None and direction is not None:
+                position = self._positions.get((code, direction))
+                return [position.copy()] if position else []
+            return [position.copy() for (key, position) in self._positions.items()
+                    if code in (None, key[0]) and direction in (None, key[1])]
+
+    def diff(self, orders, positions, trades = (), recent = ()):
+        #order id or (code, direction) -> what differs
+        drifts = {}
+        with self._lock:
+            orders = self._mergeOrders(orders, recent)
+            for (oid, order) in orders.items():
+                mine = self._orders.get(oid)
+                if not mine or (mine["volume_traded"], mine["is_active"]) !=                  \
+                        (order["volume_traded"], order["is_active"]):
+                    drifts[oid] = "报单<%s>：本地%s，服务器%s" % (oid, mine, order)
+            for oid in set(self._orders) - set(orders):
+                drifts[oid] = "报单<%s>：本地%s，服务器无此报单" % (oid, self._orders[oid])
+            positions = self._expectPositions(positions, trades)
+            for key in set(positions) | set(self._positions):
+                (mine, theirs) = (self._positions.get(key), positions.get(key))
+                if (mine and mine["volume"]) != (theirs and theirs["volume"]):
+                    drifts[key] = "持仓<%s %s>：本地%s手，服务器%s手" % (key + (
+                            mine["volume"] if mine else 0, theirs["volume"] if theirs else 0))
+        return drifts
+
+
 class QuoteImpl(SpiHelper, CTP.MdApiPy):
 
     def __init__(self, front):
         SpiHelper.__init__(self)
         CTP.MdApiPy.__init__(self)
         self._receiver = None
-        flow_dir = DATA_DIR + "md_flow/"
-        os.makedirs(flow_dir, exist_ok = True)
-        self.Create(flow_dir)
+        self._tick_decoder = decodeTickDict
+        self._tick_converter = None
+        self._tick_sinks = []
+        self._tick_store = None
+        self._latency = None
+        self._codes = set()
+        self._pending_chunks = 0
+        self._resubscribe_chunks = 0
+        self._create("md_flow", front)
         self.RegisterFront(front)
         self.Init()
         self.waitCompletion("登录行情会话")
@@ -69,102 +597,286 @@ class QuoteImpl(SpiHelper, CTP.MdApiPy):
     def OnFrontConnected(self):
         logging.info("已连接行情服务器...")
         field = CTPStruct.ReqUserLoginField()
-        self.checkApiReturnInCallback(self.ReqUserLogin(field, 0))
+        if not self.checkApiReturnInCallback(self.ReqUserLogin(field, 0)):
+            self._retryLogin()
 
     def OnRspUserLogin(self, _, info, req_id, is_last):
         assert(req_id == 0)
         assert(is_last)
         if not self.checkRspInfoInCallback(info):
+            self._retryLogin()
             return
         logging.info("已登录行情会话...")
         self.notifyCompletion()
+        if self._reconnecting:
+            self._resubscribe()
+        self._setReady(True)
+
+    def OnFrontDisconnected(self, reason):
+        logging.warning("已断开行情服务器（原因：%#x）..." % reason)
+        self._onDisconnected("行情前置已断开")
+
+    def _resubscribe(self):
+        codes = sorted(self._codes)
+        #not waited for, their responses come before those of any later subscribe() and
+        #must not count against it
+        self._resubscribe_chunks = 0
+        for i in range(0, len(codes), SUBSCRIBE_BATCH):
+            self._resubscribe_chunks += 1
+            ret = self.SubscribeMarketData(codes[i: i + SUBSCRIBE_BATCH])
+            if ret != 0:
+                self._resubscribe_chunks -= 1
+                logging.warning("重新订阅行情失败：%s" % self._cvtApiRetToError(ret))
+                return
+        if codes:
+            logging.info("已重新订阅%d个合约的行情..." % len(codes))
 
-    def setReceiver(self, func):
+    def setReceiver(self, func, tick_type = "dict"):
+        if tick_type not in TICK_TYPES:
+            raise ValueError("错误的行情格式<%s>" % tick_type)
         old_func = self._receiver
-        self._receiver = func
+        (self._receiver, self._tick_decoder, self._tick_converter) =                  \
+                (func, TICK_TYPES[tick_type], TICK_CONVERTERS[tick_type])
         return old_func
 
+    def addTickSink(self, sink):
+        self._tick_sinks = self._tick_sinks + [sink]
+
+    def removeTickSink(self, sink):
+        self._tick_sinks = [s for s in self._tick_sinks if s is not sink]
+
+    def enableTickStore(self, capacity = 1024, max_codes = 4096):
+        from .tickstore import TickStore
+        if self._tick_store:
+            self.removeTickSink(self._tick_store)
+        self._tick_store = TickStore(capacity, max_codes)
+        self.addTickSink(self._tick_store)
+
+    def getTickStore(self):
+        if not self._tick_store:
+            raise RuntimeError("未启用行情缓存")
+        return self._tick_store
+
     def subscribe(self, codes):
+        if self._tick_store:
+            self._tick_store.addCodes(codes)
+        self._sendChunks(self.SubscribeMarketData, codes, "订阅行情")
+        self._codes.update(codes)
+        logging.info("已订阅%d个合约的行情..." % len(codes))
+
+    def _sendChunks(self, send, codes, name):
+        #send all chunks back to back and wait for the last response of each
+        codes = list(codes)
+        chunks = [codes[i: i + SUBSCRIBE_BATCH] for i in range(0, len(codes), SUBSCRIBE_BATCH)]
+        if not chunks:
+            return
         self.resetCompletion()
-        self.checkApiReturn(self.SubscribeMarketData(codes))
-        self.waitCompletion("订阅行情")
-
-    def OnRspSubMarketData(self, field, info, _, is_last):
+        self._pending_chunks = len(chunks)
+        for chunk in chunks:
+            self.checkApiReturn(send(chunk))
+        self.waitCompletion(name)
+
+    def _gotChunk(self, info, is_last):
+        if self._resubscribe_chunks:
+            if info and info.ErrorID != 0:
+                logging.warning("重新订阅行情失败：%s" % info.ErrorMsg)
+            if is_last:
+                self._resubscribe_chunks -= 1
+            return
         if not self.checkRspInfoInCallback(info):
             assert(is_last)
             return
-        logging.info("已订阅<%s>的行情..." % field.InstrumentID)
         if is_last:
-            self.notifyCompletion()
+            self._pending_chunks -= 1
+            if self._pending_chunks == 0:
+                self.notifyCompletion()
+
+    def OnRspSubMarketData(self, field, info, _, is_last):
+        self._gotChunk(info, is_last)
+
+    def setLatencyStats(self, latency):
+        self._latency = latency
 
     def OnRtnDepthMarketData(self, field):
-        if not self._receiver:
-            return
-        self._receiver({"code": field.InstrumentID, "price": FILTER(field.LastPrice),
-                "open": FILTER(field.OpenPrice), "close": FILTER(field.ClosePrice),
-                "highest": FILTER(field.HighestPrice), "lowest": FILTER(field.LowestPrice),
-                "upper_limit": FILTER(field.UpperLimitPrice),
-                "lower_limit": FILTER(field.LowerLimitPrice),
-                "settlement": FILTER(field.SettlementPrice), "volume": field.Volume,
-                "turnover": field.Turnover, "open_interest": int(field.OpenInterest),
-                "pre_close": FILTER(field.PreClosePrice),
-                "pre_settlement": FILTER(field.PreSettlementPrice),
-                "pre_open_interest": int(field.PreOpenInterest),
-                "ask1": (FILTER(field.AskPrice1), field.AskVolume1),
-                "bid1": (FILTER(field.BidPrice1), field.BidVolume1),
-                "ask2": (FILTER(field.AskPrice2), field.AskVolume2),
-                "bid2": (FILTER(field.BidPrice2), field.BidVolume2),
-                "ask3": (FILTER(field.AskPrice3), field.AskVolume3),
-                "bid3": (FILTER(field.BidPrice3), field.BidVolume3),
-                "ask4": (FILTER(field.AskPrice4), field.AskVolume4),
-                "bid4": (FILTER(field.BidPrice4), field.BidVolume4),
-                "ask5": (FILTER(field.AskPrice5), field.AskVolume5),
-                "bid5": (FILTER(field.BidPrice5), field.BidVolume5)})
+        if self._latency:
+            return self._timedDepthMarketData(field)
+        receiver = self._receiver
+        sinks = self._tick_sinks
+        if sinks:
+            tick = decodeTick(field)
+            for sink in sinks:
+                #a failing sink, like a full BarEngine, must not cost the others the tick
+                try:
+                    sink(tick)
+                except Exception:
+                    logging.exception("行情处理器出错")
+            if receiver:
+                converter = self._tick_converter
+                receiver(converter(tick) if converter else tick)
+        elif receiver:
+            receiver(self._tick_decoder(field))
+
+    def _timedDepthMarketData(self, field):
+        latency = self._latency
+        latency.recordTick(field, time.time())
+        exchange = latency.exchangeOf(field.InstrumentID, field.ExchangeID)
+        start = time.perf_counter()
+        (receiver, sinks, tick) = (self._receiver, self._tick_sinks, None)
+        if sinks:
+            tick = decodeTick(field)
+            for sink in sinks:
+                #a failing sink, like a full BarEngine, must not cost the others the tick
+                try:
+                    sink(tick)
+                except Exception:
+                    logging.exception("行情处理器出错")
+            if receiver and self._tick_converter:
+                tick = self._tick_converter(tick)
+        elif receiver:
+            tick = self._tick_decoder(field)
+        decoded = time.perf_counter()
+        latency.record("tick.dispatch", exchange, decoded - start)
+        if receiver:
+            receiver(tick)
+            latency.record("tick.receiver", exchange, time.perf_counter() - decoded)
 
     def unsubscribe(self, codes):
-        self.resetCompletion()
-        self.checkApiReturn(self.UnSubscribeMarketData(codes))
-        self.waitCompletion("取消订阅行情")
+        self._codes.difference_update(codes)
+        self._sendChunks(self.UnSubscribeMarketData, codes, "取消订阅行情")
+        logging.info("已取消订阅%d个合约的行情..." % len(codes))
+
+    def clearSubscriptions(self):
+        self._codes.clear()
 
     def OnRspUnSubMarketData(self, field, info, _, is_last):
-        if not self.checkRspInfoInCallback(info):
-            assert(is_last)
-            return
-        logging.info("已取消订阅<%s>的行情..." % field.InstrumentID)
-        if is_last:
-            self.notifyCompletion()
+        self._gotChunk(info, is_last)
 
 
 class TraderImpl(SpiHelper, CTP.TraderApiPy):
 
-    def __init__(self, front, broker_id, app_id, auth_code, user_id, password):
+    def __init__(self, front, broker_id, app_id, auth_code, user_id, password,
+            fast_start = False, query_rate = 1, query_burst = 1, reconcile_interval = 60,
+            order_rate = 6, order_burst = 6):
         SpiHelper.__init__(self)
         CTP.TraderApiPy.__init__(self)
-        self._last_query_time = 0
+        self._scheduler = QueryScheduler(query_rate, query_burst)
+        self._order_bucket = TokenBucket(order_rate, order_burst)
+        self._refreshed = threading.Event()
+        self._trans_regs = None
+        self._book = TradingBook()
+        self._book_ready = threading.Event()
+        self._book_error = None
+        #while the book is queried, [ids of the orders returned, trades returned after the
+        #positions were answered], which the answers may miss
+        self._snapshot = None
+        self._snapshot_lock = threading.Lock()
+        self._positions_snapshot = None
+        self._reconcile_interval = reconcile_interval
         self._broker_id = broker_id
         self._app_id = app_id
         self._auth_code = auth_code
         self._user_id = user_id
         self._password = password
-        self._order_action = None
         self._order_ref = 0
-        flow_dir = DATA_DIR + "td_flow/"
-        os.makedirs(flow_dir, exist_ok = True)
-        self.Create(flow_dir)
+        self._order_lock = threading.Lock()
+        self._pending_orders = {}
+        self._pending_deletes = {}
+        self._latency = None
+        self._sent_times = {}
+        self._trade_store = None
+        self._trade_store_lock = threading.Lock()
+        self._risk = None
+        #order key -> (risk gate, close volume it holds until the order reaches the book)
+        self._close_holds = {}
+        #(code, direction, opening, order type) -> the fixed fields of InputOrderField
+        self._templates = {}
+        self._create("td_flow", front)
         self.RegisterFront(front)
-        self.SubscribePrivateTopic(2)   #THOST_TERT_QUICK
+        #replay the order and trade returns missed while disconnected
+        self.SubscribePrivateTopic(1)   #THOST_TERT_RESUME
         self.SubscribePublicTopic(2)    #THOST_TERT_QUICK
+        start_time = time.monotonic()
         self.Init()
         self.waitCompletion("登录交易会话")
-        del self._app_id, self._auth_code, self._password
-        self._getInstruments()
-        self._getTransferRegisters()
-
-    def _limitFrequency(self):
-        delta = time.time() - self._last_query_time
-        if delta < 1:
-            time.sleep(1 - delta)
-        self._last_query_time = time.time()
+        logging.info("登录交易会话用时%.3f秒..." % (time.monotonic() - start_time))
+        if fast_start and self._loadCachedInstruments():
+            threading.Thread(target = self._refreshInBackground, name = "ctp_refresh",
+                    daemon = True).start()
+            threading.Thread(target = self._reconcile, name = "ctp_reconcile",
+                    daemon = True).start()
+        else:
+            self._refresh(PRIORITY_NORMAL)
+            self._seedBook()
+            if reconcile_interval > 0:
+                threading.Thread(target = self._reconcile, name = "ctp_reconcile",
+                        daemon = True).start()
+
+    def _snapshotBook(self, priority):
+        snapshot = [set(), None]
+        self._snapshot = snapshot
+        try:
+            orders = self.queryOrders(priority).wait(None)
+            #a query of its own, one already running may have been answered before the
+            #snapshot started
+            positions = self._query(("book_positions",), lambda: self._queryPositions(snapshot),
+                    priority, "获取所有持仓").wait(None)
+        except Exception:
+            self._snapshot = None
+            raise
+        #the trades go on to be recorded until the caller takes the snapshot lock
+        return (orders, positions, snapshot[1], snapshot[0])
+
+    def _seedBook(self):
+        start_time = time.monotonic()
+        (orders, positions, trades, recent) = self._snapshotBook(PRIORITY_NORMAL)
+        with self._snapshot_lock:
+            self._snapshot = None
+            self._book.reset(orders, positions, trades, recent)
+            self._book_error = None
+            self._book_ready.set()
+        logging.info("初始化本地报单和持仓用时%.3f秒..." % (time.monotonic() - start_time))
+
+    def _reconcile(self):
+        backoff = 1
+        while not self._book_ready.is_set():
+            try:
+                self._seedBook()
+            except Exception as e:
+                #an empty book must not pass for the real one, keep retrying
+                self._book_error = e
+                logging.exception("初始化本地报单和持仓失败，%d秒后重试" % backoff)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, MAX_BACKOFF)
+        suspects = {}
+        while self._reconcile_interval > 0:
+            #a drift is checked again soon
+            time.sleep(min(self._reconcile_interval, 1) if suspects else self._reconcile_interval)
+            try:
+                #orders of earlier sessions that never returned did not reach the server,
+                #the rest are in the orders queried now
+                stale = [key for key in self._close_holds
+                        if key[: 2] != (self._front_id, self._session_id)]
+                (orders, positions, trades, recent) = self._snapshotBook(PRIORITY_LOW)
+                for key in stale:
+                    self._releaseHold(key)
+                #returns go on meanwhile, what they add since the queries counts as agreed, but
+                #one on its way as the server answered still looks like a drift once, so only
+                #a drift seen twice in a row is acted on
+                with self._snapshot_lock:
+                    self._snapshot = None
+                    drifts = self._book.diff(orders, positions, trades, recent)
+                    confirmed = [drifts[key] for key in drifts if key in suspects]
+                    if confirmed:
+                        self._book.reset(orders, positions, trades, recent)
+                suspects = {} if confirmed else drifts
+                if confirmed:
+                    logging.warning("本地报单和持仓与服务器不一致，已以服务器为准：\n%s" %
+                            "\n".join(confirmed))
+            except Exception:
+                logging.exception("核对本地报单和持仓失败")
+
+    def _query(self, key, func, priority, operation_name):
+        return self._scheduler.submit(key, func, priority, operation_name)
 
     def __del__(self):
         logging.info("已登出交易服务器...")
@@ -173,54 +885,133 @@ class TraderImpl(SpiHelper, CTP.TraderApiPy):
         logging.info("已连接交易服务器...")
         field = CTPStruct.ReqAuthenticateField(BrokerID = self._broker_id,
                 AppID = self._app_id, AuthCode = self._auth_code, UserID = self._user_id)
-        self.checkApiReturnInCallback(self.ReqAuthenticate(field, 1))
+        if not self.checkApiReturnInCallback(self.ReqAuthenticate(field, 1)):
+            self._retryLogin()
 
     def OnRspAuthenticate(self, _, info, req_id, is_last):
         assert(req_id == 1)
         assert(is_last)
         if not self.checkRspInfoInCallback(info):
+            self._retryLogin()
             return
         logging.info("已通过交易终端认证...")
         field = CTPStruct.ReqUserLoginField(BrokerID = self._broker_id,
                 UserID = self._user_id, Password = self._password)
-        self.checkApiReturnInCallback(self.ReqUserLogin(field, 0))
+        if not self.checkApiReturnInCallback(self.ReqUserLogin(field, 0)):
+            self._retryLogin()
 
     def OnRspUserLogin(self, field, info, req_id, is_last):
         assert(req_id == 0)
         assert(is_last)
         if not self.checkRspInfoInCallback(info):
+            self._retryLogin()
             return
         self._front_id = field.FrontID
         self._session_id = field.SessionID
+        self._trading_day = field.TradingDay
         logging.info("已登录交易会话...")
         field = CTPStruct.SettlementInfoConfirmField(BrokerID = self._broker_id,
                 InvestorID = self._user_id)
-        self.checkApiReturnInCallback(self.ReqSettlementInfoConfirm(field, 2))
+        if not self.checkApiReturnInCallback(self.ReqSettlementInfoConfirm(field, 2)):
+            self._retryLogin()
 
     def OnRspSettlementInfoConfirm(self, _, info, req_id, is_last):
         assert(req_id == 2)
         assert(is_last)
         if not self.checkRspInfoInCallback(info):
+            self._retryLogin()
             return
         logging.info("已确认结算单...")
         self.notifyCompletion()
+        self._setReady(True)
+
+    def OnFrontDisconnected(self, reason):
+        logging.warning("已断开交易服务器（原因：%#x）..." % reason)
+        self._onDisconnected("交易前置已断开")
+        with self._order_lock:
+            futures = list(self._pending_orders.values()) + list(self._pending_deletes.values())
+            self._pending_orders.clear()
+            self._pending_deletes.clear()
+            self._sent_times.clear()
+        #the returns of these requests, if any, are replayed into the book after reconnecting
+        for future in futures:
+            future.setError("交易前置已断开，请求结果未知，请在重连后查询订单")
+
+    def _refresh(self, priority):
+        try:
+            start_time = time.monotonic()
+            self._getInstruments(priority)
+            logging.info("加载合约用时%.3f秒..." % (time.monotonic() - start_time))
+            start_time = time.monotonic()
+            self._getTransferRegisters(priority)
+            logging.info("获取银期签约关系用时%.3f秒..." % (time.monotonic() - start_time))
+        finally:
+            self._refreshed.set()
+
+    def _refreshInBackground(self):
+        try:
+            self._refresh(PRIORITY_LOW)
+        except Exception:
+            logging.exception("后台刷新合约和银期签约关系失败")
+
+    def _loadCachedInstruments(self):
+        from .instruments import InstrumentTable
+        cache_dir = DATA_DIR + "instruments/"
+        if not os.path.isdir(cache_dir):
+            return False
+        for name in sorted(os.listdir(cache_dir), reverse = True):
+            if not name.endswith(".dat"):
+                continue
+            try:
+                self._instruments = InstrumentTable(cache_dir + name)
+            except (ValueError, OSError) as e:
+                logging.warning(e)
+                continue
+            logging.info("已加载%s的全部共%d个合约..." %
+                    (self._instruments.date, len(self._instruments)))
+            return True
+        return False
 
-    def _getInstruments(self):
-        file_path = DATA_DIR + "instruments.dat"
+    def _getInstruments(self, priority):
+        from .instruments import InstrumentTable
+        cache_dir = DATA_DIR + "instruments/"
+        os.makedirs(cache_dir, exist_ok = True)
         now_date = time.strftime("%Y-%m-%d", time.localtime())
-        if os.path.exists(file_path):
-            fd = open(file_path)
-            cached_date = fd.readline()
-            if cached_date[: -1] == now_date:
-                self._instruments = json.load(fd)
-                fd.close()
+        #newest first, a day has more than one file when one was found broken
+        for name in sorted(os.listdir(cache_dir), reverse = True):
+            if not (name.startswith(now_date) and name.endswith(".dat")):
+                continue
+            try:
+                self._instruments = InstrumentTable(cache_dir + name)
+                self._templates = {}
                 logging.info("已加载全部共%d个合约..." % len(self._instruments))
                 return
-            fd.close()
-        self._instruments = {}
+            except ValueError as e:
+                logging.warning(e)
+        instruments = self._query(("instruments",), self._queryInstruments, priority,
+                "获取所有合约").wait(None)
+        #always a new file: one mapped here or by another process can neither be replaced
+        #nor deleted on Windows
+        file_path = cache_dir + "%s_%d.dat" % (now_date, time.time() * 1000)
+        InstrumentTable.save(file_path, now_date, instruments)
+        old_path = getattr(getattr(self, "_instruments", None), "path", None)
+        self._instruments = InstrumentTable(file_path)
+        #expired instruments must not keep their templates
+        self._templates = {}
+        #the table replaced may still be read by other threads, its file goes next time, as
+        #do the files other processes still map
+        for name in os.listdir(cache_dir):
+            if cache_dir + name not in (file_path, old_path):
+                try:
+                    os.remove(cache_dir + name)
+                except OSError:
+                    pass
+        logging.info("已保存全部共%d个合约..." % len(self._instruments))
+
+    def _queryInstruments(self):
+        self._new_instruments = {}
         field = CTPStruct.QryInstrumentField()
         self.resetCompletion()
-        self._limitFrequency()
         self.checkApiReturn(self.ReqQryInstrument(field, 3))
         last_count = 0
         while True:
@@ -228,16 +1019,14 @@ class TraderImpl(SpiHelper, CTP.TraderApiPy):
                 self.waitCompletion("获取所有合约")
                 break
             except TimeoutError as e:
-                count = len(self._instruments)
+                count = len(self._new_instruments)
                 if count == last_count:
                     raise e
                 logging.info("已获取%d个合约..." % count)
                 last_count = count
-        fd = open(file_path, "w")
-        fd.write(now_date + "\n")
-        json.dump(self._instruments, fd)
-        fd.close()
-        logging.info("已保存全部共%d个合约..." % len(self._instruments))
+        instruments = self._new_instruments
+        del self._new_instruments
+        return instruments
 
     def OnRspQryInstrument(self, field, info, req_id, is_last):
         assert(req_id == 3)
@@ -253,15 +1042,16 @@ class TraderImpl(SpiHelper, CTP.TraderApiPy):
                 option_type = None
             expire_date = None if field.ExpireDate == "" else       \
                     time.strftime("%Y-%m-%d", time.strptime(field.ExpireDate, "%Y%m%d"))
-            self._instruments[field.InstrumentID] = {"name": field.InstrumentName,
-                    "exchange": field.ExchangeID, "multiple": field.VolumeMultiple,
+            self._new_instruments[field.InstrumentID] = {"name": field.InstrumentName,
+                    "exchange": field.ExchangeID, "product": field.ProductID,
+                    "underlying": field.UnderlyingInstrID, "multiple": field.VolumeMultiple,
                     "price_tick": field.PriceTick, "expire_date": expire_date,
                     "long_margin_ratio": FILTER(field.LongMarginRatio),
                     "short_margin_ratio": FILTER(field.ShortMarginRatio),
                     "option_type": option_type, "strike_price": FILTER(field.StrikePrice),
                     "is_trading": bool(field.IsTrading)}
         if is_last:
-            logging.info("已获取全部共%d个合约..." % len(self._instruments))
+            logging.info("已获取全部共%d个合约..." % len(self._new_instruments))
             self.notifyCompletion()
 
     def getInstrument(self, code):
@@ -269,21 +1059,38 @@ class TraderImpl(SpiHelper, CTP.TraderApiPy):
             raise ValueError("合约<%s>不存在" % code)
         return self._instruments[code].copy()
 
-    def _getTransferRegisters(self):
+    def listInstruments(self, exchange = None, product = None, underlying = None,
+            expire_date = None, option_type = None, prefix = None):
+        return self._instruments.select(exchange, product, underlying, expire_date,
+                option_type, prefix)
+
+    def getOptionChain(self, underlying, expire_date):
+        return self._instruments.getOptionChain(underlying, expire_date)
+
+    def _getTransferRegisters(self, priority):
         self._bank_names = {}
+        self._query(("contract_banks",), self._queryContractBanks, priority,
+                "获取期货公司支持的银行").wait(None)
+        self._trans_regs = self._query(("transfer_registers",), self._queryTransferRegisters,
+                priority, "获取银期转账签约关系").wait(None)
+        del self._bank_names
+
+    def _queryContractBanks(self):
         field = CTPStruct.QryContractBankField(BrokerID = self._broker_id)
         self.resetCompletion()
-        self._limitFrequency()
         self.checkApiReturn(self.ReqQryContractBank(field, 4))
         self.waitCompletion("获取期货公司支持的银行")
-        self._trans_regs = []
+
+    def _queryTransferRegisters(self):
+        self._new_trans_regs = []
         field = CTPStruct.QryAccountregisterField(BrokerID = self._broker_id,
                 AccountID = self._user_id)
         self.resetCompletion()
-        self._limitFrequency()
         self.checkApiReturn(self.ReqQryAccountregister(field, 5))
         self.waitCompletion("获取银期转账签约关系")
-        del self._bank_names
+        trans_regs = self._new_trans_regs
+        del self._new_trans_regs
+        return trans_regs
 
     def OnRspQryContractBank(self, field, info, req_id, is_last):
         assert(req_id == 4)
@@ -304,7 +1111,7 @@ class TraderImpl(SpiHelper, CTP.TraderApiPy):
         if field and field.OpenOrDestroy == "1":    #THOST_FTDC_OOD_Open = 1
             assert(field.BrokerID == self._broker_id)
             assert(field.AccountID == self._user_id)
-            self._trans_regs.append({"bank_name": self._bank_names[field.BankID],
+            self._new_trans_regs.append({"bank_name": self._bank_names[field.BankID],
                     "bank_id": field.BankID, "bank_branch_id": field.BankBranchID,
                     "bank_account": field.BankAccount, "currency": field.CurrencyID,
                     "broker_branch_id": field.BrokerBranchID})
@@ -312,12 +1119,17 @@ class TraderImpl(SpiHelper, CTP.TraderApiPy):
             logging.info("已获取银期转账签约关系...")
             self.notifyCompletion()
 
-    def getAccount(self):
+    def queryAccount(self, priority = PRIORITY_NORMAL):
+        return self._query(("account",), self._queryAccount, priority, "获取资金账户")
+
+    def getAccount(self, priority = PRIORITY_NORMAL):
+        return self.queryAccount(priority).wait(None)
+
+    def _queryAccount(self):
         #THOST_FTDC_BZTP_Future = 1
         field = CTPStruct.QryTradingAccountField(BrokerID = self._broker_id,
                 InvestorID = self._user_id, CurrencyID = "CNY", BizType = '1')
         self.resetCompletion()
-        self._limitFrequency()
         self.checkApiReturn(self.ReqQryTradingAccount(field, 6))
         self.waitCompletion("获取资金账户")
         return self._account
@@ -332,19 +1144,36 @@ class TraderImpl(SpiHelper, CTP.TraderApiPy):
         logging.info("已获取资金账户...")
         self.notifyCompletion()
 
-    def getOrders(self):
+    def queryOrders(self, priority = PRIORITY_NORMAL):
+        return self._query(("orders",), self._queryOrders, priority, "获取所有报单")
+
+    def _waitBook(self):
+        #wait for the book to be seeded, but fail while seeding keeps failing
+        while not self._book_ready.wait(1):
+            if self._book_error:
+                raise RuntimeError("本地报单和持仓尚未初始化：%s" % self._book_error)
+
+    def getOrders(self, code = None, direction = None):
+        self._waitBook()
+        return self._book.getOrders(code, direction)
+
+    def getOrder(self, order_id):
+        self._waitBook()
+        order = self._book.getOrder(order_id)
+        if not order:
+            raise ValueError("订单<%s>不存在" % order_id)
+        return order
+
+    def _queryOrders(self):
         self._orders = {}
         field = CTPStruct.QryOrderField(BrokerID = self._broker_id,
                 InvestorID = self._user_id)
         self.resetCompletion()
-        self._limitFrequency()
         self.checkApiReturn(self.ReqQryOrder(field, 7))
         self.waitCompletion("获取所有报单")
         return self._orders
 
-    def _gotOrder(self, order):
-        if len(order.OrderSysID) == 0:
-            return
+    def _parseOrder(self, order):
         oid = "%s@%s" % (order.OrderSysID, order.InstrumentID)
         (direction, volume) = (int(order.Direction), order.VolumeTotalOriginal)
         assert(direction in (0, 1))
@@ -354,10 +1183,16 @@ class TraderImpl(SpiHelper, CTP.TraderApiPy):
         direction = "short" if direction else "long"
         #THOST_FTDC_OST_AllTraded = 0, THOST_FTDC_OST_Canceled = 5
         is_active = order.OrderStatus not in ('0', '5')
-        assert(oid not in self._orders)
-        self._orders[oid] = {"code": order.InstrumentID, "direction": direction,
+        return (oid, {"code": order.InstrumentID, "direction": direction,
                 "price": order.LimitPrice, "volume": volume,
-                "volume_traded": order.VolumeTraded, "is_active": is_active}
+                "volume_traded": order.VolumeTraded, "is_active": is_active})
+
+    def _gotOrder(self, order):
+        if len(order.OrderSysID) == 0:
+            return
+        (oid, order) = self._parseOrder(order)
+        assert(oid not in self._orders)
+        self._orders[oid] = order
 
     def OnRspQryOrder(self, field, info, req_id, is_last):
         assert(req_id == 7)
@@ -370,12 +1205,19 @@ class TraderImpl(SpiHelper, CTP.TraderApiPy):
             logging.info("已获取所有报单...")
             self.notifyCompletion()
 
-    def getPositions(self):
+    def queryPositions(self, priority = PRIORITY_NORMAL):
+        return self._query(("positions",), self._queryPositions, priority, "获取所有持仓")
+
+    def getPositions(self, code = None, direction = None):
+        self._waitBook()
+        return self._book.getPositions(code, direction)
+
+    def _queryPositions(self, snapshot = None):
         self._positions = []
+        self._positions_snapshot = snapshot
         field = CTPStruct.QryInvestorPositionField(BrokerID = self._broker_id,
                 InvestorID = self._user_id)
         self.resetCompletion()
-        self._limitFrequency()
         self.checkApiReturn(self.ReqQryInvestorPosition(field, 8))
         self.waitCompletion("获取所有持仓")
         return self._positions
@@ -403,31 +1245,143 @@ class TraderImpl(SpiHelper, CTP.TraderApiPy):
         if field:
             self._gotPosition(field)
         if is_last:
+            if self._positions_snapshot:
+                #trades returned from now on are not in these positions
+                with self._snapshot_lock:
+                    self._positions_snapshot[1] = []
             logging.info("已获取所有持仓...")
             self.notifyCompletion()
 
     def OnRtnOrder(self, order):
-        if self._order_action:
-            if self._order_action(order):
-                self._order_action = None
-
-    def _handleNewOrder(self, order):
-        order_ref = None if len(order.OrderRef) == 0 else int(order.OrderRef)
-        if (order.FrontID, order.SessionID, order_ref) !=               \
-                (self._front_id, self._session_id, self._order_ref):
-            return False
+        if len(order.OrderSysID) != 0:
+            (oid, parsed) = self._parseOrder(order)
+            snapshot = self._snapshot
+            if snapshot:
+                with self._snapshot_lock:
+                    snapshot[0].add(oid)
+                    self._book.updateOrder(oid, parsed)
+            else:
+                self._book.updateOrder(oid, parsed)
+        if self._sent_times:
+            self._stampReturn(order)
+        if self._pending_orders or self._close_holds:
+            order_ref = None if len(order.OrderRef) == 0 else int(order.OrderRef)
+            key = (order.FrontID, order.SessionID, order_ref)
+        #the book counts the close volume from now on, or the order was rejected
+        #THOST_FTDC_OST_Canceled = 5
+        if self._close_holds and (len(order.OrderSysID) != 0 or order.OrderStatus == '5'):
+            self._releaseHold(key)
+        if self._pending_orders:
+            future = self._pending_orders.get(key)
+            if future and self._handleNewOrder(future, order):
+                with self._order_lock:
+                    self._pending_orders.pop(key, None)
+        if self._pending_deletes and len(order.OrderSysID) != 0:
+            oid = "%s@%s" % (order.OrderSysID, order.InstrumentID)
+            future = self._pending_deletes.get(oid)
+            if future and self._handleDeleteOrder(future, oid, order):
+                with self._order_lock:
+                    self._pending_deletes.pop(oid, None)
+
+    def OnRtnTrade(self, trade):
+        logging.debug(trade)
+        parsed = self._parseTrade(trade)
+        self._getTradeStore().add([parsed])
+        code = trade.InstrumentID
+        instrument = self._instruments.get(code)
+        if not instrument:
+            logging.warning("成交回报中的合约<%s>不存在" % code)
+            return
+        direction = parsed["direction"]
+        item = ((trade.ExchangeID, trade.TradeID), code, direction, parsed["volume"],
+                trade.Price, instrument["multiple"], instrument[direction + "_margin_ratio"])
+        snapshot = self._snapshot
+        if snapshot:
+            with self._snapshot_lock:
+                #kept for the book being queried, the trades before are in its positions
+                if snapshot[1] is not None:
+                    snapshot[1].append(item)
+                if self._book_ready.is_set():
+                    self._book.applyTrade(*item)
+        elif self._book_ready.is_set():
+            #otherwise replayed before the book is seeded, the positions queried for it
+            #already include the trade
+            self._book.applyTrade(*item)
+
+    def _parseTrade(self, trade):
+        #THOST_FTDC_D_Buy = 0, THOST_FTDC_D_Sell = 1
+        direction = 1 if trade.Direction == '1' else 0
+        volume = trade.Volume
+        if trade.OffsetFlag != '0':         #THOST_FTDC_OF_Open
+            direction = 1 - direction
+            volume = -volume
+        return {"trade_id": trade.TradeID.strip(), "exchange": trade.ExchangeID,
+                "order_id": "%s@%s" % (trade.OrderSysID, trade.InstrumentID),
+                "code": trade.InstrumentID, "direction": "short" if direction else "long",
+                "price": trade.Price, "volume": volume, "date": trade.TradeDate,
+                "time": trade.TradeTime, "trading_day": trade.TradingDay}
+
+    def _getTradeStore(self, trading_day = None):
+        from .trades import TradeStore
+        directory = DATA_DIR + "trades/%s_%s/" % (self._broker_id, self._user_id)
+        if trading_day and trading_day != self._trading_day:
+            return TradeStore(directory + trading_day + ".jsonl", trading_day, True)
+        with self._trade_store_lock:
+            store = self._trade_store
+            if not store or store.trading_day != self._trading_day:
+                if store:
+                    store.close()
+                store = self._trade_store = TradeStore(
+                        directory + self._trading_day + ".jsonl", self._trading_day)
+            return store
+
+    def queryTrades(self, priority = PRIORITY_NORMAL):
+        return self._query(("trades",), self._queryTrades, priority, "获取成交")
+
+    def getTrades(self, code = None, trading_day = None, priority = PRIORITY_NORMAL):
+        if trading_day is None or trading_day == self._trading_day:
+            self.queryTrades(priority).wait(None)
+        return self._getTradeStore(trading_day).getTrades(code)
+
+    def getOrderTrades(self, order_id, priority = PRIORITY_NORMAL):
+        self.queryTrades(priority).wait(None)
+        return self._getTradeStore().getOrderTrades(order_id)
+
+    def _queryTrades(self):
+        store = self._getTradeStore()
+        #only the trades since the last one already stored, which is fetched again
+        start_time = store.lastTime()
+        self._trades = []
+        field = CTPStruct.QryTradeField(BrokerID = self._broker_id,
+                InvestorID = self._user_id, TradeTimeStart = start_time or "")
+        self.resetCompletion()
+        self.checkApiReturn(self.ReqQryTrade(field, 14))
+        self.waitCompletion("获取成交")
+        return store.add(self._trades)
+
+    def OnRspQryTrade(self, field, info, req_id, is_last):
+        assert(req_id == 14)
+        if not self.checkRspInfoInCallback(info):
+            assert(is_last)
+            return
+        if field:
+            self._trades.append(self._parseTrade(field))
+        if is_last:
+            logging.info("已获取%d笔成交..." % len(self._trades))
+            self.notifyCompletion()
+
+    def _handleNewOrder(self, future, order):
         logging.debug(order)
         if order.OrderStatus == 'a':                #THOST_FTDC_OST_Unknown
             return False
         if order.OrderSubmitStatus == '4':          #THOST_FTDC_OSS_InsertRejected
-            self.notifyCompletion(order.StatusMsg)
+            future.setError(order.StatusMsg)
             return True
         if order.TimeCondition == '1':              #THOST_FTDC_TC_IOC
             #THOST_FTDC_OST_AllTraded = 0, THOST_FTDC_OST_Canceled = 5
             if order.OrderStatus in ('0', '5'):
                 logging.info("已执行IOC单，成交量：%d" % order.VolumeTraded)
-                self._traded_volume = order.VolumeTraded
-                self.notifyCompletion()
+                future.setResult(order.VolumeTraded)
                 return True
         else:
             assert(order.TimeCondition == '3')      #THOST_FTDC_TC_GFD
@@ -437,33 +1391,29 @@ class TraderImpl(SpiHelper, CTP.TraderApiPy):
                 #THOST_FTDC_OST_NoTradeNotQueueing = 4, THOST_FTDC_OST_Canceled = 5
                 assert(order.OrderStatus in ('0', '1', '2', '3', '4', '5'))
                 assert(len(order.OrderSysID) != 0)
-                self._order_id = "%s@%s" % (order.OrderSysID, order.InstrumentID)
-                logging.info("已提交限价单（单号：<%s>）" % self._order_id)
-                self.notifyCompletion()
+                order_id = "%s@%s" % (order.OrderSysID, order.InstrumentID)
+                logging.info("已提交限价单（单号：<%s>）" % order_id)
+                future.setResult(order_id)
                 return True
         return False
 
-    def _order(self, code, direction, volume, price, min_volume):
+    def _makeTemplate(self, code, direction, opening, order_type):
         if code not in self._instruments:
             raise ValueError("合约<%s>不存在！" % code)
         exchange = self._instruments[code]["exchange"]
         if direction == "long":
-            direction = 0               #THOST_FTDC_D_Buy
+            side = 0                    #THOST_FTDC_D_Buy
         elif direction == "short":
-            direction = 1               #THOST_FTDC_D_Sell
+            side = 1                    #THOST_FTDC_D_Sell
         else:
             raise ValueError("错误的买卖方向<%s>" % direction)
-        if volume != int(volume) or volume == 0:
-            raise ValueError("交易数量<%s>必须是非零整数" % volume)
-        if volume > 0:
+        if opening:
             offset_flag = '0'           #THOST_FTDC_OF_Open
         else:
             offset_flag = '1'           #THOST_FTDC_OF_Close
-            volume = -volume
-            direction = 1 - direction
-        direction = str(direction)
+            side = 1 - side
         #Market Price Order
-        if price == 0:
+        if order_type == 0:
             if exchange == "CFFEX":
                 price_type = 'G'        #THOST_FTDC_OPT_FiveLevelPrice
             else:
@@ -471,103 +1421,322 @@ class TraderImpl(SpiHelper, CTP.TraderApiPy):
             #THOST_FTDC_TC_IOC, THOST_FTDC_VC_AV
             (time_cond, volume_cond) = ('1', '1')
         #Limit Price Order
-        elif min_volume == 0:
+        elif order_type == 1:
             #THOST_FTDC_OPT_LimitPrice, THOST_FTDC_TC_GFD, THOST_FTDC_VC_AV
             (price_type, time_cond, volume_cond) = ('2', '3', '1')
         #FAK Order
         else:
-            min_volume = abs(min_volume)
-            if min_volume > volume:
-                raise ValueError("最小成交量<%s>不能超过交易数量<%s>" % (min_volume, volume))
             #THOST_FTDC_OPT_LimitPrice, THOST_FTDC_TC_IOC, THOST_FTDC_VC_MV
             (price_type, time_cond, volume_cond) = ('2', '1', '2')
-        self._order_ref += 1
-        self._order_action = self._handleNewOrder
-        field = CTPStruct.InputOrderField(BrokerID = self._broker_id,
+        template = dict(BrokerID = self._broker_id,
                 InvestorID = self._user_id, ExchangeID = exchange, InstrumentID = code,
-                Direction = direction, CombOffsetFlag = offset_flag,
+                Direction = str(side), CombOffsetFlag = offset_flag,
                 TimeCondition = time_cond, VolumeCondition = volume_cond,
-                OrderPriceType = price_type, LimitPrice = price,
-                VolumeTotalOriginal = volume, MinVolume = min_volume,
+                OrderPriceType = price_type,
                 CombHedgeFlag = '1',            #THOST_FTDC_HF_Speculation
                 ContingentCondition = '1',      #THOST_FTDC_CC_Immediately
-                ForceCloseReason = '0',         #THOST_FTDC_FCC_NotForceClose
-                OrderRef = "%12d" % self._order_ref)
-        self.resetCompletion()
-        self.checkApiReturn(self.ReqOrderInsert(field, 9))
-        self.waitCompletion("录入报单")
+                ForceCloseReason = '0')         #THOST_FTDC_FCC_NotForceClose
+        self._templates[(code, direction, opening, order_type)] = template
+        return template
+
+    def prepareInstruments(self, codes):
+        #build the order templates ahead of the first order of each code
+        for code in codes:
+            for direction in ("long", "short"):
+                for opening in (True, False):
+                    for order_type in range(3):
+                        self._makeTemplate(code, direction, opening, order_type)
+        if self._risk:
+            self._risk.prepare(codes)
+
+    def _prepareOrder(self, code, direction, volume, price, min_volume):
+        #0 market, 1 limit, 2 FAK
+        order_type = 0 if price == 0 else 2 if min_volume else 1
+        template = self._templates.get((code, direction, volume > 0, order_type))
+        if template is None:
+            template = self._makeTemplate(code, direction, volume > 0, order_type)
+        if volume != int(volume) or volume == 0:
+            raise ValueError("交易数量<%s>必须是非零整数" % volume)
+        if order_type == 2 and abs(min_volume) > abs(volume):
+            raise ValueError("最小成交量<%s>不能超过交易数量<%s>" %
+                    (abs(min_volume), abs(volume)))
+        #last, it takes rate tokens which are refunded if the order is not sent after all
+        hold = self._risk.check(code, direction, volume, price) if self._risk else None
+        return (template, price, abs(volume), abs(min_volume), hold)
+
+    def setLatencyStats(self, latency):
+        self._latency = latency
+        self._sent_times = {}
+
+    def setRiskGate(self, risk):
+        self._risk = risk
+
+    def _stampRequest(self, stage, exchange, key, future, start):
+        latency = self._latency
+        sending = time.perf_counter()
+        latency.record(stage + ".throttle", exchange, sending - start)
+        latency.track(future, stage + ".accept", exchange, sending)
+        self._sent_times[key] = (stage, exchange, sending)
+        return sending
+
+    def _stampReturn(self, order, error_key = None):
+        latency = self._latency
+        if not latency:
+            return
+        now = time.perf_counter()
+        if error_key:
+            keys = (error_key,)
+        else:
+            order_ref = None if len(order.OrderRef) == 0 else int(order.OrderRef)
+            keys = ((order.FrontID, order.SessionID, order_ref),
+                    "%s@%s" % (order.OrderSysID, order.InstrumentID))
+        for key in keys:
+            item = self._sent_times.pop(key, None)
+            if item:
+                (stage, exchange, sent) = item
+                latency.record(stage + ".first_return", exchange, now - sent)
+
+    def _expireOrder(self, future):
+        #given up after a timeout, nothing completes it any more; the late returns of the
+        #request still reach the book
+        with self._order_lock:
+            for pending in (self._pending_orders, self._pending_deletes):
+                for (key, item) in list(pending.items()):
+                    if item is future:
+                        del pending[key]
+                        self._sent_times.pop(key, None)
+        future.setError(TimeoutError("%s超时" % future._operation_name))
+
+    def _waitOrder(self, future, stage):
+        try:
+            result = future.wait()
+        except TimeoutError:
+            self._expireOrder(future)
+            raise
+        if self._latency:
+            self._latency.recordWake(future, stage + ".wake")
+        return result
+
+    def _sendOrder(self, template, price, volume, min_volume, hold = None):
+        latency = self._latency
+        if latency:
+            start = time.perf_counter()
+        self._order_bucket.acquire()
+        future = RequestFuture("录入报单")
+        with self._order_lock:
+            self._order_ref += 1
+            order_ref = self._order_ref
+            key = (self._front_id, self._session_id, order_ref)
+            self._pending_orders[key] = future
+            if hold:
+                self._close_holds[key] = (self._risk, hold)
+        field = CTPStruct.InputOrderField(OrderRef = "%12d" % order_ref, LimitPrice = price,
+                VolumeTotalOriginal = volume, MinVolume = min_volume, **template)
+        if latency:
+            sending = self._stampRequest("order", field.ExchangeID, key, future, start)
+        try:
+            self.checkApiReturn(self.ReqOrderInsert(field, 9))
+        except RuntimeError:
+            with self._order_lock:
+                self._pending_orders.pop(key, None)
+                self._close_holds.pop(key, None)
+            if self._risk:
+                self._risk.refund(template["InstrumentID"], hold)
+            raise
+        if latency:
+            latency.record("order.send", field.ExchangeID, time.perf_counter() - sending)
+        return future
+
+    def _submitOrder(self, code, direction, volume, price, min_volume):
+        return self._sendOrder(*self._prepareOrder(code, direction, volume, price, min_volume))
+
+    def _sendBatch(self, send, items):
+        futures = []
+        for item in items:
+            try:
+                futures.append(send(*item))
+            except RuntimeError as e:
+                future = RequestFuture()
+                future.setError(e)
+                futures.append(future)
+        return futures
+
+    def _waitBatch(self, futures):
+        results = []
+        for future in futures:
+            try:
+                results.append(future.wait())
+            except TimeoutError as e:
+                self._expireOrder(future)
+                results.append(e)
+            except RuntimeError as e:
+                results.append(e)
+        return results
+
+    def submitLimitBatch(self, orders):
+        prepared = []
+        try:
+            for (i, (code, direction, volume, price)) in enumerate(orders):
+                if not price > 0:
+                    raise ValueError("第%d笔订单的价格<%s>必须大于0" % (i + 1, price))
+                try:
+                    prepared.append(self._prepareOrder(code, direction, volume, price, 0))
+                except ValueError as e:
+                    raise ValueError("第%d笔订单：%s" % (i + 1, e)) from None
+        except ValueError:
+            #none of the orders is sent
+            if self._risk:
+                for (template, _, _, _, hold) in prepared:
+                    self._risk.refund(template["InstrumentID"], hold)
+            raise
+        return self._sendBatch(self._sendOrder, prepared)
+
+    def orderLimitBatch(self, orders):
+        return self._waitBatch(self.submitLimitBatch(orders))
 
     def OnRspOrderInsert(self, field, info, req_id, is_last):
         assert(req_id == 9)
         assert(is_last)
         self.OnErrRtnOrderInsert(field, info)
 
-    def OnErrRtnOrderInsert(self, _, info):
-        success = self.checkRspInfoInCallback(info)
-        assert(not success)
+    def OnErrRtnOrderInsert(self, field, info):
+        assert(info and info.ErrorID != 0)
+        key = (self._front_id, self._session_id, int(field.OrderRef))
+        if self._sent_times:
+            self._stampReturn(None, key)
+        if self._close_holds:
+            self._releaseHold(key)
+        with self._order_lock:
+            future = self._pending_orders.pop(key, None)
+        if future:
+            future.setError(info.ErrorMsg)
+
+    def _releaseHold(self, key):
+        with self._order_lock:
+            item = self._close_holds.pop(key, None)
+        if item:
+            (risk, hold) = item
+            risk.release(hold)
+
+    def submitMarket(self, code, direction, volume):
+        return self._submitOrder(code, direction, volume, 0, 0)
+
+    def submitFAK(self, code, direction, volume, price, min_volume):
+        assert(price > 0)
+        return self._submitOrder(code, direction, volume, price,
+                1 if min_volume == 0 else min_volume)
+
+    def submitFOK(self, code, direction, volume, price):
+        return self.submitFAK(code, direction, volume, price, volume)
+
+    def submitLimit(self, code, direction, volume, price):
+        assert(price > 0)
+        return self._submitOrder(code, direction, volume, price, 0)
 
     def orderMarket(self, code, direction, volume):
-        self._order(code, direction, volume, 0, 0)
-        return self._traded_volume
+        return self._waitOrder(self.submitMarket(code, direction, volume), "order")
 
     def orderFAK(self, code, direction, volume, price, min_volume):
-        assert(price > 0)
-        self._order(code, direction, volume, price, 1 if min_volume == 0 else min_volume)
-        return self._traded_volume
+        return self._waitOrder(self.submitFAK(code, direction, volume, price, min_volume), "order")
 
     def orderFOK(self, code, direction, volume, price):
-        return self.orderFAK(code, direction, volume, price, volume)
+        return self._waitOrder(self.submitFOK(code, direction, volume, price), "order")
 
     def orderLimit(self, code, direction, volume, price):
-        assert(price > 0)
-        self._order(code, direction, volume, price, 0)
-        return self._order_id
+        return self._waitOrder(self.submitLimit(code, direction, volume, price), "order")
 
-    def _handleDeleteOrder(self, order):
-        oid = "%s@%s" % (order.OrderSysID, order.InstrumentID)
-        if oid != self._order_id:
-            return False
+    def _handleDeleteOrder(self, future, oid, order):
         logging.debug(order)
         if order.OrderSubmitStatus == '5':      #THOST_FTDC_OSS_CancelRejected
-            self.notifyCompletion(order.StatusMsg)
+            future.setError(order.StatusMsg)
             return True
         #THOST_FTDC_OST_AllTraded = 0, THOST_FTDC_OST_Canceled = 5
         if order.OrderStatus in ('0', '5'):
-            logging.info("已撤销限价单，单号：<%s>" % self._order_id)
-            self.notifyCompletion()
+            logging.info("已撤销限价单，单号：<%s>" % oid)
+            future.setResult()
             return True
         return False
 
-    def deleteOrder(self, order_id):
+    def _prepareDelete(self, order_id):
         items = order_id.split("@")
         if len(items) != 2:
             raise ValueError("订单号<%s>格式错误" % order_id)
         (sys_id, code) = items
         if code not in self._instruments:
             raise ValueError("订单号<%s>中的合约号<%s>不存在" % (order_id, code))
-        field = CTPStruct.InputOrderActionField(BrokerID = self._broker_id,
+        return CTPStruct.InputOrderActionField(BrokerID = self._broker_id,
                 InvestorID = self._user_id, UserID = self._user_id,
                 ActionFlag = '0',               #THOST_FTDC_AF_Delete
                 ExchangeID = self._instruments[code]["exchange"],
                 InstrumentID = code, OrderSysID = sys_id)
-        self.resetCompletion()
-        self._order_id = order_id
-        self._order_action = self._handleDeleteOrder
-        self.checkApiReturn(self.ReqOrderAction(field, 10))
-        self.waitCompletion("撤销报单")
+
+    def submitDelete(self, order_id):
+        return self._sendDelete(order_id, self._prepareDelete(order_id))
+
+    def _sendDelete(self, order_id, field):
+        latency = self._latency
+        if latency:
+            start = time.perf_counter()
+        with self._order_lock:
+            future = self._pending_deletes.get(order_id)
+            if future:
+                return future
+            future = RequestFuture("撤销报单")
+            self._pending_deletes[order_id] = future
+        self._order_bucket.acquire()
+        if latency:
+            sending = self._stampRequest("cancel", field.ExchangeID, order_id, future, start)
+        try:
+            self.checkApiReturn(self.ReqOrderAction(field, 10))
+        except RuntimeError:
+            with self._order_lock:
+                self._pending_deletes.pop(order_id, None)
+            raise
+        if latency:
+            latency.record("cancel.send", field.ExchangeID, time.perf_counter() - sending)
+        return future
+
+    def deleteOrder(self, order_id):
+        self._waitOrder(self.submitDelete(order_id), "cancel")
+
+    def submitDeletes(self, order_ids):
+        prepared = [(order_id, self._prepareDelete(order_id)) for order_id in order_ids]
+        return self._sendBatch(self._sendDelete, prepared)
+
+    def deleteOrders(self, order_ids):
+        return self._waitBatch(self.submitDeletes(order_ids))
+
+    def cancelAll(self, code = None, direction = None):
+        order_ids = [oid for (oid, order) in self.getOrders(code, direction).items()
+                if order["is_active"]]
+        return dict(zip(order_ids, self.deleteOrders(order_ids)))
 
     def OnRspOrderAction(self, field, info, req_id, is_last):
         assert(req_id == 10)
         assert(is_last)
         self.OnErrRtnOrderAction(field, info)
 
-    def OnErrRtnOrderAction(self, _, info):
-        success = self.checkRspInfoInCallback(info)
-        assert(not success)
+    def OnErrRtnOrderAction(self, field, info):
+        assert(info and info.ErrorID != 0)
+        oid = "%s@%s" % (field.OrderSysID, field.InstrumentID)
+        if self._sent_times:
+            self._stampReturn(None, oid)
+        with self._order_lock:
+            future = self._pending_deletes.pop(oid, None)
+        if future:
+            future.setError(info.ErrorMsg)
 
     def transfer(self, money, password, bank_name = None, bank_account = None):
         if money == 0:
             return
+        self._refreshed.wait()
+        priority = PRIORITY_HIGH
+        if self._trans_regs is None:
+            #the refresh in the background failed, try once more now
+            try:
+                self._getTransferRegisters(priority)
+            except Exception as e:
+                raise RuntimeError("获取银期签约关系失败，无法转账：%s" % e) from None
         found = False
         if bank_account:
             for reg in self._trans_regs:
@@ -598,13 +1767,19 @@ class TraderImpl(SpiHelper, CTP.TraderApiPy):
                 BankAccType = "\0", BankSecuAccType = "\0", FeePayFlag = "\0",
                 SecuPwdFlag = "\0", BankPwdFlag = "\0",
                 TransferStatus = "\0", LastFragment = "\0")
-        self.resetCompletion()
         if money > 0:
-            self.checkApiReturn(self.ReqFromBankToFutureByFuture(field, 11))
-            self.waitCompletion("银期转账（银行->期货）")
+            self._query(None, lambda: self._transfer(self.ReqFromBankToFutureByFuture,
+                    field, 11, "银期转账（银行->期货）"), priority,
+                    "银期转账（银行->期货）").wait(None)
         else:
-            self.checkApiReturn(self.ReqFromFutureToBankByFuture(field, 12))
-            self.waitCompletion("银期转账（期货->银行）")
+            self._query(None, lambda: self._transfer(self.ReqFromFutureToBankByFuture,
+                    field, 12, "银期转账（期货->银行）"), priority,
+                    "银期转账（期货->银行）").wait(None)
+
+    def _transfer(self, request, field, req_id, operation_name):
+        self.resetCompletion()
+        self.checkApiReturn(request(field, req_id))
+        self.waitCompletion(operation_name)
 
     def OnRspFromBankToFutureByFuture(self, _, info, req_id, is_last):
         assert(req_id == 11)
@@ -632,17 +1807,72 @@ class TraderImpl(SpiHelper, CTP.TraderApiPy):
         else:
             self.notifyCompletion(field.ErrorMsg)
 
-    def getSettlement(self, date, encoding):
+    def getSettlement(self, date, encoding, priority = PRIORITY_NORMAL):
+        return self.querySettlement(date, encoding, priority).wait(None)
+
+    def querySettlement(self, date, encoding, priority = PRIORITY_NORMAL):
+        try:
+            with open(self._settlementPath(date), "rb") as fd:
+                content = fd.read()
+        except OSError:
+            return self._query(("settlement", date, encoding),
+                    lambda: self._querySettlement(date, encoding), priority, "获取结算单")
+        future = RequestFuture("获取结算单")
+        future.setResult(content.decode(encoding))
+        return future
+
+    def iterSettlements(self, dates, encoding, priority = PRIORITY_LOW):
+        #all queries are queued at once and paced by the scheduler, results are yielded
+        #in the order they arrive
+        (cond, done) = (threading.Condition(), collections.deque())
+        def onDone(date, future):
+            with cond:
+                done.append((date, future))
+                cond.notify()
+        for date in dates:
+            self.querySettlement(date, encoding, priority).addCallback(
+                    lambda future, date = date: onDone(date, future))
+        for _ in range(len(dates)):
+            with cond:
+                while not done:
+                    cond.wait()
+                (date, future) = done.popleft()
+            #any failure, like a statement that could not be cached, is yielded rather
+            #than ending the stream
+            try:
+                result = future.wait(0)
+            except Exception as e:
+                result = e
+            yield (date, result)
+
+    def _settlementPath(self, date):
+        return DATA_DIR + "settlements/%s_%s/%s.dat" % (self._broker_id, self._user_id, date)
+
+    def _querySettlement(self, date, encoding):
         self._date = date
         self._encoding = encoding
-        self._settlement = bytes()
+        self._settlement = []
         field = CTPStruct.QrySettlementInfoField(BrokerID = self._broker_id,
                 InvestorID = self._user_id, TradingDay = date)
         self.resetCompletion()
-        self._limitFrequency()
         self.checkApiReturn(self.ReqQrySettlementInfo(field, 13))
         self.waitCompletion("获取结算单")
-        return self._settlement.decode(encoding)
+        content = b"".join(self._settlement)
+        #statements of past days and months never change
+        if content and date < self._trading_day[: len(date)]:
+            path = self._settlementPath(date)
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok = True)
+                with open(path + ".tmp", "wb") as fd:
+                    fd.write(content)
+                os.replace(path + ".tmp", path)
+            except OSError as e:
+                logging.warning("缓存结算单<%s>失败：%s" % (date, e))
+                try:
+                    os.remove(path + ".tmp")
+                except OSError:
+                    pass
+        return content.decode(encoding)
 
     def OnRspQrySettlementInfo(self, field, info, req_id, is_last):
         assert(req_id == 13)
@@ -653,7 +1883,7 @@ class TraderImpl(SpiHelper, CTP.TraderApiPy):
             if isinstance(content, str):
                 content = content.encode(self._encoding)
             assert(isinstance(content, bytes))
-            self._settlement += content
+            self._settlement.append(content)
         if is_last:
             logging.info("已获取%s的结算单..." % self._date)
             self.notifyCompletion()
@@ -661,33 +1891,176 @@ class TraderImpl(SpiHelper, CTP.TraderApiPy):
 
 class Client:
 
-    def __init__(self, md_front, td_front, broker_id, app_id, auth_code, user_id, password):
-        self._md = QuoteImpl(md_front)
-        self._td = TraderImpl(td_front, broker_id, app_id, auth_code, user_id, password)
+    quote_impl = QuoteImpl
+    trader_impl = TraderImpl
 
-    def setReceiver(self, func):
-        return self._md.setReceiver(func)
+    def __init__(self, md_front, td_front, broker_id, app_id, auth_code, user_id, password,
+            fast_start = False, query_rate = 1, query_burst = 1, reconcile_interval = 60,
+            order_rate = 6, order_burst = 6, md_dual = False, probe_interval = 10,
+            latency_threshold = 0.005):
+        if isinstance(md_front, str):
+            self._md = self.quote_impl(md_front)
+        else:
+            from .pool import QuotePool
+            self._md = QuotePool(md_front, self.quote_impl, md_dual, probe_interval,
+                    latency_threshold)
+        kwargs = {"broker_id": broker_id, "app_id": app_id, "auth_code": auth_code,
+                "user_id": user_id, "password": password, "fast_start": fast_start,
+                "query_rate": query_rate, "query_burst": query_burst,
+                "reconcile_interval": reconcile_interval, "order_rate": order_rate,
+                "order_burst": order_burst}
+        if isinstance(td_front, str):
+            self._td = self.trader_impl(td_front, **kwargs)
+        else:
+            from .pool import TraderPool
+            self._td = TraderPool(td_front, self.trader_impl, kwargs, probe_interval,
+                    latency_threshold)
+        from .subscriptions import SubscriptionManager
+        self._subscriptions = SubscriptionManager(self._md, lambda: self._td._instruments)
 
-    def subscribe(self, codes):
-        for code in codes:
-            if code not in self._td._instruments:
-                raise ValueError("合约<%s>不存在" % code)
-        self._md.subscribe(codes)
+    def setReceiver(self, func, tick_type = "dict"):
+        return self._md.setReceiver(func, tick_type)
 
-    def unsubscribe(self, codes):
-        self._md.unsubscribe(codes)
+    def subscribe(self, codes = None, exchange = None, product = None, underlying = None,
+            expire_date = None, option_type = None, prefix = None):
+        return self._subscriptions.subscribe(self._subscriptions.resolve(codes, exchange,
+                product, underlying, expire_date, option_type, prefix))
 
-    def getInstrument(self, code):
-        return self._td.getInstrument(code)
+    def unsubscribe(self, codes = None, exchange = None, product = None, underlying = None,
+            expire_date = None, option_type = None, prefix = None):
+        self._subscriptions.unsubscribe(self._subscriptions.resolve(codes, exchange, product,
+                underlying, expire_date, option_type, prefix))
+
+    def flushUnsubscribes(self):
+        self._subscriptions.flush()
+
+    def getSubscriptions(self):
+        return self._subscriptions.codes()
+
+    def addTickSink(self, sink):
+        self._md.addTickSink(sink)
+
+    def removeTickSink(self, sink):
+        self._md.removeTickSink(sink)
 
-    def getAccount(self):
-        return self._td.getAccount()
+    def enableTickStore(self, capacity = 1024, max_codes = 4096):
+        self._md.enableTickStore(capacity, max_codes)
 
-    def getOrders(self):
-        return self._td.getOrders()
+    def getLatest(self, code):
+        return self._md.getTickStore().getLatest(code)
 
-    def getPositions(self):
-        return self._td.getPositions()
+    def getHistory(self, code, n):
+        return self._md.getTickStore().getHistory(code, n)
+
+    def snapshot(self):
+        return self._md.getTickStore().snapshot()
+
+    def getInstrument(self, code):
+        return self._td.getInstrument(code)
+
+    def listInstruments(self, exchange = None, product = None, underlying = None,
+            expire_date = None, option_type = None, prefix = None):
+        return self._td.listInstruments(exchange, product, underlying, expire_date, option_type,
+                prefix)
+
+    def getOptionChain(self, underlying, expire_date):
+        return self._td.getOptionChain(underlying, expire_date)
+
+    def getAccount(self, priority = PRIORITY_NORMAL):
+        return self._td.getAccount(priority)
+
+    def enablePnlEngine(self):
+        from .pnl import PnlEngine
+        if getattr(self, "_pnl", None):
+            self._md.removeTickSink(self._pnl)
+        self._pnl = PnlEngine(self._td)
+        self._md.addTickSink(self._pnl)
+
+    def getPnl(self):
+        if not getattr(self, "_pnl", None):
+            raise RuntimeError("未启用盈亏估算")
+        return self._pnl.getPnl()
+
+    def enableBars(self, intervals = (60,), capacity = 1024, max_codes = 4096, grace = 1.0):
+        from .bars import BarEngine
+        if getattr(self, "_bars", None):
+            self._md.removeTickSink(self._bars)
+            self._bars.close()
+        self._bars = BarEngine(intervals, capacity, max_codes, grace)
+        self._md.addTickSink(self._bars)
+
+    def _getBarEngine(self):
+        if not getattr(self, "_bars", None):
+            raise RuntimeError("未启用K线")
+        return self._bars
+
+    def addBarCallback(self, func):
+        self._getBarEngine().addCallback(func)
+
+    def removeBarCallback(self, func):
+        self._getBarEngine().removeCallback(func)
+
+    def getBars(self, code, n, interval = 60):
+        return self._getBarEngine().getBars(code, n, interval)
+
+    def getCurrentBar(self, code, interval = 60):
+        return self._getBarEngine().getCurrentBar(code, interval)
+
+    def enableRiskGate(self, max_volume = None, max_notional = None, max_rate = None):
+        from .risk import RiskGate
+        if getattr(self, "_risk", None):
+            self._md.removeTickSink(self._risk)
+        self._risk = RiskGate(self._td, max_volume, max_notional, max_rate)
+        self._md.addTickSink(self._risk)
+        self._td.setRiskGate(self._risk)
+
+    def setRiskLimits(self, code = None, max_volume = None, max_notional = None,
+            max_rate = None):
+        if not getattr(self, "_risk", None):
+            raise RuntimeError("未启用风控")
+        self._risk.setLimits(code, max_volume, max_notional, max_rate)
+
+    def enableDepthBook(self, max_codes = 4096):
+        from .depth import DepthBook
+        if getattr(self, "_depth", None):
+            self._md.removeTickSink(self._depth)
+        self._depth = DepthBook(lambda code: self._td.getInstrument(code)["price_tick"],
+                max_codes)
+        self._md.addTickSink(self._depth)
+
+    def getDepthBook(self):
+        if not getattr(self, "_depth", None):
+            raise RuntimeError("未启用盘口表")
+        return self._depth
+
+    def getDepthMetrics(self, codes = None):
+        return self.getDepthBook().compute(codes)
+
+    def enableLatencyStats(self, dump_path = None, dump_interval = 60):
+        from .latency import LatencyStats
+        if getattr(self, "_latency", None):
+            self._latency.close()
+        self._latency = LatencyStats(lambda code: self._td.getInstrument(code)["exchange"],
+                dump_path, dump_interval)
+        self._md.setLatencyStats(self._latency)
+        self._td.setLatencyStats(self._latency)
+
+    def latencyStats(self):
+        if not getattr(self, "_latency", None):
+            raise RuntimeError("未启用延迟统计")
+        return self._latency.snapshot()
+
+    def getOrders(self, code = None, direction = None):
+        return self._td.getOrders(code, direction)
+
+    def getOrder(self, order_id):
+        return self._td.getOrder(order_id)
+
+    def getPositions(self, code = None, direction = None):
+        return self._td.getPositions(code, direction)
+
+    def prepareInstruments(self, codes):
+        self._td.prepareInstruments(codes)
 
     def orderMarket(self, code, direction, volume):
         return self._td.orderMarket(code, direction, volume)
@@ -704,11 +2077,203 @@ class Client:
     def deleteOrder(self, order_id):
         self._td.deleteOrder(order_id)
 
+    def submitMarket(self, code, direction, volume):
+        return self._td.submitMarket(code, direction, volume)
+
+    def submitFAK(self, code, direction, volume, price, min_volume):
+        return self._td.submitFAK(code, direction, volume, price, min_volume)
+
+    def submitFOK(self, code, direction, volume, price):
+        return self._td.submitFOK(code, direction, volume, price)
+
+    def submitLimit(self, code, direction, volume, price):
+        return self._td.submitLimit(code, direction, volume, price)
+
+    def submitDelete(self, order_id):
+        return self._td.submitDelete(order_id)
+
+    def orderLimitBatch(self, orders):
+        return self._td.orderLimitBatch(orders)
+
+    def deleteOrders(self, order_ids):
+        return self._td.deleteOrders(order_ids)
+
+    def cancelAll(self, code = None, direction = None):
+        return self._td.cancelAll(code, direction)
+
     def transferFromBank(self, money, password, bank_name = None, bank_account = None):
         self._td.transfer(abs(money), password, bank_name, bank_account)
 
     def transferToBank(self, money, password, bank_name = None, bank_account = None):
         self._td.transfer(-abs(money), password, bank_name, bank_account)
 
-    def getSettlement(self, date, encoding = "gbk"):
-        return self._td.getSettlement(date, encoding)
+    def getSettlement(self, date, encoding = "gbk", priority = PRIORITY_NORMAL):
+        return self._td.getSettlement(date, encoding, priority)
+
+    def getTrades(self, code = None, trading_day = None, priority = PRIORITY_NORMAL):
+        return self._td.getTrades(code, trading_day, priority)
+
+    def getOrderTrades(self, order_id, priority = PRIORITY_NORMAL):
+        return self._td.getOrderTrades(order_id, priority)
+
+    def getSettlements(self, start_date, end_date, encoding = "gbk", priority = PRIORITY_LOW):
+        from .settlement import tradingDates
+        return self._td.iterSettlements(tradingDates(start_date, end_date), encoding, priority)
+
+
+class AsyncClient:
+
+    def __init__(self, client, tick_type = "dict"):
+        self._client = client
+        self._td = client._td
+        self._md_executor = concurrent.futures.ThreadPoolExecutor(1, "ctp_md")
+        self._td_executor = concurrent.futures.ThreadPoolExecutor(1, "ctp_td")
+        #orders keep their sequence and never queue behind a blocking query or transfer
+        self._order_executor = concurrent.futures.ThreadPoolExecutor(1, "ctp_order")
+        self._tick_queues = []
+        client.setReceiver(self._onTick, tick_type)
+
+    @classmethod
+    async def create(cls, *args, tick_type = "dict", **kwargs):
+        loop = asyncio.get_running_loop()
+        client = await loop.run_in_executor(None, lambda: Client(*args, **kwargs))
+        return cls(client, tick_type)
+
+    def close(self):
+        self._md_executor.shutdown(wait = False)
+        self._td_executor.shutdown(wait = False)
+        self._order_executor.shutdown(wait = False)
+
+    def _runMd(self, func, *args):
+        return asyncio.get_running_loop().run_in_executor(self._md_executor, func, *args)
+
+    def _runTd(self, func, *args):
+        return asyncio.get_running_loop().run_in_executor(self._td_executor, func, *args)
+
+    def _runOrder(self, func, *args):
+        return asyncio.get_running_loop().run_in_executor(self._order_executor, func, *args)
+
+    async def _await(self, future, timeout = MAX_TIMEOUT):
+        loop = asyncio.get_running_loop()
+        aio_future = loop.create_future()
+        future.addCallback(lambda _: loop.call_soon_threadsafe(self._resolve, aio_future, future))
+        try:
+            return await asyncio.wait_for(aio_future, timeout)
+        except asyncio.TimeoutError:
+            #only orders and deletes are waited with a timeout
+            self._td._expireOrder(future)
+            raise TimeoutError("%s超时" % future._operation_name) from None
+
+    def _resolve(self, aio_future, future):
+        if aio_future.done():
+            return
+        try:
+            aio_future.set_result(future.wait(0))
+        except Exception as e:
+            aio_future.set_exception(e)
+
+    def _onTick(self, tick):
+        for (loop, queue) in self._tick_queues:
+            loop.call_soon_threadsafe(self._putTick, queue, tick)
+
+    def _putTick(self, queue, tick):
+        if queue.full():
+            queue.get_nowait()
+        queue.put_nowait(tick)
+
+    async def ticks(self, maxsize = 10000):
+        item = (asyncio.get_running_loop(), asyncio.Queue(maxsize))
+        self._tick_queues.append(item)
+        try:
+            while True:
+                yield await item[1].get()
+        finally:
+            self._tick_queues.remove(item)
+
+    async def subscribe(self, codes = None, exchange = None, product = None, underlying = None,
+            expire_date = None, option_type = None, prefix = None):
+        return await self._runMd(self._client.subscribe, codes, exchange, product, underlying,
+                expire_date, option_type, prefix)
+
+    async def unsubscribe(self, codes = None, exchange = None, product = None,
+            underlying = None, expire_date = None, option_type = None, prefix = None):
+        await self._runMd(self._client.unsubscribe, codes, exchange, product, underlying,
+                expire_date, option_type, prefix)
+
+    def getInstrument(self, code):
+        return self._client.getInstrument(code)
+
+    async def getAccount(self, priority = PRIORITY_NORMAL):
+        return await self._await(self._td.queryAccount(priority), None)
+
+    async def _waitBook(self):
+        #the book is seeded soon after the login, a thread is only needed to wait for it
+        if not self._td._book_ready.is_set():
+            await asyncio.get_running_loop().run_in_executor(None, self._td._waitBook)
+
+    async def getOrders(self, code = None, direction = None):
+        await self._waitBook()
+        return self._client.getOrders(code, direction)
+
+    def getOrder(self, order_id):
+        return self._client.getOrder(order_id)
+
+    async def getPositions(self, code = None, direction = None):
+        await self._waitBook()
+        return self._client.getPositions(code, direction)
+
+    def prepareInstruments(self, codes):
+        self._client.prepareInstruments(codes)
+
+    #submit*() may wait for the order rate limit, so they run on the order thread rather
+    #than blocking the event loop
+    async def orderMarket(self, code, direction, volume):
+        return await self._await(await self._runOrder(self._td.submitMarket, code, direction,
+                volume))
+
+    async def orderFAK(self, code, direction, volume, price, min_volume):
+        return await self._await(await self._runOrder(self._td.submitFAK, code, direction,
+                volume, price, min_volume))
+
+    async def orderFOK(self, code, direction, volume, price):
+        return await self._await(await self._runOrder(self._td.submitFOK, code, direction,
+                volume, price))
+
+    async def orderLimit(self, code, direction, volume, price):
+        return await self._await(await self._runOrder(self._td.submitLimit, code, direction,
+                volume, price))
+
+    async def deleteOrder(self, order_id):
+        await self._await(await self._runOrder(self._td.submitDelete, order_id))
+
+    async def _awaitBatch(self, futures):
+        return await asyncio.gather(*[self._await(future) for future in futures],
+                return_exceptions = True)
+
+    async def orderLimitBatch(self, orders):
+        return await self._awaitBatch(await self._runOrder(self._td.submitLimitBatch, orders))
+
+    async def deleteOrders(self, order_ids):
+        return await self._awaitBatch(await self._runOrder(self._td.submitDeletes, order_ids))
+
+    async def cancelAll(self, code = None, direction = None):
+        order_ids = [oid for (oid, order) in (await self.getOrders(code, direction)).items()
+                if order["is_active"]]
+        return dict(zip(order_ids, await self.deleteOrders(order_ids)))
+
+    async def transferFromBank(self, money, password, bank_name = None, bank_account = None):
+        await self._runTd(self._client.transferFromBank, money, password, bank_name,
+                bank_account)
+
+    async def transferToBank(self, money, password, bank_name = None, bank_account = None):
+        await self._runTd(self._client.transferToBank, money, password, bank_name,
+                bank_account)
+
+    async def getTrades(self, code = None, trading_day = None, priority = PRIORITY_NORMAL):
+        return await self._runTd(self._client.getTrades, code, trading_day, priority)
+
+    async def getOrderTrades(self, order_id, priority = PRIORITY_NORMAL):
+        return await self._runTd(self._client.getOrderTrades, order_id, priority)
+
+    async def getSettlement(self, date, encoding = "gbk", priority = PRIORITY_NORMAL):
+        return await self._runTd(self._client.getSettlement, date, encoding, priority)
@@ -0,0 +1,184 @@
+import time
+import logging
+import threading
+import numpy as np
+from .latency import CST_OFFSET
+
+BAR_DTYPE = np.dtype([("start", "f8"), ("open", "f8"), ("high", "f8"), ("low", "f8"),
+        ("close", "f8"), ("volume", "i8"), ("turnover", "f8"), ("open_interest", "i8"),
+        ("ticks", "i8")])
+
+def exchangeTime(update_time, millisec, now):
+    #the time nearest to now with the time of day of the tick, so neither ActionDay, which
+    #exchanges report differently for night sessions, nor a drifting local clock matter
+    t = int(update_time[0: 2]) * 3600 + int(update_time[3: 5]) * 60 + int(update_time[6: 8])   \
+            + millisec / 1000
+    return now - ((now + CST_OFFSET) % 86400 - t + 43200) % 86400 + 43200
+
+class BarEngine:
+
+    def __init__(self, intervals = (60,), capacity = 1024, max_codes = 4096, grace = 1.0):
+        self._intervals = tuple(intervals)
+        self._capacity = capacity
+        self._max_codes = max_codes
+        self._grace = grace
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self._rows = {}
+        self._codes = []
+        #per code: cumulative volume, turnover and trading day of the last tick, and how far
+        #the exchange clock is ahead of the local one
+        self._last = []
+        self._drift = []
+        #per interval and code: the open bar as a list, end of the last closed bar,
+        #closed bars and their count
+        self._current = [[] for _ in self._intervals]
+        self._ends = [[] for _ in self._intervals]
+        self._histories = [[] for _ in self._intervals]
+        self._counts = [[] for _ in self._intervals]
+        self._running = True
+        self._thread = threading.Thread(target = self._flushLoop, name = "ctp_bars",
+                daemon = True)
+        self._thread.start()
+
+    def close(self):
+        if self._running:
+            self._running = False
+            self._thread.join()
+
+    def addCallback(self, func):
+        self._callbacks = self._callbacks + [func]
+
+    def removeCallback(self, func):
+        self._callbacks = [f for f in self._callbacks if f is not func]
+
+    def _addCode(self, code):
+        row = len(self._codes)
+        if row == self._max_codes:
+            raise RuntimeError("K线引擎已满（最多%d个合约）" % self._max_codes)
+        for k in range(len(self._intervals)):
+            self._current[k].append(None)
+            self._ends[k].append(0.0)
+            #like TickStore every bar is written twice so the latest n are contiguous
+            self._histories[k].append(np.zeros(self._capacity * 2, BAR_DTYPE))
+            self._counts[k].append(0)
+        self._last.append(None)
+        self._drift.append(0.0)
+        self._codes.append(code)
+        self._rows[code] = row
+        return row
+
+    def __call__(self, tick):
+        price = tick[1]
+        if price is None:
+            return
+        now = time.time()
+        try:
+            t = exchangeTime(tick[37], tick[38], now)
+        except ValueError:
+            return
+        (volume, turnover, trading_day) = (tick[9], tick[10], tick[35])
+        closed = []
+        with self._lock:
+            row = self._rows.get(tick[0])
+            if row is None:
+                row = self._addCode(tick[0])
+            last = self._last[row]
+            self._last[row] = (volume, turnover, trading_day)
+            self._drift[row] = t - now
+            if last is None:
+                #the first tick only sets the baseline of the cumulative fields
+                return
+            if trading_day != last[2] or volume < last[0]:
+                #a new trading day starts counting from zero
+                (dv, dt) = (volume, turnover)
+            else:
+                (dv, dt) = (volume - last[0], turnover - last[1])
+            for (k, interval) in enumerate(self._intervals):
+                current = self._current[k]
+                bar = current[row]
+                if bar is not None and t >= bar[0] + interval:
+                    closed.append(self._closeBar(k, row))
+                    bar = None
+                if bar is None:
+                    #ticks without trades, like snapshots pushed around session breaks,
+                    #do not open a bar; late ticks go to the bar after the last closed one
+                    if dv == 0:
+                        continue
+                    start = max(t - (t + CST_OFFSET) % interval, self._ends[k][row])
+                    current[row] = [start, price, price, price, price, dv, dt, tick[11], 1]
+                    continue
+                if price > bar[2]:
+                    bar[2] = price
+                if price < bar[3]:
+                    bar[3] = price
+                bar[4] = price
+                bar[5] += dv
+                bar[6] += dt
+                bar[7] = tick[11]
+                bar[8] += 1
+        if closed:
+            self._emit(closed)
+
+    def _closeBar(self, k, row):
+        bar = self._current[k][row]
+        self._current[k][row] = None
+        interval = self._intervals[k]
+        self._ends[k][row] = bar[0] + interval
+        count = self._counts[k][row]
+        i = count % self._capacity
+        history = self._histories[k][row]
+        history[i] = history[i + self._capacity] = tuple(bar)
+        self._counts[k][row] = count + 1
+        return (self._codes[row], interval, history[i + self._capacity])
+
+    def _emit(self, closed):
+        for item in closed:
+            for func in self._callbacks:
+                try:
+                    func(*item)
+                except Exception:
+                    logging.exception("K线回调出错")
+
+    def flush(self, now = None):
+        #close bars whose end has passed on the exchange clock, e.g. the last bar before
+        #a session break which no later tick would close
+        now = time.time() if now is None else now
+        closed = []
+        with self._lock:
+            for (k, interval) in enumerate(self._intervals):
+                for (row, bar) in enumerate(self._current[k]):
+                    if bar is not None and now + self._drift[row] >= bar[0] + interval +  \
+                            self._grace:
+                        closed.append(self._closeBar(k, row))
+        if closed:
+            self._emit(closed)
+
+    def _flushLoop(self):
+        while self._running:
+            time.sleep(0.2)
+            self.flush()
+
+    def _getIndex(self, interval):
+        try:
+            return self._intervals.index(interval)
+        except ValueError:
+            raise ValueError("未启用%s秒K线" % interval) from None
+
+    def getBars(self, code, n, interval = 60):
+        k = self._getIndex(interval)
+        with self._lock:
+            row = self._rows.get(code)
+            if row is None:
+                return np.zeros(0, BAR_DTYPE)
+            count = self._counts[k][row]
+            n = min(n, count, self._capacity)
+            end = (count - 1) % self._capacity + self._capacity + 1
+            return self._histories[k][row][end - n: end]
+
+    def getCurrentBar(self, code, interval = 60):
+        k = self._getIndex(interval)
+        with self._lock:
+            row = self._rows.get(code)
+            bar = None if row is None else self._current[k][row]
+            return None if bar is None else np.array(tuple(bar), BAR_DTYPE)[()]
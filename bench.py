@@ -0,0 +1,259 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+from . import CTPStruct, FILTER, decodeTick, decodeTickDict, decodeTickObject
+from .instruments import InstrumentTable
+from .simulator import MD_FIELDS, DBL_MAX, SimFront, SimClient, makeField, makeInstruments
+
+BENCHMARKS = {}
+
+def benchmark(name):
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+def makeTick(code = "sim0000", price = 3000.0, volume = 10 ** 9):
+    tick = [code, price, price, None, price + 10, price - 10, price * 1.1, price * 0.9, None,
+            12345, 3.7e10, 67890, price, price, 60000]
+    for i in range(1, 6):
+        tick += [price + i, volume, price - i, volume]
+    return tuple(tick + ["20240105", "20240105", "10:15:30", 500])
+
+def makeDepthField(tick):
+    return makeField(CTPStruct.DepthMarketDataField, **{name: DBL_MAX if value is None
+            else value for (name, value) in zip(MD_FIELDS, tick)})
+
+
+class Session:
+    #a simulated front and client shared by the benchmarks that need one
+
+    def __init__(self):
+        self._cwd = os.getcwd()
+        self._directory = tempfile.mkdtemp(prefix = "ctp_bench_")
+        os.chdir(self._directory)
+        self.front = SimFront("bench", seed = 0)
+        self.client = SimClient(self.front.address, self.front.address, "9999", "app", "auth",
+                "user", "password", query_rate = 1000, query_burst = 1000,
+                reconcile_interval = 0, order_rate = 10 ** 9, order_burst = 10 ** 9)
+        self.client.subscribe(["sim0000"])
+        self.front.publish(makeTick())
+
+    def close(self):
+        self.front.close()
+        os.chdir(self._cwd)
+        shutil.rmtree(self._directory, ignore_errors = True)
+
+
+@benchmark("decode.dict")
+def benchDecodeDict(session):
+    field = makeDepthField(makeTick())
+    return (lambda: decodeTickDict(field), 1000)
+
+@benchmark("decode.tuple")
+def benchDecodeTuple(session):
+    field = makeDepthField(makeTick())
+    return (lambda: decodeTick(field), 1000)
+
+@benchmark("decode.tick")
+def benchDecodeTick(session):
+    field = makeDepthField(makeTick())
+    return (lambda: decodeTickObject(field), 1000)
+
+@benchmark("filter")
+def benchFilter(session):
+    return (lambda: FILTER(3000.0), 1000)
+
+@benchmark("dispatch.receiver")
+def benchDispatch(session):
+    md = session.client._md
+    md.setReceiver(lambda tick: None, "dict")
+    field = makeDepthField(makeTick())
+    return (lambda: md.OnRtnDepthMarketData(field), 1000)
+
+@benchmark("dispatch.sinks")
+def benchDispatchSinks(session):
+    md = session.client._md
+    md.setReceiver(lambda tick: None, "tick")
+    sink = lambda tick: None
+    md.addTickSink(sink)
+    field = makeDepthField(makeTick())
+    return (lambda: md.OnRtnDepthMarketData(field), 1000, lambda: md.removeTickSink(sink))
+
+@benchmark("parse.order")
+def benchParseOrder(session):
+    td = session.client._td
+    order = makeField(CTPStruct.OrderField, OrderSysID = "      123456", InstrumentID = "sim0000",
+            Direction = '0', CombOffsetFlag = '0', VolumeTotalOriginal = 3,
+            LimitPrice = 3000.0, VolumeTraded = 1, OrderStatus = '1')
+    return (lambda: td._parseOrder(order), 1000)
+
+@benchmark("parse.position")
+def benchParsePosition(session):
+    td = session.client._td
+    position = makeField(CTPStruct.InvestorPositionField, InstrumentID = "sim0000",
+            PosiDirection = '2', Position = 3, UseMargin = 9000.0, OpenCost = 90000.0)
+    def run():
+        td._positions = []
+        td._gotPosition(position)
+    return (run, 1000)
+
+@benchmark("instruments.save")
+def benchInstrumentsSave(session):
+    instruments = {}
+    for i in makeInstruments(50000):
+        instruments[i["InstrumentID"]] = {"name": i["InstrumentName"],
+                "exchange": i["ExchangeID"], "product": i["ProductID"],
+                "underlying": i["UnderlyingInstrID"], "multiple": i["VolumeMultiple"],
+                "price_tick": i["PriceTick"], "expire_date": None,
+                "long_margin_ratio": i["LongMarginRatio"],
+                "short_margin_ratio": i["ShortMarginRatio"], "option_type": None,
+                "strike_price": None, "is_trading": True}
+    path = os.path.abspath("bench_instruments.dat")
+    session.instruments_path = path
+    return (lambda: InstrumentTable.save(path, "20240105", instruments), 1)
+
+@benchmark("instruments.load")
+def benchInstrumentsLoad(session):
+    path = getattr(session, "instruments_path", None)
+    if not path:
+        benchInstrumentsSave(session)[0]()
+        path = session.instruments_path
+    codes = random.Random(0).sample(list(InstrumentTable(path)), 100)
+    def run():
+        table = InstrumentTable(path)
+        for code in codes:
+            table[code]
+    return (run, 1)
+
+@benchmark("order.insert")
+def benchOrderInsert(session):
+    #the Python side of an order, from submitLimit() to the return of ReqOrderInsert()
+    td = session.client._td
+    td.ReqOrderInsert = lambda field, req_id: 0
+    def run():
+        td.submitLimit("sim0000", "long", 1, 3001.0)
+        td._pending_orders.clear()
+    return (run, 1000, lambda: td.__dict__.pop("ReqOrderInsert"))
+
+@benchmark("order.roundtrip")
+def benchOrderRoundTrip(session):
+    client = session.client
+    #the simulated book has unlimited volume at 3001, so every FAK order fills at once
+    return (lambda: client.orderFAK("sim0000", "long", 1, 3001.0, 0), 1)
+
+
+def run(name, session, duration = 1.0, min_rounds = 20):
+    items = BENCHMARKS[name](session)
+    (func, batch, teardown) = items if len(items) == 3 else items + (None,)
+    timer = time.perf_counter
+    try:
+        #warm up caches and lazily built state
+        for _ in range(min(batch, 100)):
+            func()
+        #throughput from batches, which amortize the cost of reading the clock
+        samples = []
+        deadline = timer() + duration / 2
+        while len(samples) < min_rounds or timer() < deadline:
+            start = timer()
+            for _ in range(batch):
+                func()
+            samples.append((timer() - start) / batch)
+        #percentiles from single operations, the means of batches would hide the tail
+        latencies = []
+        deadline = timer() + duration / 2
+        while len(latencies) < min_rounds or timer() < deadline:
+            start = timer()
+            func()
+            latencies.append(timer() - start)
+        tracemalloc.start()
+        (base, _) = tracemalloc.get_traced_memory()
+        for _ in range(batch):
+            func()
+        (current, peak) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    finally:
+        if teardown:
+            teardown()
+    ops = len(samples) * batch
+    latencies.sort()
+    pick = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1e6
+    return {"ops": ops, "ops_per_sec": ops / (sum(samples) * batch),
+            "p50_us": pick(0.5), "p99_us": pick(0.99), "p999_us": pick(0.999),
+            "retained_bytes_per_op": (current - base) / batch, "peak_bytes": peak - base}
+
+def getMeta():
+    meta = {"time": time.strftime("%Y-%m-%d %H:%M:%S"), "python": sys.version.split()[0],
+            "implementation": platform.python_implementation(),
+            "machine": platform.machine(), "platform": platform.platform()}
+    try:
+        meta["commit"] = subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                cwd = os.path.dirname(os.path.abspath(__file__)), capture_output = True,
+                text = True, timeout = 10).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        pass
+    return meta
+
+def runAll(names = None, duration = 1.0):
+    session = Session()
+    try:
+        results = {}
+        for name in names or BENCHMARKS:
+            results[name] = run(name, session, duration)
+            print("%-20s %12.0f ops/s  p50 %9.2fus  p99 %9.2fus  p999 %9.2fus" %
+                    (name, results[name]["ops_per_sec"], results[name]["p50_us"],
+                    results[name]["p99_us"], results[name]["p999_us"]))
+    finally:
+        session.close()
+    return {"meta": getMeta(), "results": results}
+
+def compare(baseline, current, threshold = 0.1):
+    regressions = []
+    for (name, result) in current["results"].items():
+        old = baseline["results"].get(name)
+        if not old:
+            continue
+        ratio = result["ops_per_sec"] / old["ops_per_sec"]
+        flag = ""
+        if ratio < 1 - threshold:
+            flag = "  <-- 退化"
+            regressions.append(name)
+        print("%-20s %12.0f -> %12.0f ops/s  %+7.1f%%%s" % (name, old["ops_per_sec"],
+                result["ops_per_sec"], (ratio - 1) * 100, flag))
+    return regressions
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(prog = "python -m ctp_client.bench",
+            description = "ctp_client热路径基准测试")
+    parser.add_argument("names", nargs = "*", help = "只运行这些基准（默认全部）")
+    parser.add_argument("-o", "--output", help = "把结果保存为JSON文件")
+    parser.add_argument("-b", "--baseline", help = "与之前保存的JSON结果比较")
+    parser.add_argument("-t", "--threshold", type = float, default = 0.1,
+            help = "吞吐量下降超过该比例视为退化（默认0.1）")
+    parser.add_argument("-d", "--duration", type = float, default = 1.0,
+            help = "每个基准的运行时间（秒）")
+    args = parser.parse_args(argv)
+    for name in args.names:
+        if name not in BENCHMARKS:
+            parser.error("未知的基准<%s>，可选：%s" % (name, ", ".join(BENCHMARKS)))
+    current = runAll(args.names, args.duration)
+    if args.output:
+        with open(args.output, "w") as fd:
+            json.dump(current, fd, indent = 2)
+    if args.baseline:
+        with open(args.baseline) as fd:
+            baseline = json.load(fd)
+        if compare(baseline, current, args.threshold):
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,114 @@
+import threading
+import numpy as np
+
+LEVELS = 5
+#the order of the fields of each level in a tick
+ASK = 0
+BID = 1
+METRICS_DTYPE = np.dtype([("code", "U31"), ("mid", "f8"), ("spread", "f8"),
+        ("spread_ticks", "f8"), ("weighted_mid", "f8"), ("imbalance", "f8"),
+        ("imbalance1", "f8"), ("bid_depth", "i8"), ("ask_depth", "i8"),
+        ("upper_distance", "f8"), ("lower_distance", "f8")])
+
+class DepthBook:
+
+    def __init__(self, get_price_tick = None, max_codes = 4096):
+        self._get_price_tick = get_price_tick
+        self._max_codes = max_codes
+        self._lock = threading.Lock()
+        self._rows = {}
+        self._codes = []
+        #instrument x level x side x (price, volume) laid out as in a tick, so a tick is
+        #copied with one assignment; empty prices are NaN
+        self._levels = np.zeros((max_codes, LEVELS, 2, 2))
+        self._levels[..., 0] = np.nan
+        self._flat = self._levels.reshape(max_codes, LEVELS * 4)
+        self.prices = self._levels[..., 0]
+        self.volumes = self._levels[..., 1]
+        #upper limit, lower limit
+        self.limits = np.full((max_codes, 2), np.nan)
+        self.price_ticks = np.full(max_codes, np.nan)
+        self._metrics = np.zeros(max_codes, METRICS_DTYPE)
+        self._changed = set()
+
+    def _addCode(self, code):
+        row = len(self._codes)
+        if row == self._max_codes:
+            raise RuntimeError("盘口表已满（最多%d个合约）" % self._max_codes)
+        if self._get_price_tick:
+            try:
+                self.price_ticks[row] = self._get_price_tick(code)
+            except ValueError:
+                pass
+        self._metrics[row]["code"] = code
+        self._codes.append(code)
+        self._rows[code] = row
+        return row
+
+    def __call__(self, tick):
+        with self._lock:
+            row = self._rows.get(tick[0])
+            if row is None:
+                row = self._addCode(tick[0])
+            #None becomes NaN
+            self._flat[row] = tick[15: 15 + LEVELS * 4]
+            self.limits[row] = tick[6: 8]
+            self._changed.add(row)
+
+    def _compute(self, rows):
+        (prices, volumes) = (self.prices[rows], self.volumes[rows])
+        (bid, ask) = (prices[:, 0, BID], prices[:, 0, ASK])
+        (bid_volume, ask_volume) = (volumes[:, 0, BID], volumes[:, 0, ASK])
+        metrics = self._metrics[rows]
+        with np.errstate(invalid = "ignore", divide = "ignore"):
+            metrics["mid"] = mid = (bid + ask) / 2
+            metrics["spread"] = spread = ask - bid
+            ticks = self.price_ticks[rows]
+            metrics["spread_ticks"] = spread / ticks
+            #the side with more volume pulls the price away from itself
+            metrics["weighted_mid"] = (bid * ask_volume + ask * bid_volume) /                \
+                    (bid_volume + ask_volume)
+            metrics["imbalance1"] = (bid_volume - ask_volume) / (bid_volume + ask_volume)
+            #empty levels have NaN volumes too, they add nothing to the depth
+            depth = np.nansum(volumes, axis = 1)
+            metrics["bid_depth"] = depth[:, BID]
+            metrics["ask_depth"] = depth[:, ASK]
+            metrics["imbalance"] = (depth[:, BID] - depth[:, ASK]) /                         \
+                    (depth[:, BID] + depth[:, ASK])
+            limits = self.limits[rows]
+            metrics["upper_distance"] = (limits[:, 0] - mid) / ticks
+            metrics["lower_distance"] = (mid - limits[:, 1]) / ticks
+        self._metrics[rows] = metrics
+        return metrics
+
+    def compute(self, codes = None):
+        with self._lock:
+            if codes is None:
+                self._changed.clear()
+                return self._compute(slice(0, len(self._codes)))
+            rows = [self._rows[code] for code in codes if code in self._rows]
+            self._changed.difference_update(rows)
+            return self._compute(np.array(rows, np.intp))
+
+    def computeChanged(self):
+        #only the rows updated by ticks since the last call
+        with self._lock:
+            rows = np.array(sorted(self._changed), np.intp)
+            self._changed.clear()
+            return self._compute(rows)
+
+    def getMetrics(self, code):
+        with self._lock:
+            row = self._rows.get(code)
+            if row is None:
+                raise ValueError("合约<%s>没有盘口" % code)
+            return self._compute(np.array([row], np.intp))[0]
+
+    def getRow(self, code):
+        row = self._rows.get(code)
+        if row is None:
+            raise ValueError("合约<%s>没有盘口" % code)
+        return row
+
+    def codes(self):
+        return list(self._codes)
@@ -0,0 +1,183 @@
+import os
+import math
+import mmap
+import struct
+import collections.abc
+
+MAGIC = b"CTPINST1"
+#magic, date, count, code width, product width, underlying width
+HEADER = struct.Struct("<8s10sIHHH")
+#multiple, price tick, long margin ratio, short margin ratio, strike price, is trading
+RECORD = struct.Struct("<qdddd?")
+OPTION_TYPES = {None: b"", "call": b"c", "put": b"p"}
+
+def indexEntry(code_width, product_width, underlying_width):
+    #code, exchange, product, underlying, expire date, option type, record offset, record size
+    return struct.Struct("<%ds8s%ds%ds10s1sII" % (code_width, product_width, underlying_width))
+
+def toFloat(x):
+    return math.nan if x is None else x
+
+def fromFloat(x):
+    return None if x != x else x
+
+
+class InstrumentTable(collections.abc.Mapping):
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as fd:
+            self._mm = mmap.mmap(fd.fileno(), 0, access = mmap.ACCESS_READ)
+        if self._mm[: len(MAGIC)] != MAGIC or len(self._mm) < HEADER.size:
+            #unmapped at once, the file is about to be deleted
+            self._mm.close()
+            raise ValueError("合约缓存<%s>格式错误" % path)
+        (_, date, self._count, self._code_width, product_width, underlying_width) =       \
+                HEADER.unpack_from(self._mm, 0)
+        self.date = date.decode()
+        self._entry = indexEntry(self._code_width, product_width, underlying_width)
+        self._rows = {}
+        self._records = {}
+        self._indexes = None
+
+    @staticmethod
+    def save(path, date, instruments):
+        codes = sorted(instruments)
+        encoded = [(code.encode(), instruments[code]) for code in codes]
+        code_width = max([len(code) for (code, _) in encoded] + [1])
+        product_width = max([len(i["product"].encode()) for (_, i) in encoded] + [1])
+        underlying_width = max([len(i["underlying"].encode()) for (_, i) in encoded] + [1])
+        entry = indexEntry(code_width, product_width, underlying_width)
+        (entries, records) = ([], [])
+        offset = HEADER.size + entry.size * len(codes)
+        for (code, i) in encoded:
+            record = RECORD.pack(i["multiple"], i["price_tick"],
+                    toFloat(i["long_margin_ratio"]), toFloat(i["short_margin_ratio"]),
+                    toFloat(i["strike_price"]), i["is_trading"]) + i["name"].encode()
+            entries.append(entry.pack(code, i["exchange"].encode(), i["product"].encode(),
+                    i["underlying"].encode(), (i["expire_date"] or "").encode(),
+                    OPTION_TYPES[i["option_type"]], offset, len(record)))
+            records.append(record)
+            offset += len(record)
+        with open(path + ".tmp", "wb") as fd:
+            fd.write(HEADER.pack(MAGIC, date.encode(), len(codes), code_width, product_width,
+                    underlying_width))
+            fd.write(b"".join(entries))
+            fd.write(b"".join(records))
+        os.replace(path + ".tmp", path)
+
+    def _lowerBound(self, key):
+        #first row whose code is not less than key, codes are sorted and padded with \0
+        (mm, size, width) = (self._mm, self._entry.size, self._code_width)
+        (lo, hi) = (0, self._count)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset = HEADER.size + mid * size
+            if mm[offset: offset + width] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _findRow(self, code):
+        row = self._rows.get(code)
+        if row is not None:
+            return row
+        key = code.encode()
+        if len(key) > self._code_width:
+            return None
+        key = key.ljust(self._code_width, b"\0")
+        lo = self._lowerBound(key)
+        offset = HEADER.size + lo * self._entry.size
+        if lo == self._count or self._mm[offset: offset + self._code_width] != key:
+            return None
+        self._rows[code] = lo
+        return lo
+
+    def _selectPrefix(self, prefix):
+        key = prefix.encode()
+        if len(key) > self._code_width:
+            return set()
+        codes = set()
+        for row in range(self._lowerBound(key), self._count):
+            code = self._unpackEntry(row)[0]
+            if not code.startswith(key):
+                break
+            codes.add(code.rstrip(b"\0").decode())
+        return codes
+
+    def _unpackEntry(self, row):
+        return self._entry.unpack_from(self._mm, HEADER.size + row * self._entry.size)
+
+    def __contains__(self, code):
+        return code in self._records or self._findRow(code) is not None
+
+    def __getitem__(self, code):
+        instrument = self._records.get(code)
+        if instrument:
+            return instrument
+        row = self._findRow(code)
+        if row is None:
+            raise KeyError(code)
+        (_, exchange, product, underlying, expire_date, option_type, offset, size) =       \
+                self._unpackEntry(row)
+        (multiple, price_tick, long_margin_ratio, short_margin_ratio, strike_price,
+                is_trading) = RECORD.unpack_from(self._mm, offset)
+        name = self._mm[offset + RECORD.size: offset + size].decode()
+        instrument = {"name": name, "exchange": exchange.rstrip(b"\0").decode(),
+                "product": product.rstrip(b"\0").decode(),
+                "underlying": underlying.rstrip(b"\0").decode(),
+                "multiple": multiple, "price_tick": price_tick,
+                "expire_date": expire_date.rstrip(b"\0").decode() or None,
+                "long_margin_ratio": fromFloat(long_margin_ratio),
+                "short_margin_ratio": fromFloat(short_margin_ratio),
+                "option_type": {b"c": "call", b"p": "put"}.get(option_type.rstrip(b"\0")),
+                "strike_price": fromFloat(strike_price), "is_trading": is_trading}
+        self._records[code] = instrument
+        return instrument
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        for row in range(self._count):
+            yield self._unpackEntry(row)[0].rstrip(b"\0").decode()
+
+    def _getIndexes(self):
+        if self._indexes:
+            return self._indexes
+        indexes = {"exchange": {}, "product": {}, "underlying": {}, "expire_date": {},
+                "option_type": {}}
+        for row in range(self._count):
+            entry = [x.rstrip(b"\0").decode() for x in self._unpackEntry(row)[: 6]]
+            entry[5] = {"c": "call", "p": "put"}.get(entry[5])
+            for (key, value) in zip(("exchange", "product", "underlying", "expire_date",
+                    "option_type"), entry[1:]):
+                indexes[key].setdefault(value or None, set()).add(entry[0])
+        self._indexes = indexes
+        return indexes
+
+    def select(self, exchange = None, product = None, underlying = None, expire_date = None,
+            option_type = None, prefix = None):
+        indexes = self._getIndexes()
+        result = None if prefix is None else self._selectPrefix(prefix)
+        for (key, value) in (("exchange", exchange), ("product", product),
+                ("underlying", underlying), ("expire_date", expire_date),
+                ("option_type", option_type)):
+            if value is None:
+                continue
+            codes = indexes[key].get(value, set())
+            result = codes if result is None else result & codes
+        return sorted(self if result is None else result)
+
+    def getOptionChain(self, underlying, expire_date):
+        chain = {}
+        for code in self.select(underlying = underlying, expire_date = expire_date):
+            instrument = self[code]
+            if instrument["option_type"] is None:
+                continue
+            strike_price = instrument["strike_price"]
+            if strike_price not in chain:
+                chain[strike_price] = {"strike_price": strike_price, "call": None, "put": None}
+            chain[strike_price][instrument["option_type"]] = code
+        return [chain[strike_price] for strike_price in sorted(chain)]
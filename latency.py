@@ -0,0 +1,179 @@
+import json
+import time
+import logging
+import threading
+
+SUB_BITS = 7
+HALF = 1 << (SUB_BITS - 1)
+#exchange timestamps are China Standard Time
+CST_OFFSET = 8 * 3600
+
+#HdrHistogram style buckets of microseconds: values below 2 ** SUB_BITS have a bucket each,
+#above that every power of two is split into HALF buckets, i.e. about 1.6% precision
+class Histogram:
+
+    def __init__(self):
+        self._counts = [0] * (HALF * 4)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    @staticmethod
+    def _index(value):
+        e = value.bit_length() - SUB_BITS
+        if e <= 0:
+            return value
+        return e * HALF + (value >> e)
+
+    @staticmethod
+    def _highest(index):
+        if index < 2 * HALF:
+            return index
+        e = index // HALF - 1
+        return ((index - e * HALF + 1) << e) - 1
+
+    def record(self, value):
+        value = max(int(value), 0)
+        i = self._index(value)
+        counts = self._counts
+        if i >= len(counts):
+            counts.extend([0] * (i + 1 - len(counts)))
+        counts[i] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        counts = self._counts
+        if len(other._counts) > len(counts):
+            counts.extend([0] * (len(other._counts) - len(counts)))
+        for (i, n) in enumerate(other._counts):
+            counts[i] += n
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        self.max = max(self.max, other.max)
+
+    def percentiles(self, qs):
+        (result, seen, j) = ([], 0, 0)
+        targets = [max(1, round(q * self.count)) for q in qs]
+        for (i, n) in enumerate(self._counts):
+            seen += n
+            while j < len(targets) and seen >= targets[j]:
+                result.append(min(self._highest(i), self.max))
+                j += 1
+            if j == len(targets):
+                break
+        return result + [self.max] * (len(targets) - len(result))
+
+    def toDict(self):
+        if self.count == 0:
+            return {"count": 0}
+        (p50, p90, p99, p999) = self.percentiles((0.5, 0.9, 0.99, 0.999))
+        return {"count": self.count, "min": self.min, "mean": self.total / self.count,
+                "p50": p50, "p90": p90, "p99": p99, "p999": p999, "max": self.max}
+
+
+class LatencyStats:
+
+    def __init__(self, get_exchange = None, dump_path = None, dump_interval = 60):
+        self._get_exchange = get_exchange
+        self._exchanges = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+        self._running = False
+        if dump_path:
+            self._running = True
+            self._thread = threading.Thread(target = self._dump,
+                    args = (dump_path, dump_interval), name = "ctp_latency", daemon = True)
+            self._thread.start()
+
+    def close(self):
+        if self._running:
+            self._running = False
+            self._thread.join()
+
+    def exchangeOf(self, code, default = ""):
+        exchange = self._exchanges.get(code)
+        if exchange is None:
+            exchange = default
+            if self._get_exchange:
+                try:
+                    exchange = self._get_exchange(code)
+                except ValueError:
+                    pass
+            self._exchanges[code] = exchange = exchange or "UNKNOWN"
+        return exchange
+
+    def record(self, stage, exchange, seconds):
+        #counts may rarely lose an increment across threads, which is fine for statistics
+        histogram = self._histograms.get((stage, exchange))
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault((stage, exchange), Histogram())
+        histogram.record(seconds * 1e6)
+
+    def recordTick(self, field, now):
+        t = field.UpdateTime
+        try:
+            exchange_time = int(t[0: 2]) * 3600 + int(t[3: 5]) * 60 + int(t[6: 8])     \
+                    + field.UpdateMillisec / 1000
+        except ValueError:
+            return
+        #compare times of day so ActionDay quirks of night sessions do not matter
+        delay = ((now + CST_OFFSET) % 86400 - exchange_time + 43200) % 86400 - 43200
+        self.record("tick.transit", self.exchangeOf(field.InstrumentID, field.ExchangeID),
+                delay)
+
+    def track(self, future, stage, exchange, sent):
+        def onDone(_):
+            now = time.perf_counter()
+            future._stamp = (exchange, now)
+            self.record(stage, exchange, now - sent)
+        future.addCallback(onDone)
+
+    def recordWake(self, future, stage):
+        stamp = getattr(future, "_stamp", None)
+        if stamp:
+            self.record(stage, stamp[0], time.perf_counter() - stamp[1])
+
+    def snapshot(self):
+        with self._lock:
+            items = list(self._histograms.items())
+        stages = {}
+        for ((stage, exchange), histogram) in items:
+            stages.setdefault(stage, {})[exchange] = histogram
+        result = {}
+        for (stage, histograms) in sorted(stages.items()):
+            merged = Histogram()
+            for histogram in histograms.values():
+                merged.merge(histogram)
+            result[stage] = {"all": merged.toDict()}
+            for (exchange, histogram) in sorted(histograms.items()):
+                result[stage][exchange] = histogram.toDict()
+        return result
+
+    def reset(self):
+        with self._lock:
+            self._histograms = {}
+
+    def _write(self, path):
+        try:
+            with open(path, "a") as fd:
+                fd.write(json.dumps({"time": time.time(), "stages": self.snapshot()}) + "\n")
+        except OSError:
+            logging.exception("写入延迟统计出错")
+
+    def _dump(self, path, interval):
+        next_time = time.monotonic() + interval
+        while self._running:
+            time.sleep(0.2)
+            if time.monotonic() >= next_time:
+                self._write(path)
+                next_time += interval
+        self._write(path)
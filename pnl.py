@@ -0,0 +1,127 @@
+import logging
+import threading
+import numpy as np
+from . import PRIORITY_LOW
+
+class PnlEngine:
+
+    def __init__(self, trader):
+        self._trader = trader
+        self._lock = threading.Lock()
+        self._version = None
+        self._account = None
+        self._account_pnl = 0.0
+        #one account query in flight at a time, a change meanwhile asks for another after it
+        self._account_pending = False
+        self._account_stale = False
+        self._prices = {}
+        self._rebuild()
+
+    def _rebuild(self):
+        #built aside and swapped in at once under the lock, getPnl() may be walking the
+        #old arrays meanwhile
+        version = self._trader._book.positions_version
+        (positions, instruments) = ([], [])
+        for position in self._trader.getPositions():
+            try:
+                instruments.append(self._trader.getInstrument(position["code"]))
+            except ValueError as e:
+                #left out until the positions change again rather than retried every tick
+                logging.warning("盈亏估算忽略持仓：%s" % e)
+                continue
+            positions.append(position)
+        n = len(positions)
+        keys = [(p["code"], p["direction"]) for p in positions]
+        rows = {}
+        for (row, (code, _)) in enumerate(keys):
+            rows.setdefault(code, []).append(row)
+        sign = np.array([1.0 if d == "long" else -1.0 for (_, d) in keys])
+        volume = np.array([p["volume"] for p in positions], dtype = np.float64)
+        cost = np.array([p["cost"] for p in positions], dtype = np.float64)
+        multiple = np.empty(n)
+        margin_ratio = np.empty(n)
+        for (row, ((_, direction), instrument)) in enumerate(zip(keys, instruments)):
+            multiple[row] = instrument["multiple"]
+            ratio = instrument[direction + "_margin_ratio"]
+            margin_ratio[row] = 0 if ratio is None else ratio
+        #positions without a tick yet are marked at their average open price
+        price = cost / (volume * multiple)
+        for (row, (code, _)) in enumerate(keys):
+            if code in self._prices:
+                price[row] = self._prices[code]
+        with self._lock:
+            (self._version, self._keys, self._rows) = (version, keys, rows)
+            (self._sign, self._volume, self._cost) = (sign, volume, cost)
+            (self._multiple, self._margin_ratio, self._price) = (multiple, margin_ratio, price)
+            self._compute()
+        self._refreshAccount()
+
+    def _refreshAccount(self):
+        with self._lock:
+            if self._account_pending:
+                self._account_stale = True
+                return
+            (self._account_pending, self._account_stale) = (True, False)
+        self._trader.queryAccount(PRIORITY_LOW).addCallback(self._onAccount)
+
+    def _onAccount(self, future):
+        try:
+            account = future.wait(0)
+        except Exception as e:
+            account = None
+            logging.warning("盈亏估算获取资金账户失败：%s" % e)
+        with self._lock:
+            if account:
+                (self._account, self._account_pnl) = (account, self._total_pnl)
+            self._account_pending = False
+            stale = self._account_stale
+        if stale:
+            self._refreshAccount()
+
+    def _compute(self):
+        value = self._price * self._volume * self._multiple
+        self._pnl = self._sign * (value - self._cost)
+        self._margin = value * self._margin_ratio
+        self._total_pnl = float(self._pnl.sum())
+        self._total_margin = float(self._margin.sum())
+
+    def recompute(self):
+        with self._lock:
+            self._compute()
+
+    def __call__(self, tick):
+        if self._trader._book.positions_version != self._version:
+            self._rebuild()
+        rows = self._rows.get(tick[0])
+        if not rows:
+            return
+        #settlement price once published, otherwise the last price
+        price = tick[8] if tick[8] is not None else tick[1]
+        if price is None:
+            return
+        self._prices[tick[0]] = price
+        with self._lock:
+            for row in rows:
+                self._price[row] = price
+                value = price * self._volume[row] * self._multiple[row]
+                pnl = self._sign[row] * (value - self._cost[row])
+                margin = value * self._margin_ratio[row]
+                self._total_pnl += float(pnl - self._pnl[row])
+                self._total_margin += float(margin - self._margin[row])
+                (self._pnl[row], self._margin[row]) = (pnl, margin)
+
+    def getPnl(self):
+        with self._lock:
+            positions = [{"code": code, "direction": direction,
+                    "volume": int(self._volume[row]), "price": float(self._price[row]),
+                    "float_pnl": float(self._pnl[row]), "margin": float(self._margin[row])}
+                    for (row, (code, direction)) in enumerate(self._keys)]
+            result = {"positions": positions, "float_pnl": self._total_pnl,
+                    "margin": self._total_margin, "balance": None, "available": None}
+            if self._account:
+                account = self._account
+                balance = account["balance"] + self._total_pnl - self._account_pnl
+                frozen = account["balance"] - account["margin"] - account["available"]
+                result["balance"] = balance
+                result["available"] = balance - self._total_margin - frozen
+            return result
@@ -0,0 +1,265 @@
+import time
+import socket
+import logging
+import threading
+import collections
+import concurrent.futures
+from . import TICK_TYPES, TICK_CONVERTERS
+
+def probeFront(front, timeout = 1):
+    #round trip of a TCP connect, None if the front is unreachable
+    (scheme, _, address) = front.partition("://")
+    if scheme != "tcp":
+        return 0.0
+    (host, _, port) = address.rpartition(":")
+    start = time.monotonic()
+    try:
+        socket.create_connection((host, int(port)), timeout).close()
+    except (OSError, ValueError):
+        return None
+    return time.monotonic() - start
+
+def rankFronts(fronts):
+    with concurrent.futures.ThreadPoolExecutor(len(fronts)) as executor:
+        rtts = list(executor.map(probeFront, fronts))
+    ranked = sorted(zip(fronts, rtts), key = lambda item: (item[1] is None, item[1] or 0))
+    logging.info("前置连接延迟：%s" % ", ".join("%s=%s" % (front, "不可达" if rtt is None else
+            "%.1fms" % (rtt * 1000)) for (front, rtt) in ranked))
+    return [front for (front, _) in ranked]
+
+
+class FrontPool:
+
+    def __init__(self, probe_interval, latency_threshold):
+        self._active = None
+        self._standby = None
+        self._fronts = {}
+        self._switch_lock = threading.Lock()
+        self._probe_interval = probe_interval
+        self._latency_threshold = latency_threshold
+
+    def _startProbing(self):
+        if self._standby and self._probe_interval > 0:
+            threading.Thread(target = self._probe, name = "ctp_probe", daemon = True).start()
+
+    def _probe(self):
+        while True:
+            time.sleep(self._probe_interval)
+            (active, standby) = (self._active, self._standby)
+            if not standby.isReady():
+                continue
+            (active_rtt, standby_rtt) = (probeFront(self._fronts[active]),
+                    probeFront(self._fronts[standby]))
+            if standby_rtt is None:
+                continue
+            if active_rtt is None or active_rtt - standby_rtt > self._latency_threshold:
+                logging.warning("前置<%s>延迟变差，切换到<%s>..." %
+                        (self._fronts[active], self._fronts[standby]))
+                self._switch(active)
+
+    def _onStatus(self, session, ready):
+        if not ready and session is self._active:
+            #switch outside of the callback thread of the failed session
+            threading.Thread(target = self._switch, args = (session,), name = "ctp_failover",
+                    daemon = True).start()
+
+    def _switch(self, old_active):
+        with self._switch_lock:
+            standby = self._standby
+            if self._active is not old_active or not standby or not standby.isReady():
+                return
+            self._activate(standby, old_active)
+            (self._active, self._standby) = (standby, old_active)
+            logging.warning("已切换到前置<%s>..." % self._fronts[standby])
+
+    def _activate(self, session, old_session):
+        pass
+
+
+class QuotePool(FrontPool):
+
+    def __init__(self, fronts, quote_impl, dual = False, probe_interval = 10,
+            latency_threshold = 0.005):
+        FrontPool.__init__(self, probe_interval, latency_threshold)
+        self._dual = dual
+        self._receiver = None
+        self._converter = TICK_CONVERTERS["dict"]
+        self._tick_sinks = []
+        self._tick_store = None
+        self._latency = None
+        self._codes = set()
+        self._recent = {}
+        self._lock = threading.Lock()
+        self.duplicates = 0
+        sessions = self._login(fronts, quote_impl)
+        (self._active, self._standby) = (sessions + [None])[: 2]
+        for session in sessions[2:]:
+            session.Release()
+        for session in sessions[: 2]:
+            session.setReceiver(self._makeReceiver(session), "tuple")
+            session.setStatusHandler(self._onStatus)
+        self._startProbing()
+
+    def _login(self, fronts, quote_impl):
+        def login(front):
+            start_time = time.monotonic()
+            session = quote_impl(front)
+            return (time.monotonic() - start_time, front, session)
+        (results, error) = ([], None)
+        with concurrent.futures.ThreadPoolExecutor(len(fronts)) as executor:
+            for future in [executor.submit(login, front) for front in fronts]:
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    logging.warning("登录行情前置失败：%s" % e)
+                    error = error or e
+        if not results:
+            raise error
+        results.sort(key = lambda item: item[0])
+        logging.info("行情前置登录用时：%s" % ", ".join("%s=%.1fms" % (front, elapsed * 1000)
+                for (elapsed, front, _) in results))
+        for (_, front, session) in results:
+            self._fronts[session] = front
+        return [session for (_, _, session) in results]
+
+    def setReceiver(self, func, tick_type = "dict"):
+        if tick_type not in TICK_TYPES:
+            raise ValueError("错误的行情格式<%s>" % tick_type)
+        old_func = self._receiver
+        (self._receiver, self._converter) = (func, TICK_CONVERTERS[tick_type])
+        return old_func
+
+    def addTickSink(self, sink):
+        self._tick_sinks = self._tick_sinks + [sink]
+
+    def removeTickSink(self, sink):
+        self._tick_sinks = [s for s in self._tick_sinks if s is not sink]
+
+    def enableTickStore(self, capacity = 1024, max_codes = 4096):
+        from .tickstore import TickStore
+        if self._tick_store:
+            self.removeTickSink(self._tick_store)
+        self._tick_store = TickStore(capacity, max_codes)
+        self._tick_store.addCodes(self._codes)
+        self.addTickSink(self._tick_store)
+
+    def getTickStore(self):
+        if not self._tick_store:
+            raise RuntimeError("未启用行情缓存")
+        return self._tick_store
+
+    def setLatencyStats(self, latency):
+        for session in (self._active, self._standby):
+            if session:
+                session.setLatencyStats(latency)
+
+    def _sessions(self):
+        if self._dual and self._standby:
+            return [s for s in (self._active, self._standby) if s.isReady()]
+        return [self._active]
+
+    def subscribe(self, codes):
+        if self._tick_store:
+            self._tick_store.addCodes(codes)
+        with self._switch_lock:
+            self._codes.update(codes)
+            for session in self._sessions():
+                session.subscribe(codes)
+
+    def unsubscribe(self, codes):
+        with self._switch_lock:
+            self._codes.difference_update(codes)
+            for session in self._sessions():
+                session.unsubscribe(codes)
+
+    def _activate(self, session, old_session):
+        if not self._dual:
+            #the old session resubscribes its codes by itself once it reconnects
+            old_session.clearSubscriptions()
+            if self._codes:
+                session.subscribe(sorted(self._codes))
+
+    def _makeReceiver(self, session):
+        def receive(tick):
+            if self._dual:
+                #deliver whichever copy arrives first
+                key = (tick[9], tick[37], tick[38])
+                with self._lock:
+                    recent = self._recent.get(tick[0])
+                    if recent is None:
+                        recent = self._recent[tick[0]] = collections.deque(maxlen = 8)
+                    elif key in recent:
+                        self.duplicates += 1
+                        return
+                    recent.append(key)
+            elif session is not self._active:
+                return
+            for sink in self._tick_sinks:
+                sink(tick)
+            receiver = self._receiver
+            if receiver:
+                converter = self._converter
+                receiver(converter(tick) if converter else tick)
+        return receive
+
+
+class TraderPool(FrontPool):
+
+    def __init__(self, fronts, trader_impl, kwargs, probe_interval = 10,
+            latency_threshold = 0.005):
+        FrontPool.__init__(self, probe_interval, latency_threshold)
+        ranked = rankFronts(fronts)
+        error = None
+        for (i, front) in enumerate(ranked):
+            try:
+                self._active = trader_impl(front, **kwargs)
+            except Exception as e:
+                logging.warning("登录交易前置<%s>失败：%s" % (front, e))
+                error = error or e
+                continue
+            self._fronts[self._active] = front
+            self._active.setStatusHandler(self._onStatus)
+            if i + 1 < len(ranked):
+                #the standby reuses today's instrument cache written by the active session
+                kwargs = dict(kwargs, fast_start = True, reconcile_interval = 0)
+                threading.Thread(target = self._loginStandby,
+                        args = (ranked[i + 1:], trader_impl, kwargs),
+                        name = "ctp_standby", daemon = True).start()
+            return
+        raise error
+
+    def _loginStandby(self, fronts, trader_impl, kwargs):
+        for front in fronts:
+            try:
+                standby = trader_impl(front, **kwargs)
+            except Exception as e:
+                logging.warning("登录备用交易前置<%s>失败：%s" % (front, e))
+                continue
+            self._fronts[standby] = front
+            if self._active._latency:
+                standby.setLatencyStats(self._active._latency)
+            if self._active._risk:
+                standby.setRiskGate(self._active._risk)
+            standby.setStatusHandler(self._onStatus)
+            self._standby = standby
+            logging.info("备用交易前置<%s>已就绪..." % front)
+            self._startProbing()
+            return
+
+    def setLatencyStats(self, latency):
+        for session in (self._active, self._standby):
+            if session:
+                session.setLatencyStats(latency)
+
+    def setRiskGate(self, risk):
+        for session in (self._active, self._standby):
+            if session:
+                session.setRiskGate(risk)
+
+    def prepareInstruments(self, codes):
+        for session in (self._active, self._standby):
+            if session:
+                session.prepareInstruments(codes)
+
+    def __getattr__(self, name):
+        return getattr(self._active, name)
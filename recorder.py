@@ -0,0 +1,197 @@
+import os
+import glob
+import math
+import mmap
+import time
+import heapq
+import struct
+import logging
+import threading
+import collections
+from . import DATA_DIR, TICK_FIELDS, TICK_INT_FIELDS, TICK_STR_FIELDS, TICK_CONVERTERS
+
+MAGIC = b"CTPTICK1"
+#magic, record size
+HEADER = struct.Struct("<8sI")
+#receive time, then TICK_FIELDS
+RECORD = struct.Struct("<d" + "".join("32s" if name == "code" else
+        "8s" if name in TICK_STR_FIELDS else "q" if name in TICK_INT_FIELDS else "d"
+        for name in TICK_FIELDS))
+FLOAT_INDEXES = [i for (i, name) in enumerate(TICK_FIELDS)
+        if name not in TICK_INT_FIELDS and name not in TICK_STR_FIELDS]
+STR_INDEXES = [i for (i, name) in enumerate(TICK_FIELDS) if name in TICK_STR_FIELDS]
+TRADING_DAY_INDEX = TICK_FIELDS.index("trading_day")
+
+def packTick(now, tick):
+    values = list(tick)
+    for i in FLOAT_INDEXES:
+        if values[i] is None:
+            values[i] = math.nan
+    for i in STR_INDEXES:
+        values[i] = values[i].encode()
+    return RECORD.pack(now, *values)
+
+def unpackTick(values):
+    values = list(values)
+    now = values.pop(0)
+    for i in FLOAT_INDEXES:
+        if values[i] != values[i]:
+            values[i] = None
+    for i in STR_INDEXES:
+        values[i] = values[i].rstrip(b"\0").decode()
+    return (now, tuple(values))
+
+def findTickFiles(trading_day, exchanges = None, directory = DATA_DIR + "ticks/"):
+    if exchanges is None:
+        return sorted(glob.glob(os.path.join(directory, trading_day, "*.tick")))
+    return [os.path.join(directory, trading_day, "%s.tick" % exchange)
+            for exchange in exchanges]
+
+def readTicks(path):
+    with open(path, "rb") as fd:
+        if os.fstat(fd.fileno()).st_size <= HEADER.size:
+            return
+        with mmap.mmap(fd.fileno(), 0, access = mmap.ACCESS_READ) as mm:
+            (magic, record_size) = HEADER.unpack_from(mm, 0)
+            if magic != MAGIC or record_size != RECORD.size:
+                raise RuntimeError("行情文件<%s>格式不匹配" % path)
+            #ignore a partially written record at the end
+            count = (len(mm) - HEADER.size) // RECORD.size
+            view = memoryview(mm)[HEADER.size: HEADER.size + count * RECORD.size]
+            try:
+                for values in RECORD.iter_unpack(view):
+                    yield unpackTick(values)
+            finally:
+                view.release()
+
+def loadArray(path):
+    import numpy as np
+    dtype = np.dtype([("time", "<f8")] + [(name, "S32" if name == "code" else
+            "S8" if name in TICK_STR_FIELDS else "<i8" if name in TICK_INT_FIELDS else "<f8")
+            for name in TICK_FIELDS])
+    assert(dtype.itemsize == RECORD.size)
+    count = (os.path.getsize(path) - HEADER.size) // RECORD.size
+    return np.memmap(path, dtype, mode = "r", offset = HEADER.size, shape = (count,))
+
+
+class TickRecorder:
+
+    def __init__(self, client, directory = DATA_DIR + "ticks/", flush_interval = 1):
+        self._client = client
+        self._directory = directory
+        self._flush_interval = flush_interval
+        self._exchanges = {}
+        self._files = {}
+        self._pending = collections.deque()
+        self._running = True
+        self._recorded = 0
+        self._thread = threading.Thread(target = self._work, name = "ctp_recorder",
+                daemon = True)
+        self._thread.start()
+        client.addTickSink(self)
+
+    def __call__(self, tick):
+        self._pending.append((time.time(), tick))
+
+    def close(self):
+        self._client.removeTickSink(self)
+        self._running = False
+        self._thread.join()
+        logging.info("已记录%d条行情..." % self._recorded)
+
+    def _getExchange(self, code):
+        exchange = self._exchanges.get(code)
+        if exchange is None:
+            try:
+                exchange = self._client.getInstrument(code)["exchange"]
+            except ValueError:
+                exchange = "UNKNOWN"
+            self._exchanges[code] = exchange
+        return exchange
+
+    def _getFile(self, trading_day, exchange):
+        key = (trading_day, exchange)
+        fd = self._files.get(key)
+        if fd:
+            return fd
+        for old_key in [k for k in self._files if k[0] != trading_day]:
+            self._files.pop(old_key).close()
+        path = os.path.join(self._directory, trading_day)
+        os.makedirs(path, exist_ok = True)
+        fd = open(os.path.join(path, "%s.tick" % exchange), "ab", buffering = 1 << 20)
+        if fd.tell() == 0:
+            fd.write(HEADER.pack(MAGIC, RECORD.size))
+        else:
+            #drop a partially written record left by a crash
+            fd.truncate(HEADER.size + (fd.tell() - HEADER.size) // RECORD.size * RECORD.size)
+            fd.seek(0, os.SEEK_END)
+        self._files[key] = fd
+        return fd
+
+    def _flush(self):
+        batches = {}
+        for _ in range(len(self._pending)):
+            (now, tick) = self._pending.popleft()
+            key = (tick[TRADING_DAY_INDEX], self._getExchange(tick[0]))
+            batches.setdefault(key, []).append(packTick(now, tick))
+        for (key, records) in batches.items():
+            fd = self._getFile(*key)
+            fd.write(b"".join(records))
+            fd.flush()
+            self._recorded += len(records)
+
+    def _work(self):
+        while self._running:
+            time.sleep(self._flush_interval)
+            try:
+                self._flush()
+            except Exception:
+                logging.exception("记录行情出错")
+        self._flush()
+        for fd in self._files.values():
+            fd.close()
+        self._files.clear()
+
+
+class TickReplayer:
+
+    def __init__(self, paths, speed = 0):
+        self._paths = paths
+        self._speed = speed
+        self._receiver = None
+        self._converter = TICK_CONVERTERS["dict"]
+        self._tick_sinks = []
+
+    def setReceiver(self, func, tick_type = "dict"):
+        if tick_type not in TICK_CONVERTERS:
+            raise ValueError("错误的行情格式<%s>" % tick_type)
+        old_func = self._receiver
+        (self._receiver, self._converter) = (func, TICK_CONVERTERS[tick_type])
+        return old_func
+
+    def addTickSink(self, sink):
+        self._tick_sinks = self._tick_sinks + [sink]
+
+    def removeTickSink(self, sink):
+        self._tick_sinks = [s for s in self._tick_sinks if s is not sink]
+
+    def run(self):
+        ticks = heapq.merge(*[readTicks(path) for path in self._paths],
+                key = lambda item: item[0])
+        (receiver, converter, sinks) = (self._receiver, self._converter, self._tick_sinks)
+        (count, start, first) = (0, time.monotonic(), None)
+        for (now, tick) in ticks:
+            if self._speed > 0:
+                if first is None:
+                    first = now
+                delay = (now - first) / self._speed - (time.monotonic() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            for sink in sinks:
+                sink(tick)
+            if receiver:
+                receiver(converter(tick) if converter else tick)
+            count += 1
+        elapsed = time.monotonic() - start
+        logging.info("已回放%d条行情，用时%.3f秒..." % (count, elapsed))
+        return count
@@ -0,0 +1,164 @@
+import time
+import threading
+
+class RiskRejected(ValueError):
+    pass
+
+
+class RateLimit:
+    #a token bucket that rejects instead of waiting
+
+    def __init__(self, rate):
+        self._rate = rate
+        self._tokens = rate
+        self._last_time = time.monotonic()
+
+    def check(self, now):
+        self._tokens = min(self._rate, self._tokens + (now - self._last_time) * self._rate)
+        self._last_time = now
+        return self._tokens >= 1
+
+    def take(self):
+        self._tokens -= 1
+
+    def give(self):
+        self._tokens = min(self._rate, self._tokens + 1)
+
+
+class RiskGate:
+
+    def __init__(self, trader, max_volume = None, max_notional = None, max_rate = None):
+        self._trader = trader
+        self._lock = threading.Lock()
+        #default limits of every code, overridden per code by setLimits(); max_rate of the
+        #defaults is the order rate of the whole account
+        self._limits = {None: (max_volume, max_notional, max_rate)}
+        self._account_rate = RateLimit(max_rate) if max_rate else None
+        #code -> [price tick, multiple, upper limit, lower limit, max volume, max notional,
+        #rate limit], built on the first order or tick of the code
+        self._table = {}
+        #(code, direction) -> volume of closes that passed check() but are not in the book yet
+        self._holding = {}
+        self.rejected = 0
+
+    def setLimits(self, code = None, max_volume = None, max_notional = None, max_rate = None):
+        with self._lock:
+            self._limits[code] = (max_volume, max_notional, max_rate)
+            if code is None:
+                self._account_rate = RateLimit(max_rate) if max_rate else None
+                #rebuilt with the new defaults on next use
+                self._table = {}
+            else:
+                self._table.pop(code, None)
+
+    def _getEntry(self, code):
+        entry = self._table.get(code)
+        if entry is None:
+            instrument = self._trader.getInstrument(code)
+            (max_volume, max_notional, _) = self._limits[None]
+            (code_volume, code_notional, max_rate) = self._limits.get(code, (None,) * 3)
+            if code_volume is not None:
+                max_volume = code_volume
+            if code_notional is not None:
+                max_notional = code_notional
+            entry = [instrument["price_tick"], instrument["multiple"], None, None, max_volume,
+                    max_notional, RateLimit(max_rate) if max_rate else None]
+            self._table[code] = entry
+        return entry
+
+    def prepare(self, codes):
+        with self._lock:
+            for code in codes:
+                self._getEntry(code)
+
+    def __call__(self, tick):
+        #keep the latest price limits, which are only known from market data
+        entry = self._table.get(tick[0])
+        if entry is None:
+            try:
+                with self._lock:
+                    entry = self._getEntry(tick[0])
+            except ValueError:
+                return
+        (entry[2], entry[3]) = (tick[6], tick[7])
+
+    def check(self, code, direction, volume, price):
+        #returns the close volume held for the order, to be released once the book has it
+        with self._lock:
+            try:
+                return self._check(code, direction, volume, price)
+            except RiskRejected:
+                self.rejected += 1
+                raise
+
+    def refund(self, code, hold = None):
+        #give back the tokens and the held close volume of an order that passed check() but
+        #was not sent
+        with self._lock:
+            entry = self._table.get(code)
+            if entry and entry[6]:
+                entry[6].give()
+            if self._account_rate:
+                self._account_rate.give()
+            if hold:
+                self._release(hold)
+
+    def release(self, hold):
+        #the order is in the book now, or was rejected
+        with self._lock:
+            self._release(hold)
+
+    def _release(self, hold):
+        (code, direction, volume) = hold
+        left = self._holding.get((code, direction), 0) - volume
+        if left > 0:
+            self._holding[(code, direction)] = left
+        else:
+            self._holding.pop((code, direction), None)
+
+    def _check(self, code, direction, volume, price):
+        (price_tick, multiple, upper, lower, max_volume, max_notional, rate) =                \
+                self._getEntry(code)
+        if price:
+            ticks = price / price_tick
+            if abs(ticks - round(ticks)) > 1e-6:
+                raise RiskRejected("价格<%s>不是最小变动价位<%s>的整数倍" % (price, price_tick))
+            if upper is not None and price > upper:
+                raise RiskRejected("价格<%s>高于涨停价<%s>" % (price, upper))
+            if lower is not None and price < lower:
+                raise RiskRejected("价格<%s>低于跌停价<%s>" % (price, lower))
+        if max_volume is not None and abs(volume) > max_volume:
+            raise RiskRejected("交易数量<%s>超过单笔上限<%s>" % (abs(volume), max_volume))
+        if max_notional is not None:
+            #market orders are valued at the worst price they may trade at
+            buying = (direction == "long") == (volume > 0)
+            value_price = price or (upper if buying else lower)
+            if value_price is not None and value_price * abs(volume) * multiple > max_notional:
+                raise RiskRejected("报单金额<%.2f>超过单笔上限<%.2f>" %
+                        (value_price * abs(volume) * multiple, max_notional))
+        hold = None
+        if volume < 0 and self._trader._book_ready.is_set():
+            self._checkClose(code, direction, -volume)
+            hold = (code, direction, -volume)
+        now = time.monotonic()
+        account_rate = self._account_rate
+        if rate and not rate.check(now):
+            raise RiskRejected("合约<%s>报单频率超过限制" % code)
+        if account_rate and not account_rate.check(now):
+            raise RiskRejected("账户报单频率超过限制")
+        if rate:
+            rate.take()
+        if account_rate:
+            account_rate.take()
+        if hold:
+            key = (code, direction)
+            self._holding[key] = self._holding.get(key, 0) + hold[2]
+        return hold
+
+    def _checkClose(self, code, direction, volume):
+        #closes sent but not returned yet count too, or two of them sent back to back would
+        #both pass
+        closable = self._trader._book.getClosable(code, direction) -                           \
+                self._holding.get((code, direction), 0)
+        if volume > closable:
+            raise RiskRejected("平仓数量<%s>超过可平持仓<%s>" % (volume, closable))
@@ -0,0 +1,86 @@
+import re
+import datetime
+
+#English titles of the sections in a CTP settlement statement
+SECTIONS = (("account summary", "funds"), ("deposit/withdrawal", "cash"),
+        ("transaction record", "trades"), ("position closed", "closed"),
+        ("positions detail", "position_details"), ("positions", "positions"),
+        ("delivery", "deliveries"))
+ITEM = re.compile(r"([^：:|]+?)\s*[：:]+\s*(\S+)")
+NUMBER = re.compile(r"-?[\d,]*\.?\d+")
+#dates, trade numbers and account ids stay strings
+IDENTIFIER = re.compile(r"(^|_)(date|no|id)$")
+CHINESE = re.compile("[一-鿿]")
+
+def tradingDates(start_date, end_date):
+    #every weekday, exchanges have no sessions at weekends; holidays come back empty
+    (day, end) = (datetime.datetime.strptime(start_date, "%Y%m%d").date(),
+            datetime.datetime.strptime(end_date, "%Y%m%d").date())
+    dates = []
+    while day <= end:
+        if day.weekday() < 5:
+            dates.append(day.strftime("%Y%m%d"))
+        day += datetime.timedelta(days = 1)
+    return dates
+
+def toKey(name):
+    #the English part of a bilingual label, or the label itself if it has none
+    english = re.findall(r"[A-Za-z][A-Za-z0-9./&() -]*", name)
+    name = max(english, key = len) if english else name
+    return re.sub(r"[^0-9a-z一-鿿]+", "_", name.strip().lower()).strip("_")
+
+def toValue(key, value):
+    if IDENTIFIER.search(key) or not NUMBER.fullmatch(value):
+        return value
+    value = value.replace(",", "")
+    return float(value) if "." in value else int(value)
+
+def parseSettlement(text):
+    result = {"info": {}, "funds": {}}
+    (section, header, rows) = (None, None, None)
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or set(line) <= set("-=|"):
+            continue
+        if line.startswith("|"):
+            cells = [cell.strip() for cell in line.strip("|").split("|")]
+            if rows is None:
+                if section is None:
+                    continue
+                (header, rows) = (cells, result.setdefault(section, []))
+            elif not rows and len(cells) == len(header) and not CHINESE.search(line):
+                #the English header row under the Chinese one
+                header = [english or chinese for (chinese, english) in zip(header, cells)]
+            elif re.match(r"共\s*\d+\s*条|total", cells[0], re.I):
+                continue
+            else:
+                row = {}
+                for (name, value) in zip(header, cells):
+                    if name:
+                        key = toKey(name)
+                        row[key] = toValue(key, value)
+                rows.append(row)
+            continue
+        (header, rows) = (None, None)
+        items = ITEM.findall(line)
+        english = " ".join(re.findall(r"[A-Za-z/]+", line)).lower()
+        title = next((key for (title, key) in SECTIONS if english.startswith(title)), None)
+        #titles may contain items too, like 币种：人民币, but never numbers
+        if title and not any(NUMBER.fullmatch(value) for (_, value) in items):
+            section = title
+            continue
+        if items and re.sub(r"\s", "", ITEM.sub("", line)) == "":
+            #lines made of label：value pairs
+            target = result["funds" if section == "funds" else "info"]
+            for (name, value) in items:
+                key = toKey(name)
+                target[key] = toValue(key, value)
+            continue
+        section = toKey(line)
+    fees = {}
+    for trade in result.get("trades", []):
+        code = trade.get("instrument")
+        if isinstance(trade.get("fee"), float):
+            fees[code] = fees.get(code, 0.0) + trade["fee"]
+    result["fees"] = fees
+    return result
@@ -0,0 +1,215 @@
+import os
+import time
+import math
+import struct
+import logging
+import threading
+import multiprocessing.connection as MPConn
+from multiprocessing import shared_memory
+from . import MAX_TIMEOUT, TICK_FIELDS, TICK_INT_FIELDS, TICK_STR_FIELDS, TICK_CONVERTERS
+
+MAGIC = b"CTPB"
+#magic, max_codes, code_count, slot_size, authkey, listener address
+HEADER = struct.Struct("<4sIII16s256s")
+HEADER_SIZE = 512
+CODE_COUNT = struct.Struct("<I")
+CODE_COUNT_OFFSET = 8
+#seqlock sequence (odd while being written), code
+SLOT_HEAD = struct.Struct("<Q32s")
+SEQ = struct.Struct("<Q")
+#receive time, then TICK_FIELDS[1:]
+RECORD = struct.Struct("<d" + "".join("q" if name in TICK_INT_FIELDS else
+        "8s" if name in TICK_STR_FIELDS else "d" for name in TICK_FIELDS[1:]))
+SLOT_SIZE = (SLOT_HEAD.size + RECORD.size + 63) // 64 * 64
+FLOAT_INDEXES = [i for (i, name) in enumerate(TICK_FIELDS)
+        if name not in TICK_INT_FIELDS and name not in TICK_STR_FIELDS]
+STR_INDEXES = [i for (i, name) in enumerate(TICK_FIELDS) if name in TICK_STR_FIELDS][1:]
+#a slot left odd for this many reads was abandoned by a publisher dying in the middle of a write
+READ_RETRIES = 10000
+
+class TickPublisher:
+
+    def __init__(self, client, name = "ctp_client", max_codes = 4096):
+        self._client = client
+        self._max_codes = max_codes
+        self._shm = shared_memory.SharedMemory(name, create = True,
+                size = HEADER_SIZE + SLOT_SIZE * max_codes)
+        self._buf = self._shm.buf
+        self._slots = {}
+        self._seqs = []
+        self._lock = threading.Lock()
+        #held by a write, close() waits for the one under way
+        self._write_lock = threading.Lock()
+        self._closed = False
+        authkey = os.urandom(16)
+        self._listener = MPConn.Listener(authkey = authkey)
+        address = self._listener.address
+        HEADER.pack_into(self._buf, 0, MAGIC, max_codes, 0, SLOT_SIZE, authkey,
+                address.encode())
+        self._thread = threading.Thread(target = self._serve, name = "ctp_bus_listener",
+                daemon = True)
+        self._thread.start()
+        client.addTickSink(self)
+        logging.info("已创建行情总线<%s>..." % name)
+
+    def close(self):
+        #the md thread may still hold the sink it read before the removal
+        self._client.removeTickSink(self)
+        with self._write_lock:
+            self._closed = True
+        self._listener.close()
+        del self._buf
+        self._shm.close()
+        self._shm.unlink()
+
+    def _addSlot(self, code):
+        with self._lock:
+            if code in self._slots:
+                return self._slots[code]
+            slot = len(self._seqs)
+            if slot == self._max_codes:
+                raise RuntimeError("行情总线已满（最多%d个合约）" % self._max_codes)
+            SLOT_HEAD.pack_into(self._buf, HEADER_SIZE + slot * SLOT_SIZE, 0, code.encode())
+            self._seqs.append(0)
+            self._slots[code] = slot
+            CODE_COUNT.pack_into(self._buf, CODE_COUNT_OFFSET, slot + 1)
+            return slot
+
+    def __call__(self, tick):
+        slot = self._slots.get(tick[0])
+        if slot is None:
+            slot = self._addSlot(tick[0])
+        values = list(tick)
+        for i in FLOAT_INDEXES:
+            if values[i] is None:
+                values[i] = math.nan
+        for i in STR_INDEXES:
+            values[i] = values[i].encode()
+        values[0] = time.time()
+        offset = HEADER_SIZE + slot * SLOT_SIZE
+        with self._write_lock:
+            if self._closed:
+                return
+            seq = self._seqs[slot]
+            SEQ.pack_into(self._buf, offset, seq + 1)
+            RECORD.pack_into(self._buf, offset + SLOT_HEAD.size, *values)
+            SEQ.pack_into(self._buf, offset, seq + 2)
+            self._seqs[slot] = seq + 2
+
+    def _serve(self):
+        while True:
+            try:
+                conn = self._listener.accept()
+            except OSError:
+                return
+            except MPConn.AuthenticationError:
+                continue
+            threading.Thread(target = self._serveConnection, args = (conn,),
+                    daemon = True).start()
+
+    def _serveConnection(self, conn):
+        with conn:
+            while True:
+                try:
+                    (command, codes) = conn.recv()
+                except (EOFError, OSError):
+                    return
+                assert(command == "subscribe")
+                try:
+                    for code in codes:
+                        self._addSlot(code)
+                    self._client.subscribe(codes)
+                    conn.send(None)
+                except Exception as e:
+                    conn.send(str(e))
+
+
+class TickSubscriber:
+
+    def __init__(self, name = "ctp_client", tick_type = "dict"):
+        if tick_type not in TICK_CONVERTERS:
+            raise ValueError("错误的行情格式<%s>" % tick_type)
+        self._converter = TICK_CONVERTERS[tick_type]
+        self._shm = shared_memory.SharedMemory(name)
+        self._buf = self._shm.buf
+        (magic, self._max_codes, _, slot_size, self._authkey, address) =                \
+                HEADER.unpack_from(self._buf, 0)
+        if magic != MAGIC or slot_size != SLOT_SIZE:
+            raise RuntimeError("行情总线<%s>格式不匹配" % name)
+        self._address = address.rstrip(b"\0").decode()
+        self._conn = None
+        self._slots = {}
+        self._seqs = {}
+
+    def close(self):
+        if self._conn:
+            self._conn.close()
+        del self._buf
+        self._shm.close()
+
+    def subscribe(self, codes):
+        if not self._conn:
+            self._conn = MPConn.Client(self._address, authkey = self._authkey)
+        self._conn.send(("subscribe", list(codes)))
+        if not self._conn.poll(MAX_TIMEOUT):
+            raise TimeoutError("订阅行情超时")
+        error = self._conn.recv()
+        if error:
+            raise RuntimeError(error)
+
+    def _getSlot(self, code):
+        slot = self._slots.get(code)
+        if slot is None:
+            (count,) = CODE_COUNT.unpack_from(self._buf, CODE_COUNT_OFFSET)
+            for i in range(len(self._slots), count):
+                (_, slot_code) = SLOT_HEAD.unpack_from(self._buf, HEADER_SIZE + i * SLOT_SIZE)
+                self._slots[slot_code.rstrip(b"\0").decode()] = i
+            slot = self._slots.get(code)
+        return slot
+
+    def _read(self, code):
+        slot = self._getSlot(code)
+        if slot is None:
+            return (0, None)
+        offset = HEADER_SIZE + slot * SLOT_SIZE
+        for _ in range(READ_RETRIES):
+            (seq,) = SEQ.unpack_from(self._buf, offset)
+            if not seq & 1:
+                values = list(RECORD.unpack_from(self._buf, offset + SLOT_HEAD.size))
+                if SEQ.unpack_from(self._buf, offset)[0] == seq:
+                    break
+            #let the publisher finish the write
+            time.sleep(0)
+        else:
+            raise RuntimeError("读取行情总线中<%s>的行情失败，发布进程可能在写入时退出" % code)
+        if seq == 0:
+            return (0, None)
+        for i in FLOAT_INDEXES:
+            if values[i] != values[i]:
+                values[i] = None
+        for i in STR_INDEXES:
+            values[i] = values[i].rstrip(b"\0").decode()
+        #(receive time, tick) as readTicks() returns them
+        receive_time = values[0]
+        values[0] = code
+        tick = tuple(values)
+        return (seq, (receive_time, self._converter(tick) if self._converter else tick))
+
+    def getLatest(self, code):
+        (seq, item) = self._read(code)
+        self._seqs[code] = seq
+        return item
+
+    def waitNext(self, code, timeout = MAX_TIMEOUT):
+        deadline = time.monotonic() + timeout
+        last_seq = self._seqs.get(code, 0)
+        delay = 0.0001
+        while True:
+            (seq, item) = self._read(code)
+            if seq != last_seq:
+                self._seqs[code] = seq
+                return item
+            if time.monotonic() > deadline:
+                raise TimeoutError("等待<%s>的行情超时" % code)
+            time.sleep(delay)
+            delay = min(delay * 2, 0.001)
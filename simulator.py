@@ -0,0 +1,663 @@
+import time
+import heapq
+import ctypes
+import random
+import logging
+import itertools
+import threading
+from . import CTPStruct, TICK_FIELDS, QuoteImpl, TraderImpl, Client
+
+DBL_MAX = 1.7976931348623157e+308
+CST_OFFSET = 8 * 3600
+#CTP field names in the order of TICK_FIELDS
+MD_FIELDS = ("InstrumentID", "LastPrice", "OpenPrice", "ClosePrice", "HighestPrice",
+        "LowestPrice", "UpperLimitPrice", "LowerLimitPrice", "SettlementPrice", "Volume",
+        "Turnover", "OpenInterest", "PreClosePrice", "PreSettlementPrice",
+        "PreOpenInterest") +                                                            \
+        sum((("AskPrice%d" % i, "AskVolume%d" % i, "BidPrice%d" % i, "BidVolume%d" % i)
+                for i in range(1, 6)), ()) +                                           \
+        ("TradingDay", "ActionDay", "UpdateTime", "UpdateMillisec")
+assert(len(MD_FIELDS) == len(TICK_FIELDS))
+
+SIM_FRONTS = {}
+
+def getFront(address):
+    front = SIM_FRONTS.get(address)
+    if not front:
+        raise ValueError("模拟前置<%s>不存在" % address)
+    return front
+
+def makeField(struct, **values):
+    #like the CTP API, strings are sent GBK encoded, and single-char fields left empty are
+    #sent as '\0' since ctypes accepts no empty bytes for them
+    for (name, kind) in getattr(struct, "_fields_", ()):
+        if kind is ctypes.c_char and not values.get(name):
+            values[name] = b"\0"
+    return struct(**{name: value.encode("gbk") if isinstance(value, str) else value
+            for (name, value) in values.items()})
+
+def makeInstruments(count = 10, exchange = "SHFE", product = "sim", multiple = 10,
+        price_tick = 1.0, margin_ratio = 0.1):
+    return [{"InstrumentID": "%s%04d" % (product, i), "ExchangeID": exchange,
+            "InstrumentName": "模拟合约%d" % i, "ProductID": product,
+            "ProductClass": '1',                #THOST_FTDC_PC_Futures
+            "UnderlyingInstrID": "", "VolumeMultiple": multiple, "PriceTick": price_tick,
+            "ExpireDate": "", "InstLifePhase": '1',        #THOST_FTDC_IP_Started
+            "PositionType": '2',                #THOST_FTDC_PT_Gross
+            "PositionDateType": '1',            #THOST_FTDC_PDT_UseHistory
+            "LongMarginRatio": margin_ratio, "ShortMarginRatio": margin_ratio,
+            "OptionsType": "", "StrikePrice": DBL_MAX, "IsTrading": 1} for i in range(count)]
+
+def rspError(error_id, message):
+    return makeField(CTPStruct.RspInfoField, ErrorID = error_id, ErrorMsg = message)
+
+
+class SimFront:
+
+    def __init__(self, name = "sim", instruments = None, balance = 1000000.0, latency = 0,
+            jitter = 0, reject_rate = 0, query_rate = None, seed = None, trading_day = None):
+        self.address = "sim://" + name
+        self._instruments = {i["InstrumentID"]: i for i in
+                (makeInstruments() if instruments is None else instruments)}
+        self._latency = latency
+        self._jitter = jitter
+        self._reject_rate = reject_rate
+        self._query_interval = 1 / query_rate if query_rate else 0
+        self._last_query = 0
+        self._random = random.Random(seed)
+        self._trading_day = trading_day or time.strftime("%Y%m%d")
+        self._lock = threading.RLock()
+        self._md_sessions = {}
+        self._td_sessions = []
+        self._disconnected = set()
+        #the private flow of the day and how far each trader session has received it
+        self._flow = []
+        self._flow_pos = {}
+        self._streaming = set()
+        self._session_ids = itertools.count(1)
+        self._sys_ids = itertools.count(1)
+        self._trade_ids = itertools.count(1)
+        self._quotes = {}
+        self._orders = {}
+        self._trades = []
+        self._resting = {}
+        self._positions = {}
+        self._balance = balance
+        self._settlements = {}
+        self._events = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._running = True
+        self._thread = threading.Thread(target = self._dispatch, name = "ctp_sim", daemon = True)
+        self._thread.start()
+        self._feed = None
+        SIM_FRONTS[self.address] = self
+
+    def close(self):
+        self.stopFeed()
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        self._thread.join()
+        SIM_FRONTS.pop(self.address, None)
+
+    def addPosition(self, code, direction, volume, price):
+        instrument = self._instruments[code]
+        value = price * volume * instrument["VolumeMultiple"]
+        ratio = instrument["LongMarginRatio" if direction == "long" else "ShortMarginRatio"]
+        with self._lock:
+            position = self._getPosition(code, '2' if direction == "long" else '3')
+            position[0] += volume
+            position[1] += value
+            position[2] += value * ratio
+
+    def setSettlement(self, date, content):
+        self._settlements[date] = content
+
+    #callbacks are delivered by a single thread like the CTP API does
+    def _post(self, delay, func, *args):
+        with self._cond:
+            heapq.heappush(self._events, (time.monotonic() + delay, next(self._seq), func, args))
+            self._cond.notify()
+
+    def _later(self, func, *args):
+        delay = self._latency
+        if self._jitter:
+            delay += self._random.uniform(0, self._jitter)
+        self._post(delay, func, *args)
+
+    def _dispatch(self):
+        while True:
+            with self._cond:
+                while self._running:
+                    if self._events:
+                        timeout = self._events[0][0] - time.monotonic()
+                        if timeout <= 0:
+                            break
+                    else:
+                        timeout = None
+                    self._cond.wait(timeout)
+                if not self._running:
+                    return
+                (_, _, func, args) = heapq.heappop(self._events)
+            try:
+                func(*args)
+            except Exception:
+                logging.exception("模拟前置回调出错")
+
+    def _respondAll(self, callback, fields, req_id):
+        if not fields:
+            callback(None, None, req_id, True)
+        for (i, field) in enumerate(fields):
+            callback(field, None, req_id, i == len(fields) - 1)
+
+    def _broadcast(self, name, field):
+        with self._lock:
+            self._flow.append((name, field))
+            for session in self._streaming:
+                self._post(0, getattr(session, name), field)
+                self._flow_pos[session] = len(self._flow)
+
+    def _resumeFlow(self, session):
+        with self._lock:
+            resume_type = getattr(session, "_resume_type", 2)
+            if resume_type == 0:        #THOST_TERT_RESTART
+                pos = 0
+            elif resume_type == 1:      #THOST_TERT_RESUME
+                pos = self._flow_pos.get(session, 0)
+            else:                       #THOST_TERT_QUICK
+                pos = len(self._flow)
+            for (name, field) in self._flow[pos:]:
+                self._post(0, getattr(session, name), field)
+            self._flow_pos[session] = len(self._flow)
+            self._streaming.add(session)
+
+    def connect(self, session, is_md):
+        with self._lock:
+            if is_md:
+                self._md_sessions[session] = set()
+            else:
+                self._td_sessions.append(session)
+        self._later(session.OnFrontConnected)
+
+    def disconnect(self, session):
+        with self._lock:
+            self._md_sessions.pop(session, None)
+            if session in self._td_sessions:
+                self._td_sessions.remove(session)
+            self._flow_pos.pop(session, None)
+            self._streaming.discard(session)
+
+    def dropConnections(self, reconnect_after = 1.0):
+        with self._lock:
+            sessions = list(self._md_sessions) + self._td_sessions
+            for codes in self._md_sessions.values():
+                codes.clear()
+            self._disconnected.update(sessions)
+            self._streaming.difference_update(sessions)
+        for session in sessions:
+            self._post(0, session.OnFrontDisconnected, 0x1001)     #network read failure
+            if reconnect_after is not None:
+                self._post(reconnect_after, self._reconnect, session)
+
+    def _reconnect(self, session):
+        with self._lock:
+            self._disconnected.discard(session)
+        session.OnFrontConnected()
+
+    def mdLogin(self, session, field, req_id):
+        if session in self._disconnected:
+            return -1
+        self._later(session.OnRspUserLogin,
+                makeField(CTPStruct.RspUserLoginField, TradingDay = self._trading_day), None,
+                req_id, True)
+        return 0
+
+    def subscribe(self, session, codes, subscribe = True):
+        if session in self._disconnected:
+            return -1
+        with self._lock:
+            codes_set = self._md_sessions[session]
+            if subscribe:
+                codes_set.update(codes)
+            else:
+                codes_set.difference_update(codes)
+        callback = session.OnRspSubMarketData if subscribe else session.OnRspUnSubMarketData
+        self._later(self._respondAll, callback,
+                [makeField(CTPStruct.SpecificInstrumentField, InstrumentID = code)
+                for code in codes], 0)
+        return 0
+
+    def authenticate(self, session, field, req_id):
+        if session in self._disconnected:
+            return -1
+        self._later(session.OnRspAuthenticate, makeField(CTPStruct.RspAuthenticateField),
+                None, req_id, True)
+        return 0
+
+    def tdLogin(self, session, field, req_id):
+        if session in self._disconnected:
+            return -1
+        rsp = makeField(CTPStruct.RspUserLoginField, TradingDay = self._trading_day, FrontID = 1,
+                SessionID = next(self._session_ids), MaxOrderRef = "0")
+        self._later(session.OnRspUserLogin, rsp, None, req_id, True)
+        #the private flow follows the login response
+        self._later(self._resumeFlow, session)
+        return 0
+
+    def confirmSettlement(self, session, field, req_id):
+        if session in self._disconnected:
+            return -1
+        self._later(session.OnRspSettlementInfoConfirm,
+                makeField(CTPStruct.SettlementInfoConfirmField), None, req_id, True)
+        return 0
+
+    def query(self, session, callback, make_fields, req_id):
+        if session in self._disconnected:
+            return -1
+        if self._query_interval:
+            now = time.monotonic()
+            if now - self._last_query < self._query_interval:
+                return -3
+            self._last_query = now
+        with self._lock:
+            fields = make_fields()
+        self._later(self._respondAll, callback, fields, req_id)
+        return 0
+
+    def _instrumentFields(self):
+        return [makeField(CTPStruct.InstrumentField, **i) for i in self._instruments.values()]
+
+    def _accountFields(self):
+        margin = sum(p[2] for p in self._positions.values())
+        available = self._balance - margin
+        return [makeField(CTPStruct.TradingAccountField, Balance = self._balance,
+                CurrMargin = margin,
+                Available = available, WithdrawQuota = max(available, 0))]
+
+    def _orderFields(self):
+        return [makeField(CTPStruct.OrderField, **order) for order in self._orders.values()]
+
+    def _tradeFields(self, start_time, end_time):
+        #like CTP, TradeTimeStart and TradeTimeEnd filter by the time of day
+        return [makeField(CTPStruct.TradeField, **trade) for trade in self._trades
+                if (not start_time or trade["TradeTime"] >= start_time) and
+                (not end_time or trade["TradeTime"] <= end_time)]
+
+    def _positionFields(self):
+        return [makeField(CTPStruct.InvestorPositionField, InstrumentID = code,
+                PosiDirection = d, Position = p[0], OpenCost = p[1], UseMargin = p[2],
+                HedgeFlag = '1',                #THOST_FTDC_HF_Speculation
+                PositionDate = '1',             #THOST_FTDC_PSD_Today
+                ExchangeID = self._instruments[code]["ExchangeID"])
+                for ((code, d), p) in self._positions.items() if p[0] > 0]
+
+    def _settlementFields(self, date):
+        content = self._settlements.get(date, "模拟结算单 %s\n" % date).encode("gbk")
+        #CTP splits the GBK content into pieces of at most 500 bytes, even inside a character
+        return [makeField(CTPStruct.SettlementInfoField, TradingDay = date,
+                Content = content[i: i + 500]) for i in range(0, len(content), 500)]
+
+    def _getPosition(self, code, posi_direction):
+        #volume, open cost, margin, volume frozen by pending close orders
+        return self._positions.setdefault((code, posi_direction), [0, 0.0, 0.0, 0])
+
+    def insertOrder(self, session, field, req_id):
+        if session in self._disconnected:
+            return -1
+        order = {"BrokerID": field.BrokerID, "InvestorID": field.InvestorID,
+                "ExchangeID": field.ExchangeID, "InstrumentID": field.InstrumentID,
+                "OrderRef": field.OrderRef, "Direction": field.Direction,
+                "CombOffsetFlag": field.CombOffsetFlag, "CombHedgeFlag": field.CombHedgeFlag,
+                "OrderPriceType": field.OrderPriceType,
+                "LimitPrice": field.LimitPrice, "TimeCondition": field.TimeCondition,
+                "VolumeCondition": field.VolumeCondition, "MinVolume": field.MinVolume,
+                "VolumeTotalOriginal": field.VolumeTotalOriginal, "VolumeTraded": 0,
+                "VolumeTotal": field.VolumeTotalOriginal,
+                "FrontID": session._front_id, "SessionID": session._session_id,
+                "TradingDay": self._trading_day, "OrderSysID": "",
+                "OrderSubmitStatus": '0',       #THOST_FTDC_OSS_InsertSubmitted
+                "OrderStatus": 'a',             #THOST_FTDC_OST_Unknown
+                "StatusMsg": "报单已提交"}
+        self._later(self._insertOrder, session, field, order, req_id)
+        return 0
+
+    def _insertOrder(self, session, field, order, req_id):
+        with self._lock:
+            error = self._checkOrder(order)
+            if error:
+                session.OnRspOrderInsert(field, rspError(*error), req_id, True)
+                return
+            self._broadcast("OnRtnOrder", makeField(CTPStruct.OrderField, **order))
+            if self._reject_rate and self._random.random() < self._reject_rate:
+                order.update(OrderSubmitStatus = '4', OrderStatus = '5',
+                        StatusMsg = "模拟交易所拒绝报单")
+                self._broadcast("OnRtnOrder", makeField(CTPStruct.OrderField, **order))
+                return
+            sys_id = "%12d" % next(self._sys_ids)
+            order.update(OrderSysID = sys_id, OrderSubmitStatus = '3',
+                    OrderStatus = '3', StatusMsg = "未成交")
+            self._orders[sys_id] = order
+            if order["CombOffsetFlag"] != '0':
+                self._getPosition(order["InstrumentID"],
+                        '3' if order["Direction"] == '0' else '2')[3] += order["VolumeTotal"]
+            self._broadcast("OnRtnOrder", makeField(CTPStruct.OrderField, **order))
+            self._match(order)
+
+    def _checkOrder(self, order):
+        instrument = self._instruments.get(order["InstrumentID"])
+        if not instrument:
+            return (16, "CTP:找不到合约")
+        if order["VolumeTotalOriginal"] <= 0:
+            return (15, "CTP:报单字段有误")
+        if order["OrderPriceType"] == '2':      #THOST_FTDC_OPT_LimitPrice
+            ticks = order["LimitPrice"] / instrument["PriceTick"]
+            if order["LimitPrice"] <= 0 or abs(ticks - round(ticks)) > 1e-6:
+                return (15, "CTP:报单字段有误")
+        if order["CombOffsetFlag"] != '0':      #THOST_FTDC_OF_Open
+            position = self._getPosition(order["InstrumentID"],
+                    '3' if order["Direction"] == '0' else '2')
+            if position[0] - position[3] < order["VolumeTotalOriginal"]:
+                return (30, "CTP:平仓量超过持仓量")
+        return None
+
+    def _match(self, order):
+        quote = self._quotes.get(order["InstrumentID"])
+        is_buy = order["Direction"] == '0'
+        #THOST_FTDC_OPT_AnyPrice, or THOST_FTDC_OPT_FiveLevelPrice used on CFFEX, which
+        #sweeps at most the five levels the simulated book has anyway
+        is_market = order["OrderPriceType"] in ('1', 'G')
+        limit = order["LimitPrice"]
+        levels = []
+        if quote:
+            for level in (quote[0] if is_buy else quote[1]):
+                if level[1] <= 0:
+                    continue
+                if not is_market and (level[0] > limit if is_buy else level[0] < limit):
+                    break
+                levels.append(level)
+        available = sum(level[1] for level in levels)
+        remaining = order["VolumeTotal"]
+        if order["TimeCondition"] == '1':               #THOST_FTDC_TC_IOC
+            #THOST_FTDC_VC_MV = 2, THOST_FTDC_VC_CV = 3
+            if order["VolumeCondition"] == '3' and available < remaining or                \
+                    order["VolumeCondition"] == '2' and available < order["MinVolume"]:
+                levels = []
+        for level in levels:
+            volume = min(level[1], remaining)
+            level[1] -= volume
+            remaining -= volume
+            self._fill(order, level[0], volume)
+            if remaining == 0:
+                break
+        if remaining > 0 and order["TimeCondition"] == '1':
+            self._cancel(order, "已撤单")
+        elif remaining > 0:
+            self._resting.setdefault(order["InstrumentID"], []).append(order)
+
+    def _fill(self, order, price, volume):
+        instrument = self._instruments[order["InstrumentID"]]
+        order["VolumeTraded"] += volume
+        order["VolumeTotal"] -= volume
+        if order["VolumeTotal"] == 0:
+            order.update(OrderStatus = '0', StatusMsg = "全部成交")
+        else:
+            order.update(OrderStatus = '1', StatusMsg = "部分成交")
+        self._broadcast("OnRtnOrder", makeField(CTPStruct.OrderField, **order))
+        offset = order["CombOffsetFlag"]
+        direction = order["Direction"]
+        value = price * volume * instrument["VolumeMultiple"]
+        if offset == '0':
+            posi_direction = '2' if direction == '0' else '3'
+            position = self._getPosition(order["InstrumentID"], posi_direction)
+            ratio = instrument["LongMarginRatio" if posi_direction == '2' else "ShortMarginRatio"]
+            position[0] += volume
+            position[1] += value
+            position[2] += value * ratio
+        else:
+            posi_direction = '3' if direction == '0' else '2'
+            position = self._getPosition(order["InstrumentID"], posi_direction)
+            share = volume / position[0]
+            (cost, margin) = (position[1] * share, position[2] * share)
+            self._balance += (value - cost) if posi_direction == '2' else (cost - value)
+            position[0] -= volume
+            position[1] -= cost
+            position[2] -= margin
+            position[3] -= volume
+        now = time.time() + CST_OFFSET
+        trade = {"InstrumentID": order["InstrumentID"], "ExchangeID": order["ExchangeID"],
+                "TradeID": "%12d" % next(self._trade_ids), "OrderSysID": order["OrderSysID"],
+                "OrderRef": order["OrderRef"], "Direction": direction, "OffsetFlag": offset,
+                "HedgeFlag": order["CombHedgeFlag"][: 1],
+                "TradingRole": '1',             #THOST_FTDC_ER_Broker
+                "Price": price, "Volume": volume, "TradingDay": self._trading_day,
+                "TradeDate": time.strftime("%Y%m%d", time.gmtime(now)),
+                "TradeTime": time.strftime("%H:%M:%S", time.gmtime(now))}
+        self._trades.append(trade)
+        self._broadcast("OnRtnTrade", makeField(CTPStruct.TradeField, **trade))
+
+    def _cancel(self, order, message):
+        order.update(OrderStatus = '5', StatusMsg = message)
+        if order["CombOffsetFlag"] != '0':
+            self._getPosition(order["InstrumentID"],
+                    '3' if order["Direction"] == '0' else '2')[3] -= order["VolumeTotal"]
+        self._broadcast("OnRtnOrder", makeField(CTPStruct.OrderField, **order))
+
+    def deleteOrder(self, session, field, req_id):
+        if session in self._disconnected:
+            return -1
+        self._later(self._deleteOrder, session, field.OrderSysID, field.InstrumentID, req_id)
+        return 0
+
+    def _deleteOrder(self, session, sys_id, code, req_id):
+        with self._lock:
+            order = self._orders.get(sys_id)
+            error = None
+            if not order or order["InstrumentID"] != code:
+                error = rspError(25, "CTP:撤单找不到相应报单")
+            elif order["OrderStatus"] in ('0', '5'):
+                error = rspError(26, "CTP:报单已全成交或已撤销，不能再撤")
+            if error:
+                field = makeField(CTPStruct.InputOrderActionField, OrderSysID = sys_id,
+                        InstrumentID = code, ActionFlag = '0')     #THOST_FTDC_AF_Delete
+                session.OnRspOrderAction(field, error, req_id, True)
+                return
+            self._resting[code] = [o for o in self._resting.get(code, []) if o is not order]
+            self._cancel(order, "已撤单")
+
+    def publish(self, tick):
+        code = tick[0]
+        with self._lock:
+            self._quotes[code] = ([[tick[i], tick[i + 1]] for i in range(15, 35, 4)
+                    if tick[i] is not None],
+                    [[tick[i], tick[i + 1]] for i in range(17, 35, 4) if tick[i] is not None])
+            for order in self._resting.pop(code, []):
+                self._match(order)
+            sessions = [s for (s, codes) in self._md_sessions.items()
+                    if code in codes and s not in self._disconnected]
+        if sessions:
+            field = makeField(CTPStruct.DepthMarketDataField, **{name: DBL_MAX if value is None
+                    else value for (name, value) in zip(MD_FIELDS, tick)})
+            for session in sessions:
+                session.OnRtnDepthMarketData(field)
+
+    def _subscribedCodes(self):
+        with self._lock:
+            return sorted(set().union(*self._md_sessions.values()))
+
+    def startFeed(self, rate = 1000, codes = None, price = 3000.0):
+        self.stopFeed()
+        self._feed = SyntheticFeed(self, rate, codes, price, self._random.random())
+        self._feed.start()
+
+    def stopFeed(self):
+        if self._feed:
+            self._feed.stop()
+            self._feed = None
+
+    def replay(self, paths, speed = 0):
+        from .recorder import TickReplayer
+        replayer = TickReplayer(paths, speed)
+        replayer.addTickSink(self.publish)
+        return replayer.run()
+
+
+class SyntheticFeed:
+
+    def __init__(self, front, rate, codes, price, seed):
+        self._front = front
+        self._rate = rate
+        self._codes = codes
+        self._price = price
+        self._random = random.Random(seed)
+        self._states = {}
+        self._running = False
+        self.count = 0
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target = self._work, name = "ctp_sim_feed",
+                daemon = True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._thread.join()
+
+    def _makeTick(self, code):
+        instrument = self._front._instruments.get(code)
+        price_tick = instrument["PriceTick"] if instrument else 1.0
+        state = self._states.get(code)
+        if not state:
+            state = self._states[code] = [self._price, 0, 0.0, 0]
+        r = self._random
+        state[0] = max(price_tick, state[0] + r.choice((-1, 0, 0, 1)) * price_tick)
+        volume = r.randint(1, 10)
+        state[1] += volume
+        state[2] += volume * state[0]
+        state[3] += r.randint(-volume, volume)
+        (last, now) = (state[0], time.time() + CST_OFFSET)
+        tick = [code, last, self._price, None, None, None, None, None, None, state[1],
+                state[2], max(state[3], 0), self._price, self._price, 0]
+        for i in range(1, 6):
+            tick += [last + i * price_tick, r.randint(1, 50),
+                    last - i * price_tick, r.randint(1, 50)]
+        day = time.strftime("%Y%m%d", time.gmtime(now))
+        tick += [self._front._trading_day, day, time.strftime("%H:%M:%S", time.gmtime(now)),
+                int(now * 1000) % 1000]
+        return tuple(tick)
+
+    def _work(self):
+        start = time.monotonic()
+        while self._running:
+            codes = self._codes or self._front._subscribedCodes()
+            due = int((time.monotonic() - start) * self._rate) - self.count
+            if not codes or due <= 0:
+                time.sleep(0.001)
+                if not codes:
+                    (start, self.count) = (time.monotonic(), 0)
+                continue
+            for _ in range(min(due, 1000)):
+                self._front.publish(self._makeTick(codes[self.count % len(codes)]))
+                self.count += 1
+
+
+class SimMdApi:
+
+    def Create(self, flow_dir = ""):
+        pass
+
+    def RegisterFront(self, front):
+        self._sim = getFront(front)
+
+    def Init(self):
+        self._sim.connect(self, True)
+
+    def Release(self):
+        self._sim.disconnect(self)
+
+    def ReqUserLogin(self, field, req_id):
+        return self._sim.mdLogin(self, field, req_id)
+
+    def SubscribeMarketData(self, codes):
+        return self._sim.subscribe(self, codes)
+
+    def UnSubscribeMarketData(self, codes):
+        return self._sim.subscribe(self, codes, False)
+
+
+class SimTraderApi:
+
+    def Create(self, flow_dir = ""):
+        pass
+
+    def RegisterFront(self, front):
+        self._sim = getFront(front)
+
+    def SubscribePrivateTopic(self, resume_type):
+        self._resume_type = resume_type
+
+    def SubscribePublicTopic(self, resume_type):
+        pass
+
+    def Init(self):
+        self._sim.connect(self, False)
+
+    def Release(self):
+        self._sim.disconnect(self)
+
+    def ReqAuthenticate(self, field, req_id):
+        return self._sim.authenticate(self, field, req_id)
+
+    def ReqUserLogin(self, field, req_id):
+        return self._sim.tdLogin(self, field, req_id)
+
+    def ReqSettlementInfoConfirm(self, field, req_id):
+        return self._sim.confirmSettlement(self, field, req_id)
+
+    def ReqQryInstrument(self, field, req_id):
+        return self._sim.query(self, self.OnRspQryInstrument, self._sim._instrumentFields, req_id)
+
+    def ReqQryTradingAccount(self, field, req_id):
+        return self._sim.query(self, self.OnRspQryTradingAccount, self._sim._accountFields, req_id)
+
+    def ReqQryOrder(self, field, req_id):
+        return self._sim.query(self, self.OnRspQryOrder, self._sim._orderFields, req_id)
+
+    def ReqQryTrade(self, field, req_id):
+        return self._sim.query(self, self.OnRspQryTrade,
+                lambda: self._sim._tradeFields(field.TradeTimeStart, field.TradeTimeEnd), req_id)
+
+    def ReqQryInvestorPosition(self, field, req_id):
+        return self._sim.query(self, self.OnRspQryInvestorPosition, self._sim._positionFields,
+                req_id)
+
+    def ReqQryContractBank(self, field, req_id):
+        return self._sim.query(self, self.OnRspQryContractBank, list, req_id)
+
+    def ReqQryAccountregister(self, field, req_id):
+        return self._sim.query(self, self.OnRspQryAccountregister, list, req_id)
+
+    def ReqQrySettlementInfo(self, field, req_id):
+        return self._sim.query(self, self.OnRspQrySettlementInfo,
+                lambda: self._sim._settlementFields(field.TradingDay), req_id)
+
+    def ReqOrderInsert(self, field, req_id):
+        return self._sim.insertOrder(self, field, req_id)
+
+    def ReqOrderAction(self, field, req_id):
+        return self._sim.deleteOrder(self, field, req_id)
+
+
+class SimQuoteImpl(SimMdApi, QuoteImpl):
+    pass
+
+
+class SimTraderImpl(SimTraderApi, TraderImpl):
+    pass
+
+
+class SimClient(Client):
+
+    quote_impl = SimQuoteImpl
+    trader_impl = SimTraderImpl
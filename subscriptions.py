@@ -0,0 +1,103 @@
+import time
+import logging
+import threading
+from . import SUBSCRIBE_BATCH
+
+UNSUBSCRIBE_DELAY = 5
+
+class SubscriptionManager:
+
+    def __init__(self, md, get_instruments, unsubscribe_delay = UNSUBSCRIBE_DELAY):
+        self._md = md
+        self._get_instruments = get_instruments
+        self._unsubscribe_delay = unsubscribe_delay
+        #reference count of every code that is subscribed
+        self._counts = {}
+        #codes whose count dropped to zero and the time it did, still subscribed until flushed
+        self._idle = {}
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def resolve(self, codes = None, exchange = None, product = None, underlying = None,
+            expire_date = None, option_type = None, prefix = None):
+        no_filter = (exchange, product, underlying, expire_date, option_type, prefix) ==      \
+                (None,) * 6
+        if codes is None and no_filter:
+            #never the whole instrument table by accident
+            raise ValueError("必须指定合约代码或筛选条件")
+        instruments = self._get_instruments()
+        if codes is not None:
+            codes = list(dict.fromkeys(codes))
+            for code in codes:
+                if code not in instruments:
+                    raise ValueError("合约<%s>不存在" % code)
+            if no_filter:
+                return codes
+        matched = instruments.select(exchange, product, underlying, expire_date, option_type,
+                prefix)
+        if codes is None:
+            return matched
+        matched = set(matched)
+        return [code for code in codes if code in matched]
+
+    def subscribe(self, codes):
+        with self._lock:
+            new_codes = [code for code in codes
+                    if code not in self._counts and code not in self._idle]
+            if new_codes:
+                #raises before any count changes, so a failed call can simply be retried
+                self._md.subscribe(new_codes)
+            for code in codes:
+                self._counts[code] = self._counts.get(code, 0) + 1
+                self._idle.pop(code, None)
+        return codes
+
+    def unsubscribe(self, codes):
+        now = time.monotonic()
+        with self._lock:
+            for code in codes:
+                count = self._counts.get(code)
+                if count is None:
+                    continue
+                if count > 1:
+                    self._counts[code] = count - 1
+                else:
+                    del self._counts[code]
+                    self._idle[code] = now
+            if self._idle and not self._timer:
+                self._startTimer(self._unsubscribe_delay)
+
+    def _startTimer(self, delay):
+        self._timer = threading.Timer(delay, self._onTimer)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _onTimer(self):
+        deadline = time.monotonic() - self._unsubscribe_delay
+        with self._lock:
+            self._timer = None
+            self._flush([code for (code, t) in self._idle.items() if t <= deadline])
+            if self._idle:
+                self._startTimer(self._unsubscribe_delay)
+
+    def flush(self):
+        with self._lock:
+            self._flush(list(self._idle))
+
+    def _flush(self, codes):
+        for i in range(0, len(codes), SUBSCRIBE_BATCH):
+            batch = codes[i: i + SUBSCRIBE_BATCH]
+            try:
+                self._md.unsubscribe(batch)
+            except Exception as e:
+                #leave them idle and try again later
+                logging.warning("取消订阅行情失败：%s" % e)
+                return
+            for code in batch:
+                del self._idle[code]
+
+    def refCount(self, code):
+        return self._counts.get(code, 0)
+
+    def codes(self):
+        return sorted(self._counts)
@@ -0,0 +1,114 @@
+import time
+import calendar
+import pytest
+#the package imports ctpwrapper
+pytest.importorskip("ctpwrapper")
+pytest.importorskip("numpy")
+from ctp_client import bars
+from ctp_client.bars import BarEngine
+from ctp_client.bench import makeTick
+
+def cst(date, update_time):
+    #Unix time of a Beijing time
+    return calendar.timegm(time.strptime(date + update_time, "%Y%m%d%H:%M:%S")) - 8 * 3600
+
+class Feeder:
+    #a BarEngine fed by hand on a fake clock
+
+    def __init__(self, monkeypatch, intervals = (60,)):
+        self.engine = BarEngine(intervals, capacity = 8)
+        #the bars are flushed by the tests
+        self.engine.close()
+        self.now = 0.0
+        self.closed = []
+        self.engine.addCallback(lambda code, interval, bar:
+                self.closed.append((interval, bar.copy())))
+        monkeypatch.setattr(bars, "time", self)
+
+    def time(self):
+        return self.now
+
+    def __call__(self, date, update_time, volume, price = 3000.0, trading_day = "20240105",
+            now = None):
+        #received 0.1 seconds after the exchange time unless given
+        self.now = cst(date, update_time) + 0.1 if now is None else now
+        tick = list(makeTick("sim0000", price))
+        (tick[9], tick[10]) = (volume, volume * price * 10)
+        (tick[35], tick[37], tick[38]) = (trading_day, update_time, 0)
+        self.engine(tuple(tick))
+
+    def current(self):
+        return self.engine.getCurrentBar("sim0000")
+
+@pytest.fixture
+def feed(monkeypatch):
+    return Feeder(monkeypatch)
+
+
+def testBarFromCumulativeFields(feed):
+    #the first tick is only the baseline of the cumulative volume
+    feed("20240105", "09:01:00", 100)
+    assert feed.current() is None
+    feed("20240105", "09:01:10", 110, 3001.0)
+    feed("20240105", "09:01:50", 115, 2999.0)
+    assert feed.current()["volume"] == 15
+    feed("20240105", "09:02:05", 120, 3000.0)
+    [(interval, bar)] = feed.closed
+    assert interval == 60 and bar["start"] == cst("20240105", "09:01:00")
+    assert (bar["open"], bar["high"], bar["low"], bar["close"]) == (3001.0, 3001.0, 2999.0,
+            2999.0)
+    #the turnover is the cumulative one of the last tick less the baseline
+    assert (bar["volume"], bar["turnover"], bar["ticks"]) == (15, 115 * 2999.0 * 10 -
+            100 * 3000.0 * 10, 2)
+    assert feed.current()["start"] == cst("20240105", "09:02:00")
+    assert list(feed.engine.getBars("sim0000", 10)["start"]) == [bar["start"]]
+
+def testSessionBreak(feed):
+    feed("20240105", "10:14:30", 100)
+    feed("20240105", "10:14:59", 105)
+    #no tick closes the last bar before the break, the flush does grace seconds after its
+    #end on the exchange clock
+    feed.engine.flush(cst("20240105", "10:15:00") + 0.5)
+    assert not feed.closed
+    feed.engine.flush(cst("20240105", "10:15:01") + 0.5)
+    assert [bar["volume"] for (_, bar) in feed.closed] == [5]
+    #snapshots without trades during the break open no bar
+    feed("20240105", "10:15:03", 105)
+    assert feed.current() is None
+    feed("20240105", "10:30:00", 108)
+    assert feed.current()["start"] == cst("20240105", "10:30:00")
+    assert feed.current()["volume"] == 3
+
+def testTradingDayReset(feed):
+    feed("20240105", "14:59:00", 5000)
+    feed("20240105", "14:59:30", 5010)
+    #the night session belongs to the next trading day, whose volume counts from zero
+    feed("20240105", "21:00:00", 3, trading_day = "20240108")
+    assert [bar["volume"] for (_, bar) in feed.closed] == [10]
+    assert feed.current()["start"] == cst("20240105", "21:00:00")
+    assert feed.current()["volume"] == 3
+    #so does a cumulative volume going back within the day
+    feed("20240105", "21:00:30", 1, trading_day = "20240108")
+    assert feed.current()["volume"] == 4
+
+def testLateTick(feed):
+    feed("20240105", "09:01:00", 100)
+    feed("20240105", "09:01:30", 101)
+    feed.engine.flush(cst("20240105", "09:02:01") + 0.5)
+    assert len(feed.closed) == 1
+    #a tick of 09:01 received after its bar closed goes to the next bar
+    feed("20240105", "09:01:59", 104, 3002.0, now = cst("20240105", "09:02:01") + 0.6)
+    bar = feed.current()
+    assert bar["start"] == cst("20240105", "09:02:00")
+    assert (bar["open"], bar["volume"]) == (3002.0, 3)
+    assert len(feed.engine.getBars("sim0000", 10)) == 1
+
+def testIntervals(monkeypatch):
+    feed = Feeder(monkeypatch, (5, 60))
+    feed("20240105", "09:01:00", 100)
+    for (second, volume) in ((1, 101), (6, 103), (12, 106)):
+        feed("20240105", "09:01:%02d" % second, volume)
+    assert [(interval, bar["volume"]) for (interval, bar) in feed.closed] == [(5, 1), (5, 2)]
+    assert feed.engine.getCurrentBar("sim0000", 60)["volume"] == 6
+    with pytest.raises(ValueError):
+        feed.engine.getBars("sim0000", 1, 30)
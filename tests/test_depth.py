@@ -0,0 +1,91 @@
+import math
+import pytest
+#the package imports ctpwrapper
+pytest.importorskip("ctpwrapper")
+np = pytest.importorskip("numpy")
+from ctp_client.depth import DepthBook, ASK, BID
+from ctp_client.bench import makeTick
+
+def depthTick(code, asks, bids, upper = 3300.0, lower = 2700.0):
+    #levels beyond the given ones are empty as CTP sends them, price and volume None
+    tick = list(makeTick(code))
+    for level in range(5):
+        (ask, bid) = (asks[level: level + 1], bids[level: level + 1])
+        tick[15 + level * 4: 19 + level * 4] = (ask[0] if ask else (None, None)) +          \
+                (bid[0] if bid else (None, None))
+    (tick[6], tick[7]) = (upper, lower)
+    return tuple(tick)
+
+def priceTick(code):
+    if code == "unknown":
+        raise ValueError("合约<%s>不存在" % code)
+    return 2.0
+
+@pytest.fixture
+def book():
+    return DepthBook(priceTick, max_codes = 4)
+
+
+def testLevels(book):
+    book(depthTick("a", [(3001.0, 10), (3002.0, 20)], [(2999.0, 30)]))
+    row = book.getRow("a")
+    assert list(book.prices[row, :2, ASK]) == [3001.0, 3002.0]
+    assert list(book.volumes[row, :2, ASK]) == [10, 20]
+    assert book.prices[row, 0, BID] == 2999.0 and book.volumes[row, 0, BID] == 30
+    #empty levels have NaN prices
+    assert np.isnan(book.prices[row, 2:, ASK]).all() and np.isnan(book.prices[row, 1:, BID]).all()
+    assert list(book.limits[row]) == [3300.0, 2700.0] and book.price_ticks[row] == 2.0
+    #a later tick replaces every level
+    book(depthTick("a", [(3003.0, 1)], [(3001.0, 2), (3000.0, 3)]))
+    assert np.isnan(book.prices[row, 1, ASK]) and book.volumes[row, 1, BID] == 3
+
+def testMetrics(book):
+    book(depthTick("a", [(3002.0, 10), (3004.0, 30)], [(2998.0, 30), (2996.0, 50)]))
+    metrics = book.getMetrics("a")
+    assert metrics["code"] == "a"
+    assert (metrics["mid"], metrics["spread"], metrics["spread_ticks"]) == (3000.0, 4.0, 2.0)
+    #more bid volume pulls the price towards the ask
+    assert metrics["weighted_mid"] == (2998.0 * 10 + 3002.0 * 30) / 40
+    assert metrics["imbalance1"] == (30 - 10) / 40
+    assert (metrics["bid_depth"], metrics["ask_depth"]) == (80, 40)
+    assert metrics["imbalance"] == (80 - 40) / 120
+    assert (metrics["upper_distance"], metrics["lower_distance"]) == (150.0, 150.0)
+
+def testOneSidedBook(book):
+    #limit up, nobody sells
+    book(depthTick("a", [], [(3300.0, 500)]))
+    metrics = book.getMetrics("a")
+    for name in ("mid", "spread", "spread_ticks", "weighted_mid", "upper_distance"):
+        assert math.isnan(metrics[name])
+    assert (metrics["bid_depth"], metrics["ask_depth"], metrics["imbalance"]) == (500, 0, 1.0)
+
+def testUnknownPriceTick(book):
+    #the spread in ticks is left NaN, the rest is computed
+    book(depthTick("unknown", [(3001.0, 1)], [(2999.0, 1)]))
+    metrics = book.getMetrics("unknown")
+    assert metrics["spread"] == 2.0 and math.isnan(metrics["spread_ticks"])
+
+def testComputeChanged(book):
+    for code in ("a", "b", "c"):
+        book(depthTick(code, [(3001.0, 1)], [(2999.0, 1)]))
+    assert list(book.computeChanged()["code"]) == ["a", "b", "c"]
+    assert len(book.computeChanged()) == 0
+    book(depthTick("c", [(3003.0, 1)], [(2999.0, 1)]))
+    book(depthTick("a", [(3001.0, 1)], [(2997.0, 1)]))
+    #computing some codes clears only theirs
+    assert list(book.compute(["a", "missing"])["mid"]) == [2999.0]
+    changed = book.computeChanged()
+    assert list(changed["code"]) == ["c"] and list(changed["mid"]) == [3001.0]
+    assert list(book.compute()["code"]) == ["a", "b", "c"]
+    assert book.codes() == ["a", "b", "c"]
+
+def testErrors(book):
+    with pytest.raises(ValueError):
+        book.getMetrics("a")
+    with pytest.raises(ValueError):
+        book.getRow("a")
+    for code in ("a", "b", "c", "d"):
+        book(depthTick(code, [(3001.0, 1)], [(2999.0, 1)]))
+    with pytest.raises(RuntimeError):
+        book(depthTick("e", [(3001.0, 1)], [(2999.0, 1)]))
+    assert book.codes() == ["a", "b", "c", "d"]
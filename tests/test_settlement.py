@@ -0,0 +1,67 @@
+import os
+import pytest
+#the package imports ctpwrapper
+pytest.importorskip("ctpwrapper")
+from ctp_client.settlement import parseSettlement, toKey, toValue, tradingDates
+
+@pytest.fixture(scope = "module")
+def statement():
+    path = os.path.join(os.path.dirname(__file__), "data", "settlement_20240105.txt")
+    with open(path, encoding = "gbk") as fd:
+        return parseSettlement(fd.read())
+
+
+def testToKey():
+    assert toKey("期初结存 Balance b/f") == "balance_b_f"
+    assert toKey(" Trans.No. ") == "trans_no"
+    assert toKey("Market Value(Long)") == "market_value_long"
+    #labels without English are kept
+    assert toKey("买/卖") == "买_卖"
+
+def testToValue():
+    assert toValue("fee", "-1.17") == -1.17
+    assert toValue("lots", "1,200") == 1200
+    assert toValue("price", ".5") == 0.5
+    assert toValue("risk_degree", "0.79%") == "0.79%"
+    #identifiers keep their leading zeros
+    assert toValue("trans_no", "0012345") == "0012345"
+    assert toValue("client_id", "00123456") == "00123456"
+    assert toValue("open_date", "20240105") == "20240105"
+
+def testTradingDates():
+    assert tradingDates("20240105", "20240109") == ["20240105", "20240108", "20240109"]
+
+def testSections(statement):
+    assert set(statement) == {"info", "funds", "cash", "trades", "closed", "position_details",
+            "positions", "fees"}
+    assert statement["info"] == {"creation_date": "20240105", "client_id": "00123456",
+            "client_name": "张三", "date": "20240105"}
+
+def testFunds(statement):
+    funds = statement["funds"]
+    assert funds["balance_b_f"] == 990000.0 and funds["balance_c_f"] == 1000005.32
+    #the funds item shares its title with the deposit/withdrawal section
+    assert funds["deposit_withdrawal"] == 10000.0
+    assert funds["realized_p_l"] == -10.0 and funds["client_equity"] == 1000405.32
+    assert funds["risk_degree"] == "0.79%"
+
+def testTables(statement):
+    #English headers under the Chinese ones name the columns, summary rows are skipped
+    assert statement["cash"] == [{"date": "20240105", "type": "银期转账", "deposit": 10000.0,
+            "withdrawal": 0.0, "note": ""}]
+    trades = statement["trades"]
+    assert [trade["trans_no"] for trade in trades] == ["0012345", "0012346", "0012347"]
+    assert trades[1] == {"date": "20240105", "exchange": "上期所", "product": "螺纹钢",
+            "instrument": "rb2405", "b_s": "卖", "s_h": "投机", "price": 3899.0, "lots": 1,
+            "turnover": 38990.0, "o_c": "平", "fee": 1.17, "realized_p_l": -10.0,
+            "premium_received_paid": 0.0, "trans_no": "0012346"}
+    assert statement["closed"][0]["open_date"] == "20240105"
+    assert statement["closed"][0]["realized_p_l"] == -10.0
+    #"positions detail" is not taken for "positions"
+    assert len(statement["position_details"]) == len(statement["positions"]) == 1
+    assert statement["position_details"][0]["margin"] == 7920.0
+    assert statement["positions"][0]["long_pos"] == 2
+    assert statement["positions"][0]["market_value_short"] == 0.0
+
+def testFees(statement):
+    assert statement["fees"] == {"rb2405": 2.34, "rb2410": 2.34}
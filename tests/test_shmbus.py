@@ -0,0 +1,72 @@
+import os
+import time
+import pytest
+#the package imports ctpwrapper
+pytest.importorskip("ctpwrapper")
+from ctp_client.shmbus import TickPublisher, TickSubscriber, SEQ, HEADER_SIZE
+from ctp_client.bench import makeTick
+
+class FakeClient:
+    #the part of Client a TickPublisher uses
+
+    def __init__(self):
+        self.sinks = []
+        self.codes = []
+
+    def addTickSink(self, sink):
+        self.sinks.append(sink)
+
+    def removeTickSink(self, sink):
+        self.sinks.remove(sink)
+
+    def subscribe(self, codes):
+        self.codes += codes
+
+@pytest.fixture
+def bus(request):
+    client = FakeClient()
+    name = "ctp_test_%d_%s" % (os.getpid(), request.node.name)
+    publisher = TickPublisher(client, name, max_codes = 4)
+    subscriber = TickSubscriber(name, "tuple")
+    yield (client, publisher, subscriber)
+    subscriber.close()
+    publisher.close()
+
+
+def testLatest(bus):
+    (client, publisher, subscriber) = bus
+    assert subscriber.getLatest("sim0000") is None
+    start = time.time()
+    publisher(makeTick())
+    (receive_time, tick) = subscriber.getLatest("sim0000")
+    assert start <= receive_time <= time.time()
+    #None prices come back as None
+    assert tick == makeTick()
+    subscriber.subscribe(["sim0001"])
+    assert client.codes == ["sim0001"] and subscriber.getLatest("sim0001") is None
+
+def testWaitNext(bus):
+    (_, publisher, subscriber) = bus
+    publisher(makeTick())
+    subscriber.getLatest("sim0000")
+    with pytest.raises(TimeoutError):
+        subscriber.waitNext("sim0000", 0.01)
+    publisher(makeTick(price = 3001.0))
+    assert subscriber.waitNext("sim0000", 0.01)[1][1] == 3001.0
+
+def testAbandonedWrite(bus):
+    (_, publisher, subscriber) = bus
+    publisher(makeTick())
+    #a publisher dying in the middle of a write leaves the sequence odd
+    SEQ.pack_into(publisher._buf, HEADER_SIZE, 3)
+    with pytest.raises(RuntimeError, match = "sim0000"):
+        subscriber.getLatest("sim0000")
+
+def testLateTickAfterClose():
+    client = FakeClient()
+    publisher = TickPublisher(client, "ctp_test_%d_close" % os.getpid())
+    publisher(makeTick())
+    publisher.close()
+    assert not client.sinks
+    #taken by the md thread before the sink was removed
+    publisher(makeTick())
@@ -0,0 +1,246 @@
+import os
+import time
+import shutil
+import asyncio
+import logging
+import pytest
+#the simulator replaces the CTP API but still uses the structs of ctpwrapper
+pytest.importorskip("ctpwrapper")
+from ctp_client import TradingBook, AsyncClient, DATA_DIR, PRIORITY_NORMAL
+from ctp_client.instruments import InstrumentTable
+from ctp_client.simulator import SimFront, SimClient, SimTraderImpl
+from ctp_client.bench import makeTick
+
+def waitFor(condition, timeout = 3.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+def makeClient(md_front, td_front, **kwargs):
+    kwargs = dict(dict(query_rate = 1000, query_burst = 1000, reconcile_interval = 0,
+            order_rate = 1000, order_burst = 1000, probe_interval = 0), **kwargs)
+    return SimClient(md_front, td_front, "9999", "app", "auth", "user", "password", **kwargs)
+
+@pytest.fixture(autouse = True)
+def workdir(tmp_path, monkeypatch):
+    #DATA_DIR is relative to the working directory
+    monkeypatch.chdir(tmp_path)
+
+@pytest.fixture
+def front(request):
+    front = SimFront(request.node.name, seed = 0)
+    front.addPosition("sim0001", "long", 2, 3000.0)
+    yield front
+    front.close()
+
+@pytest.fixture
+def client(front):
+    client = makeClient(front.address, front.address)
+    client.subscribe(["sim0000", "sim0001"])
+    front.publish(makeTick("sim0000"))
+    front.publish(makeTick("sim0001"))
+    time.sleep(0.05)
+    return client
+
+
+def testOrderFutures(client):
+    #the book of makeTick() has asks from 3001 and bids from 2999
+    assert client.orderFAK("sim0000", "long", 1, 3001.0, 0) == 1
+    assert client.orderFAK("sim0000", "long", 1, 2990.0, 0) == 0
+    assert client.orderMarket("sim0000", "short", 2) == 2
+    future = client.submitLimit("sim0000", "long", 1, 2990.0)
+    order_id = future.wait()
+    assert future.done() and order_id.endswith("@sim0000")
+
+def testOrderRejects(client):
+    with pytest.raises(RuntimeError, match = "报单字段有误"):
+        client.orderLimit("sim0000", "long", 1, 2990.5)
+    with pytest.raises(RuntimeError, match = "平仓量超过持仓量"):
+        client.orderLimit("sim0001", "long", -3, 3010.0)
+    with pytest.raises(ValueError):
+        client.orderLimit("nope", "long", 1, 3000.0)
+    with pytest.raises(ValueError):
+        client.orderLimit("sim0000", "up", 1, 3000.0)
+
+def testBookFollowsReturns(front, client):
+    assert client.getPositions("sim0001") == [{"code": "sim0001", "direction": "long",
+            "volume": 2, "margin": 6000.0, "cost": 60000.0}]
+    order_id = client.orderLimit("sim0000", "long", 2, 2990.0)
+    order = client.getOrder(order_id)
+    assert order["is_active"] and order["volume"] == 2 and order["volume_traded"] == 0
+    assert client.getPositions("sim0000") == []
+    #an ask at the order price fills it
+    tick = list(makeTick("sim0000"))
+    tick[15] = 2990.0
+    front.publish(tuple(tick))
+    assert waitFor(lambda: not client.getOrder(order_id)["is_active"])
+    assert client.getOrder(order_id)["volume_traded"] == 2
+    assert waitFor(lambda: client.getPositions("sim0000"))
+    assert client.getPositions("sim0000")[0]["volume"] == 2
+    #closing reduces the position
+    assert client.orderFAK("sim0001", "long", -1, 2999.0, 0) == 1
+    assert waitFor(lambda: client.getPositions("sim0001")[0]["volume"] == 1)
+    assert len(client.getTrades()) == 2
+
+def testSeedKeepsReturnsAfterQueries(front, client, monkeypatch):
+    order_id = client.orderLimit("sim0000", "long", 2, 2990.0)
+    snapshotBook = SimTraderImpl._snapshotBook
+    def fillAfterQueries(td, priority):
+        result = snapshotBook(td, priority)
+        tick = list(makeTick("sim0000"))
+        tick[15] = 2990.0
+        front.publish(tuple(tick))
+        assert waitFor(lambda: td._snapshot[1])
+        return result
+    #the order fills after the new session queried the book but before it is seeded
+    monkeypatch.setattr(SimTraderImpl, "_snapshotBook", fillAfterQueries)
+    other = makeClient(front.address, front.address)
+    assert not other.getOrder(order_id)["is_active"]
+    assert other.getPositions("sim0000")[0]["volume"] == 2
+
+def testBookDiffCountsReturnsAfterQueries():
+    book = TradingBook()
+    order = {"code": "sim0000", "direction": "long", "price": 2990.0, "volume": 2,
+            "volume_traded": 0, "is_active": True}
+    book.reset({"1@sim0000": order}, [])
+    book.updateOrder("1@sim0000", dict(order, volume_traded = 2, is_active = False))
+    trade = (("SHFE", "1"), "sim0000", "long", 2, 2990.0, 10, 0.1)
+    book.applyTrade(*trade)
+    #queried before the fill, which returned afterwards
+    assert len(book.diff({"1@sim0000": order}, [])) == 2
+    assert book.diff({"1@sim0000": order}, [], [trade], {"1@sim0000"}) == {}
+    book.reset({"1@sim0000": order}, [], [trade], {"1@sim0000"})
+    assert not book.getOrder("1@sim0000")["is_active"]
+    assert book.getPositions() == [{"code": "sim0000", "direction": "long", "volume": 2,
+            "margin": 5980.0, "cost": 59800.0}]
+
+def testLimitBatchAndCancelAll(client):
+    results = client.orderLimitBatch([("sim0000", "long", 1, 2990.0),
+            ("sim0000", "long", 1, 2990.5), ("sim0000", "short", 1, 3010.0)])
+    assert isinstance(results[1], RuntimeError)
+    (long_id, short_id) = (results[0], results[2])
+    assert client.getOrder(long_id)["is_active"] and client.getOrder(short_id)["is_active"]
+    with pytest.raises(ValueError, match = "第2笔"):
+        client.orderLimitBatch([("sim0000", "long", 1, 2990.0), ("nope", "long", 1, 1.0)])
+    assert len(client.getOrders()) == 2
+    assert client.cancelAll("sim0000", "short") == {short_id: None}
+    assert client.getOrder(long_id)["is_active"]
+    assert client.cancelAll() == {long_id: None}
+    assert not any(order["is_active"] for order in client.getOrders().values())
+
+def testOrderTimeout(front, client, monkeypatch):
+    client.enableLatencyStats()
+    td = client._td
+    #the front takes the orders and deletes but never answers
+    monkeypatch.setattr(front, "insertOrder", lambda session, field, req_id: 0)
+    monkeypatch.setattr(front, "deleteOrder", lambda session, field, req_id: 0)
+    aclient = AsyncClient(client)
+    (order, delete) = (td.submitLimit("sim0000", "long", 1, 2990.0),
+            td.submitDelete("1@sim0000"))
+    assert len(td._pending_orders) == len(td._pending_deletes) == 1 and len(td._sent_times) == 2
+    for future in (order, delete):
+        with pytest.raises(TimeoutError):
+            asyncio.run(aclient._await(future, 0.05))
+        #given up rather than left for returns that may never come
+        with pytest.raises(TimeoutError):
+            future.wait(0)
+    assert not td._pending_orders and not td._pending_deletes and not td._sent_times
+    aclient.close()
+
+def testInstrumentCache(client):
+    td = client._td
+    cache_dir = DATA_DIR + "instruments/"
+    [today] = os.listdir(cache_dir)
+    assert td._instruments.path == cache_dir + today
+    #as loaded by fast_start from an earlier day, the file of the day is found broken
+    shutil.copy(cache_dir + today, cache_dir + "2000-01-01_0.dat")
+    td._instruments = InstrumentTable(cache_dir + "2000-01-01_0.dat")
+    with open(cache_dir + today, "wb") as fd:
+        fd.write(b"broken")
+    td._getInstruments(PRIORITY_NORMAL)
+    #fetched into a new file, the one still mapped is left for the next refresh
+    names = sorted(os.listdir(cache_dir))
+    assert len(names) == 2 and names[0] == "2000-01-01_0.dat"
+    assert td._instruments.path == cache_dir + names[1] and names[1] != today
+    assert client.getInstrument("sim0000")["exchange"] == "SHFE"
+
+def testReconnectAndResume(front, client):
+    got = []
+    client.setReceiver(lambda tick: got.append(tick["code"]))
+    order_id = client.orderLimit("sim0000", "long", 1, 2990.0)
+    logging.disable(logging.CRITICAL)
+    try:
+        front.dropConnections(reconnect_after = 0.3)
+        assert waitFor(lambda: not client._td.isReady())
+        with pytest.raises(RuntimeError):
+            client.orderLimit("sim0000", "long", 1, 2990.0)
+        #filled while disconnected, the return is replayed after the login
+        tick = list(makeTick("sim0000"))
+        tick[15] = 2990.0
+        front.publish(tuple(tick))
+        assert waitFor(lambda: client._md.isReady() and client._td.isReady())
+    finally:
+        logging.disable(logging.NOTSET)
+    assert waitFor(lambda: not client.getOrder(order_id)["is_active"])
+    assert waitFor(lambda: client.getPositions("sim0000"))
+    #subscriptions are restored
+    got.clear()
+    front.publish(makeTick("sim0001"))
+    assert waitFor(lambda: got == ["sim0001"])
+    assert client.orderFAK("sim0000", "long", 1, 3001.0, 0) == 1
+
+def testFailover(request):
+    (a, b) = (SimFront(request.node.name + "_a"), SimFront(request.node.name + "_b"))
+    try:
+        client = makeClient([a.address, b.address], [a.address, b.address])
+        (md, td) = (client._md, client._td)
+        assert waitFor(lambda: td._standby is not None)
+        client.subscribe(["sim0000"])
+        (failed, other) = (a, b) if td._fronts[td._active] == a.address else (b, a)
+        logging.disable(logging.CRITICAL)
+        try:
+            failed.dropConnections(None)
+            assert waitFor(lambda: td._fronts[td._active] == other.address)
+            assert waitFor(lambda: md._fronts[md._active] == other.address)
+        finally:
+            logging.disable(logging.NOTSET)
+        got = []
+        client.setReceiver(lambda tick: got.append(tick["code"]))
+        other.publish(makeTick("sim0000"))
+        assert waitFor(lambda: got == ["sim0000"])
+        assert client.orderFAK("sim0000", "long", 1, 3001.0, 0) == 1
+    finally:
+        a.close()
+        b.close()
+
+def testRiskGate(front, client):
+    from ctp_client.risk import RiskRejected
+    client.enableRiskGate(max_volume = 5)
+    client.setRiskLimits("sim0000", max_rate = 2)
+    with pytest.raises(RiskRejected):
+        client.orderLimit("sim0000", "long", 1, 2990.5)
+    with pytest.raises(RiskRejected):
+        client.orderLimit("sim0000", "long", 6, 2990.0)
+    #orders that fail later checks or never leave a batch give their rate tokens back
+    with pytest.raises(ValueError):
+        client.orderFAK("sim0000", "long", 1, 3001.0, 2)
+    with pytest.raises(ValueError):
+        client.orderLimitBatch([("sim0000", "long", 1, 2990.0), ("nope", "long", 1, 1.0)])
+    client.orderLimit("sim0000", "long", 1, 2990.0)
+    client.orderLimit("sim0000", "long", 1, 2990.0)
+    with pytest.raises(RiskRejected, match = "频率"):
+        client.orderLimit("sim0000", "long", 1, 2990.0)
+    #closing orders still active count against the position
+    close_id = client.orderLimit("sim0001", "long", -2, 3010.0)
+    with pytest.raises(RiskRejected, match = "可平持仓<0>"):
+        client.orderLimit("sim0001", "long", -1, 3010.0)
+    client.deleteOrder(close_id)
+    assert waitFor(lambda: not client.getOrder(close_id)["is_active"])
+    #so do closes of the same batch, before any of them returns
+    with pytest.raises(ValueError, match = "第2笔.*可平持仓<1>"):
+        client.orderLimitBatch([("sim0001", "long", -1, 3010.0), ("sim0001", "long", -2, 3010.0)])
+    assert client.orderFAK("sim0001", "long", -2, 2999.0, 0) == 2
+    assert client._risk.rejected == 5 and not client._risk._holding
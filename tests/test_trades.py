@@ -0,0 +1,78 @@
+import json
+import pytest
+#the package imports ctpwrapper
+pytest.importorskip("ctpwrapper")
+from ctp_client.trades import TradeStore, sessionOrder
+
+def makeTrade(trade_id, time, order_id = "1@rb2405", code = "rb2405"):
+    return {"trade_id": trade_id, "exchange": "SHFE", "order_id": order_id, "code": code,
+            "direction": "long", "price": 3900.0, "volume": 1, "date": "20240105",
+            "time": time, "trading_day": "20240108"}
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "trades" / "20240108.jsonl")
+
+
+def testSessionOrder():
+    times = ["09:00:00", "23:59:59", "21:00:00", "14:59:59", "00:00:00", "02:30:00"]
+    assert sorted(times, key = sessionOrder) == ["21:00:00", "23:59:59", "00:00:00",
+            "02:30:00", "09:00:00", "14:59:59"]
+
+def testAddAndReload(path):
+    store = TradeStore(path, "20240108")
+    assert store.add([makeTrade("1", "21:00:01"), makeTrade("2", "21:00:02", "2@rb2405")]) == 2
+    #trades fetched again are not stored twice
+    assert store.add([makeTrade("2", "21:00:02", "2@rb2405"), makeTrade("3", "21:00:03")]) == 1
+    store.close()
+    store = TradeStore(path, "20240108", True)
+    assert [trade["trade_id"] for trade in store.getTrades()] == ["1", "2", "3"]
+    assert [trade["trade_id"] for trade in store.getOrderTrades("1@rb2405")] == ["1", "3"]
+    assert store.getTrades("ag2406") == []
+    #copies, the store is not changed through them
+    store.getTrades()[0]["volume"] = 100
+    assert store.getTrades()[0]["volume"] == 1
+
+def testTornLastLine(path):
+    store = TradeStore(path, "20240108")
+    store.add([makeTrade("1", "21:00:01"), makeTrade("2", "21:00:02")])
+    store.close()
+    #a crash in the middle of writing the last line
+    line = json.dumps(makeTrade("3", "21:00:03"))
+    with open(path, "a", encoding = "utf-8") as fd:
+        fd.write(line[: len(line) // 2])
+    store = TradeStore(path, "20240108")
+    assert [trade["trade_id"] for trade in store.getTrades()] == ["1", "2"]
+    #the lost trade comes again with the next query, on a line of its own
+    assert store.add([makeTrade("3", "21:00:03")]) == 1
+    store.close()
+    with open(path, encoding = "utf-8") as fd:
+        lines = fd.read().split("\n")
+    assert lines[2] == line[: len(line) // 2] and json.loads(lines[3])["trade_id"] == "3"
+    store = TradeStore(path, "20240108", True)
+    assert [trade["trade_id"] for trade in store.getTrades()] == ["1", "2", "3"]
+
+def testLastTimeAcrossMidnight(path):
+    store = TradeStore(path, "20240108")
+    assert store.lastTime() is None
+    #a query from a time before midnight would miss the trades after it, all are fetched
+    store.add([makeTrade("1", "21:00:01"), makeTrade("2", "23:59:58")])
+    assert store.lastTime() is None
+    store.add([makeTrade("3", "00:30:00")])
+    assert store.lastTime() == "00:30:00"
+    #trades of the night session returned late don't move it back
+    store.add([makeTrade("4", "23:59:59")])
+    assert store.lastTime() == "00:30:00"
+    store.add([makeTrade("5", "09:05:00")])
+    assert store.lastTime() == "09:05:00"
+    store.close()
+    #rebuilt from the file
+    assert TradeStore(path, "20240108", True).lastTime() == "09:05:00"
+
+def testReadOnly(path):
+    store = TradeStore(path, "20240108", True)
+    assert store.getTrades() == [] and store.lastTime() is None
+    #indexed but not written
+    assert store.add([makeTrade("1", "21:00:01")]) == 1
+    store.close()
+    assert TradeStore(path, "20240108", True).getTrades() == []
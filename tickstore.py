@@ -0,0 +1,84 @@
+import time
+import threading
+import numpy as np
+from . import TICK_FIELDS, TICK_INT_FIELDS, TICK_STR_FIELDS
+
+TICK_DTYPE = np.dtype([("time", "f8")] + [(name, "i8" if name in TICK_INT_FIELDS else
+        "U8" if name in TICK_STR_FIELDS else "f8") for name in TICK_FIELDS[1:]])
+LATEST_DTYPE = np.dtype([("code", "U31")] + TICK_DTYPE.descr)
+
+def emptyRecord(dtype):
+    record = np.zeros((), dtype)
+    for name in dtype.names:
+        if dtype[name].kind == "f":
+            record[name] = np.nan
+    return record
+
+class TickStore:
+
+    def __init__(self, capacity = 1024, max_codes = 4096):
+        self._capacity = capacity
+        self._max_codes = max_codes
+        self._empty = emptyRecord(TICK_DTYPE)
+        self._latest = np.full(max_codes, emptyRecord(LATEST_DTYPE))
+        self._rows = {}
+        self._codes = []
+        self._histories = []
+        self._counts = []
+        #codes are added by subscribe() as well as by the md thread
+        self._lock = threading.Lock()
+
+    def addCodes(self, codes):
+        for code in codes:
+            if code not in self._rows:
+                self._addCode(code)
+
+    def _addCode(self, code):
+        with self._lock:
+            if code in self._rows:
+                return self._rows[code]
+            row = len(self._codes)
+            if row == self._max_codes:
+                raise RuntimeError("行情缓存已满（最多%d个合约）" % self._max_codes)
+            #every record is written twice, at i and i + capacity, so that the latest n
+            #records are always contiguous and can be returned as a view
+            self._histories.append(np.full(self._capacity * 2, self._empty))
+            self._counts.append(0)
+            self._latest[row]["code"] = code
+            self._codes.append(code)
+            #published last, a row found in _rows has its history
+            self._rows[code] = row
+            return row
+
+    def __call__(self, tick):
+        code = tick[0]
+        row = self._rows.get(code)
+        if row is None:
+            row = self._addCode(code)
+        record = (time.time(),) + tick[1:]
+        count = self._counts[row]
+        i = count % self._capacity
+        history = self._histories[row]
+        history[i] = record
+        history[i + self._capacity] = record
+        self._counts[row] = count + 1
+        self._latest[row] = (code,) + record
+
+    def _getRow(self, code):
+        row = self._rows.get(code)
+        if row is None or self._counts[row] == 0:
+            raise ValueError("合约<%s>没有行情" % code)
+        return row
+
+    def getLatest(self, code):
+        return self._latest[self._getRow(code)]
+
+    def getHistory(self, code, n):
+        row = self._getRow(code)
+        count = self._counts[row]
+        n = min(n, count, self._capacity)
+        end = (count - 1) % self._capacity + self._capacity + 1
+        return self._histories[row][end - n: end]
+
+    def snapshot(self):
+        return self._latest[: len(self._codes)]
@@ -0,0 +1,80 @@
+import os
+import json
+import threading
+
+def sessionOrder(trade_time):
+    #a trading day starts with the night session, continues after midnight, then the day
+    if trade_time >= "18:00:00":
+        return (0, trade_time)
+    if trade_time < "06:00:00":
+        return (1, trade_time)
+    return (2, trade_time)
+
+class TradeStore:
+
+    def __init__(self, path, trading_day, read_only = False):
+        self.trading_day = trading_day
+        self._lock = threading.Lock()
+        self._trades = []
+        self._keys = set()
+        self._orders = {}
+        self._last = None
+        self._fd = None
+        complete = True
+        if os.path.exists(path):
+            with open(path, encoding = "utf-8") as fd:
+                for line in fd:
+                    complete = line.endswith("\n")
+                    try:
+                        self._index(json.loads(line))
+                    except ValueError:
+                        #the last line may be cut short by a crash
+                        pass
+        if not read_only:
+            os.makedirs(os.path.dirname(path), exist_ok = True)
+            self._fd = open(path, "a", encoding = "utf-8")
+            if not complete:
+                self._fd.write("\n")
+
+    def close(self):
+        with self._lock:
+            if self._fd:
+                self._fd.close()
+                self._fd = None
+
+    def _index(self, trade):
+        key = (trade["exchange"], trade["trade_id"])
+        if key in self._keys:
+            return False
+        self._keys.add(key)
+        self._trades.append(trade)
+        self._orders.setdefault(trade["order_id"], []).append(trade)
+        order = sessionOrder(trade["time"])
+        if self._last is None or order > self._last:
+            self._last = order
+        return True
+
+    def add(self, trades):
+        with self._lock:
+            lines = [json.dumps(trade, ensure_ascii = False) for trade in trades
+                    if self._index(trade)]
+            if lines and self._fd:
+                self._fd.write("\n".join(lines) + "\n")
+                self._fd.flush()
+            return len(lines)
+
+    def lastTime(self):
+        #trades from this time of day on are fetched again, None if all have to be; a query
+        #from a time before midnight would miss the trades after it
+        with self._lock:
+            if self._last is None or self._last[0] == 0:
+                return None
+            return self._last[1]
+
+    def getTrades(self, code = None):
+        with self._lock:
+            return [trade.copy() for trade in self._trades if code in (None, trade["code"])]
+
+    def getOrderTrades(self, order_id):
+        with self._lock:
+            return [trade.copy() for trade in self._orders.get(order_id, ())]